@@ -7,10 +7,13 @@ import os
 import sys
 import time
 import json
+import heapq
 import select
+import signal
 import socket
 import netifaces
 import argparse
+import itertools
 import traceback
 
 from tail import *
@@ -20,6 +23,9 @@ class cfg:
 
     debug = 0
 
+    trace_ring      = 0
+    trace_level     = 4
+
     dw1000_profile  = None
     dw1000_channel  = 5
     dw1000_pcode    = 12
@@ -38,6 +44,8 @@ class cfg:
     server_host     = None
     server_port     = 9813
 
+    schedule_spin   = 0.0005
+
     config_json     = '/etc/tail.json'
 
 
@@ -51,14 +59,12 @@ class socks:
 
     udp_addrs = {}
     udp_pipes = {}
+    udp_formats = {}
     
     tcp_clients = {}
 
-
-
-def dprint(level, *args, **kwargs):
-    if cfg.debug >= level:
-        print(*args, file=sys.stderr, flush=True, **kwargs)
+    schedule = []
+    schedule_seqn = itertools.count()
 
 
 def register_tag(eui):
@@ -73,28 +79,54 @@ def register_udp_client(owner,addr,port):
     pipe.connect(addr,port)
     socks.udp_pipes[owner] = pipe
     socks.udp_addrs[pipe.remote] = pipe
-    dprint(2, 'register_udp_client {}'.format(pipe.remote))
+    dprint(2, 'register_udp_client {}', pipe.remote)
 
 def unregister_udp_client(owner):
     if owner in socks.udp_pipes:
         pipe = socks.udp_pipes.pop(owner)
         socks.udp_addrs.pop(pipe.remote,None)
-        dprint(2, 'unregister_udp_client {}'.format(pipe.remote))
+        socks.udp_formats.pop(pipe.remote,None)
+        dprint(2, 'unregister_udp_client {}', pipe.remote)
 
 def send_udp_client(**args):
     mesg = json.dumps(args)
     for pipe in socks.udp_pipes.values():
         pipe.sendmsg(mesg)
-        dprint(3, 'send_udp_client: {} to {}'.format(mesg,pipe.remote))
+        dprint(3, 'send_udp_client: {} to {}', mesg,pipe.remote)
+
+def send_udp_frame(**args):
+    mesg = None
+    bmsg = None
+    for pipe in socks.udp_pipes.values():
+        if socks.udp_formats.get(pipe.remote) == 'binary':
+            if bmsg is None:
+                bmsg = AnchorMsg.encode(**args)
+            pipe.sendraw(bmsg)
+            dprint(3, 'send_udp_frame: {} bytes to {}', len(bmsg),pipe.remote)
+        else:
+            if mesg is None:
+                mesg = json.dumps(dict(args, Frame=args['Frame'].hex()))
+            pipe.sendmsg(mesg)
+            dprint(3, 'send_udp_frame: {} to {}', mesg,pipe.remote)
+
+def set_udp_format(owner, form, version):
+    pipe = socks.udp_pipes.get(owner, owner)
+    if pipe.remote in socks.udp_addrs:
+        if form == 'binary' and version == AnchorMsg.VERSION:
+            socks.udp_formats[pipe.remote] = 'binary'
+        else:
+            socks.udp_formats[pipe.remote] = 'json'
+        dprint(2, 'set_udp_format {} {}', pipe.remote, socks.udp_formats[pipe.remote])
 
 def recv_udp_client(pipe):
     try:
-        pipe.fillbuf()
-        while pipe.hasmsg():
-            (data,addr) = pipe.getmsgfrom()
-            if addr in socks.udp_addrs:
-                mesg = json.loads(data)
-                recv_client_msg(socks.udp_addrs[addr], mesg)
+        (data,addr) = pipe.recvraw()
+        if addr in socks.udp_addrs:
+            if AnchorMsg.is_binary(data):
+                mesg = AnchorMsg.decode(data)
+            else:
+                mesg = json.loads(data.decode())
+            recv_client_msg(socks.udp_addrs[addr], mesg)
     except ConnectionError as err:
         errhandler('recv_udp_client: Unable to receive', err)
 
@@ -112,7 +144,7 @@ def unregister_tcp_client(pipe):
 
 def send_tcp_client(pipe, **args):
     mesg = json.dumps(args)
-    dprint(2, 'send_tcp_client: {}'.format(mesg))
+    dprint(2, 'send_tcp_client: {}', mesg)
     try:
         pipe.sendmsg(mesg)
     except ConnectionError:
@@ -130,7 +162,7 @@ def recv_tcp_client(pipe):
 
 
 def recv_client_msg(pipe, mesg):
-    dprint(3, 'recv_client_msg: {}'.format(mesg))
+    dprint(3, 'recv_client_msg: {}', mesg)
     Type = mesg.get('Type')
     if Type == 'FRAME':
         Data = mesg.get('Data')
@@ -138,8 +170,13 @@ def recv_client_msg(pipe, mesg):
         transmit_wpan_frame(data)
     elif Type == 'BEACON':
         bid = mesg.get('Beacon')
-        sub = mesg.get('SubType')
-        transmit_wpan_beacon(bid, sub)
+        sub = mesg.get('SubType', 0)
+        flags = mesg.get('Flags', 0)
+        dst = mesg.get('Dst', 0xffff)
+        transmit_wpan_beacon(bid, sub, flags, dst)
+    elif Type == 'SCHEDULE':
+        beacons = mesg.get('Beacons')
+        schedule_wpan_beacons(beacons)
     elif Type == 'REGISTER':
         tag = mesg.get('Tag')
         register_tag(tag)
@@ -153,6 +190,10 @@ def recv_client_msg(pipe, mesg):
     elif Type == 'NOUDP':
         if isinstance(pipe,TCPTailPipe):
             unregister_udp_client(pipe)
+    elif Type == 'FORMAT':
+        form = mesg.get('Format')
+        vers = mesg.get('Version')
+        set_udp_format(pipe, form, vers)
     elif Type == 'RPC':
         if isinstance(pipe,TCPTailPipe):
             recv_client_rpc(pipe,mesg)
@@ -183,22 +224,41 @@ def recv_client_rpc(pipe, mesg):
 def transmit_wpan_frame(frame):
     socks.rsock.send(frame)
 
-def transmit_wpan_beacon(ref, sub=0, flags=0):
-    frame = TailFrame()
-    frame.set_src_addr(cfg.if_addr)
-    frame.set_dst_addr(0xffff)
-    frame.tail_protocol = 1
-    frame.tail_frmtype = 1
-    frame.tail_subtype = sub
-    frame.tail_flags = flags
-    frame.tail_beacon = bytes.fromhex(ref)
-    socks.rsock.send(frame.encode())
+def transmit_wpan_beacon(ref, sub=0, flags=0, dst=0xffff):
+    beacon = cfg.beacons.get((sub,dst))
+    if beacon is None:
+        beacon = cfg.beacons[(sub,dst)] = BeaconTemplate(cfg.if_addr, dst, sub)
+    socks.rsock.send(beacon.encode(ref, flags))
+
+def schedule_wpan_beacons(beacons):
+    ## Delays are relative to now; the sequence runs from socket_loop
+    now = time.monotonic()
+    for beacon in beacons:
+        heapq.heappush(socks.schedule, (now + beacon.get('Delay', 0.0), next(socks.schedule_seqn), beacon))
+
+def schedule_timeout():
+    ## Whole milliseconds rounded down, so that poll returns before the spin interval
+    if socks.schedule:
+        return max(0, int((socks.schedule[0][0] - time.monotonic() - cfg.schedule_spin) * 1000))
+    return 100
+
+def transmit_scheduled():
+    ## socket_loop keeps polling until the next beacon is within
+    ## cfg.schedule_spin; only that last interval is spun, without sleeping
+    while socks.schedule:
+        (when,_,beacon) = socks.schedule[0]
+        if when - time.monotonic() > cfg.schedule_spin:
+            break
+        while time.monotonic() < when:
+            pass
+        heapq.heappop(socks.schedule)
+        transmit_wpan_beacon(beacon['Beacon'], beacon.get('SubType', 0), beacon.get('Flags', 0), beacon.get('Dst', 0xffff))
 
 
 def recv_blink():
     (data,ancl,_,_) = socks.rsock.recvmsg(4096, 1024, 0)
     frame = TailFrame(data,ancl)
-    dprint(4, 'recv_blink: {}'.format(frame))
+    dprint(4, 'recv_blink: {}', frame)
     if frame.tail_protocol == 1:
         anc = cfg.if_eui64
         src = frame.get_src_eui()
@@ -210,7 +270,7 @@ def recv_blink():
             tms = { 'swts': None, 'hwts': None, 'hires': None }
             eprint('RX frame timestamp missing anchor:{} ancl:{} frame:{}'.format(anc,ancl,frame))
         tsi = dict(frame.timestamp.tsinfo)
-        send_udp_client(Type='RX', Anchor=anc, Src=src, Times=tms, TSInfo=tsi, Frame=data.hex())
+        send_udp_frame(Type='RX', Anchor=anc, Src=src, Times=tms, TSInfo=tsi, Frame=data)
         if frame.tail_frmtype == 0:
             if src in cfg.tags:
                 transmit_wpan_beacon(src)
@@ -219,7 +279,7 @@ def recv_blink():
 def recv_times():
     (data,ancl,_,_) = socks.rsock.recvmsg(4096, 1024, socket.MSG_ERRQUEUE)
     frame = TailFrame(data,ancl)
-    dprint(4, 'recv_times: {}'.format(frame))
+    dprint(4, 'recv_times: {}', frame)
     if frame.tail_protocol == 1:
         anc = cfg.if_eui64
         if frame.timestamp is not None:
@@ -230,7 +290,7 @@ def recv_times():
             tms = { 'swts': None, 'hwts': None, 'hires': None }
             eprint('TX frame timestamp missing anchor:{} ancl:{} frame:{}'.format(anc,ancl,frame))
         tsi = dict(frame.timestamp.tsinfo)
-        send_udp_client(Type='TX', Anchor=anc, Src=anc, Times=tms, TSInfo=tsi, Frame=data.hex())
+        send_udp_frame(Type='TX', Anchor=anc, Src=anc, Times=tms, TSInfo=tsi, Frame=data)
 
 
 def socket_loop():
@@ -262,7 +322,7 @@ def socket_loop():
         register_udp_client(socks.upipe, cfg.server_host, cfg.server_port)
 
     while True:
-        for (fd,flags) in socks.poll.poll(100):
+        for (fd,flags) in socks.poll.poll(schedule_timeout()):
             try:
                 if fd == rfd:
                     if flags & select.POLLIN:
@@ -285,6 +345,11 @@ def socket_loop():
 
             except Exception as err:
                 eprint('{}: {}'.format(err.__class__.__name__, err))
+
+        try:
+            transmit_scheduled()
+        except Exception as err:
+            eprint('{}: {}'.format(err.__class__.__name__, err))
     
 
 
@@ -305,6 +370,8 @@ def main():
     parser.add_argument('--rate', type=int, default=None)
     parser.add_argument('--txpsr', type=int, default=None)
     parser.add_argument('--power', type=str, default=None)
+    parser.add_argument('--trace-ring', type=int, default=None, help='trace ring buffer size')
+    parser.add_argument('--trace-level', type=int, default=None, help='trace ring buffer level')
     
     args = parser.parse_args()
 
@@ -352,14 +419,24 @@ def main():
         cfg.dw1000_power = args.power
     if args.rate:
         cfg.dw1000_rate = args.rate
+    if args.trace_ring is not None:
+        cfg.trace_ring = args.trace_ring
+    if args.trace_level is not None:
+        cfg.trace_level = args.trace_level
+
+    Trace.config(cfg.debug, cfg.trace_ring, cfg.trace_level)
+
+    if cfg.trace_ring:
+        signal.signal(signal.SIGUSR1, lambda signum,frame: Trace.dump())
     
     cfg.if_addr  = GetDTAttrRaw('decawave,eui64')
     cfg.if_eui64 = cfg.if_addr.hex()
     WPANFrame.set_ifaddr(cfg.if_addr)
 
     cfg.tags = {}
+    cfg.beacons = {}
 
-    dprint(1, 'Tail Anchor <{}> daemon starting...'.format(cfg.if_eui64))
+    dprint(1, 'Tail Anchor <{}> daemon starting...', cfg.if_eui64)
 
     try:
         SetDWAttr('channel', cfg.dw1000_channel)
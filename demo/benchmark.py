@@ -0,0 +1,511 @@
+#!/usr/bin/python3
+#
+# Micro-benchmarks for the Tail server components
+#
+
+import sys
+import time
+import json
+import random
+import argparse
+import threading
+
+import numpy as np
+
+import tail
+import rtlsd
+import tdoa
+
+
+def report(name, count, secs):
+    print('{:<32s} {:>9d} ops {:>9.3f} s {:>12.0f} ops/s {:>9.3f} us/op'.format(name, count, secs, count/secs, secs*1E6/count))
+
+
+##
+## Timer
+##
+
+def bench_timer(args):
+
+    timer = rtlsd.Timer()
+    done  = threading.Event()
+    late  = []
+
+    def expire(tout):
+        late.append(time.time() - tout.expiry)
+        if len(late) == args.count:
+            done.set()
+
+    touts = [ rtlsd.Timeout(timer, 0, None, None) for i in range(args.count) ]
+    for tout in touts:
+        tout.func = expire
+        tout.args = (tout,)
+
+    start = time.perf_counter()
+    for tout in touts:
+        tout.arm(random.uniform(0, args.spread))
+    report('timer arm', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    done.wait()
+    report('timer expire', args.count, time.perf_counter() - start)
+
+    late.sort()
+    print('{:<32s} avg:{:.3f}ms p50:{:.3f}ms p99:{:.3f}ms max:{:.3f}ms'.format('timer lateness',
+        1E3*sum(late)/len(late), 1E3*late[len(late)//2], 1E3*late[len(late)*99//100], 1E3*late[-1]))
+
+    start = time.perf_counter()
+    for tout in touts:
+        tout.arm(args.spread + 10)
+    for tout in touts:
+        tout.unarm()
+    report('timer arm+unarm', args.count, time.perf_counter() - start)
+
+    timer.stop()
+
+
+##
+## TDOA solvers
+##
+
+def tdoa_problems(args, dim):
+    rng = np.random.default_rng(args.seed)
+    refs = []
+    coords = []
+    ranges = []
+    sigmas = []
+    truths = []
+    for k in range(args.count):
+        A = rng.uniform(0, args.size, (args.anchors+1,3))
+        T = rng.uniform(0, args.size, 3)
+        A[:,2] = rng.uniform(-1.0, 0.0, args.anchors+1)
+        T[2] = -1.5
+        D = tdoa.dist(A[1:],T) - tdoa.dist(A[0],T) + rng.normal(0, 0.02, args.anchors)
+        refs.append(A[0,0:dim])
+        coords.append(A[1:,0:dim])
+        ranges.append(D)
+        sigmas.append(np.full(args.anchors, 0.1))
+        truths.append(T)
+    return refs,coords,ranges,sigmas,truths
+
+def bench_tdoa(args):
+
+    solvers = (
+        ('hyperlater2D',  2, tdoa.hyperlater2D,  tdoa.hyperlater2D_batch,  {}),
+        ('hyperlater3D',  3, tdoa.hyperlater3D,  tdoa.hyperlater3D_batch,  {}),
+        ('hyperlater3Dp', 3, tdoa.hyperlater3Dp, tdoa.hyperlater3Dp_batch, { 'z_est':-1.5 }),
+    )
+
+    for (name,dim,scalar,batch,kwargs) in solvers:
+        (refs,coords,ranges,sigmas,truths) = tdoa_problems(args, dim)
+
+        start = time.perf_counter()
+        for k in range(args.count):
+            scalar(refs[k], coords[k], ranges[k], sigmas[k], delta=0.01, **kwargs)
+        secs = time.perf_counter() - start
+        report(name, args.count, secs)
+
+        start = time.perf_counter()
+        for k in range(0, args.count, args.batch):
+            (B,R,S,M) = tdoa.hyperpack(coords[k:k+args.batch], ranges[k:k+args.batch], sigmas[k:k+args.batch], dim)
+            batch(refs[k:k+args.batch], B, R, S, M, delta=0.01, **kwargs)
+        bsecs = time.perf_counter() - start
+        report(name + '_batch', args.count, bsecs)
+        print('{:<32s} {:.1f}x'.format(name + ' speedup', secs/bsecs))
+
+def bench_solver(args):
+
+    solver = tdoa.HyperSolver(args.anchors)
+    solvers = (
+        ('hyperlater2D',  2, tdoa.hyperlater2D,  solver.hyperlater2D,  {}),
+        ('hyperlater3D',  3, tdoa.hyperlater3D,  solver.hyperlater3D,  {}),
+        ('hyperlater3Dp', 3, tdoa.hyperlater3Dp, solver.hyperlater3Dp, { 'z_est':-1.5 }),
+    )
+
+    for (name,dim,func,method,kwargs) in solvers:
+        (refs,coords,ranges,sigmas,truths) = tdoa_problems(args, dim)
+
+        start = time.perf_counter()
+        for k in range(args.count):
+            func(refs[k], coords[k], ranges[k], sigmas[k], delta=0.01, **kwargs)
+        secs = time.perf_counter() - start
+        report(name, args.count, secs)
+
+        start = time.perf_counter()
+        for k in range(args.count):
+            method(refs[k], coords[k], ranges[k], sigmas[k], delta=0.01, **kwargs)
+        wsecs = time.perf_counter() - start
+        report('HyperSolver.' + name, args.count, wsecs)
+        print('{:<32s} {:.1f}x'.format(name + ' speedup', secs/wsecs))
+
+    (refs,coords,ranges,sigmas,truths) = tdoa_problems(args, 3)
+    B0 = np.array(refs[0])
+    B = np.array(coords[0])
+    R = np.array(ranges[0])
+    S = np.array(sigmas[0])
+    X = tdoa.hypercone(B0,B,R)
+    solver.hyperlater3D(B0, B, R, S)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        tdoa.hyperjump3D(B0,X,B,R,S,0.045)
+    secs = time.perf_counter() - start
+    report('hyperjump3D', args.count, secs)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        solver.jump3D(B0,X,B,S,0.045)
+    wsecs = time.perf_counter() - start
+    report('HyperSolver.jump3D', args.count, wsecs)
+    print('{:<32s} {:.1f}x'.format('jump3D speedup', secs/wsecs))
+
+    ## Cold (hypercone) vs. warm start from a point args.move away from the truth
+    rng = np.random.default_rng(args.seed)
+    inits = [ T + rng.normal(0, args.move, 3) for T in truths ]
+    for (name,warm) in (('cold',False), ('warm',True)):
+        iters = 0
+        warms = 0
+        start = time.perf_counter()
+        for k in range(args.count):
+            solver.hyperlater3D(refs[k], coords[k], ranges[k], sigmas[k], delta=0.01, x_init=(inits[k] if warm else None))
+            iters += solver.iters
+            warms += solver.warm
+        secs = time.perf_counter() - start
+        report('HyperSolver.hyperlater3D ' + name, args.count, secs)
+        print('{:<32s} iterations:{:.2f} warm:{:.1%}'.format(name + ' start', iters/args.count, warms/args.count))
+
+
+##
+## TDOA measurement assembly
+##
+
+def bench_measure(args):
+
+    rng = np.random.default_rng(args.seed)
+    server = rtlsd.Server('::', 0)
+    tinfo = { key:0 for key in tail.AnchorMsg.TSKEYS }
+    tinfo['lqi'] = 1
+    for k in range(args.anchors):
+        coord = (rng.uniform(0,args.size), rng.uniform(0,args.size), rng.uniform(-1,0))
+        server.add_anchor(dict(name='A{}'.format(k), eui='70b3d5b1e0{:06x}'.format(k), host='::ffff:127.0.0.1', port=9, coord=coord, ref=True))
+    server.add_tag(dict(eui='70b3d5b1e1000001', name='T1'))
+    tag = server.get_tag('70b3d5b1e1000001')
+    tag.beacon = server.geometry.anchors[0]
+
+    ## Fill the anchors nearest to the beacon except a few, with plausible tag/beacon timestamps
+    heard = args.heard or args.anchors
+    nearest = sorted(server.geometry.anchors, key=lambda anchor: tdoa.dist(anchor.coord, tag.beacon.coord))
+    T = np.array((0, 2, 4))*1E-3 * tdoa.DW1000_CLOCK_HZ
+    for anchor in nearest[:heard - args.missing]:
+        for sub in range(3):
+            tinfo['rawts'] = int(T[sub] + rng.uniform(0, 1000))
+            tag.blinks.add(sub, rtlsd.TRX(tag, tag, anchor, None, tinfo))
+
+    def legacy():
+        COORDS = []
+        RANGES = []
+        SIGMAS = []
+        X = [ 0, 0, 0, 0, 0, 0 ]
+        for anchor in server.geometry.anchors:
+            if anchor is not tag.beacon:
+                try:
+                    X[0] = tag.blinks.timestamp(0, anchor)
+                    X[1] = tag.blinks.timestamp(0, tag.beacon)
+                    X[2] = tag.blinks.timestamp(1, tag.beacon)
+                    X[3] = tag.blinks.timestamp(1, anchor)
+                    X[4] = tag.blinks.timestamp(2, anchor)
+                    X[5] = tag.blinks.timestamp(2, tag.beacon)
+                    C = tag.beacon.distance_to(anchor)
+                    D = C - 2*rtlsd.woodoo(X)
+                    if -rtlsd.cfg.max_ddoa < D < rtlsd.cfg.max_ddoa:
+                        COORDS.append(anchor.coord)
+                        RANGES.append(D)
+                        SIGMAS.append(0.1)
+                except (KeyError,ZeroDivisionError):
+                    pass
+        return (COORDS,RANGES,SIGMAS)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        legacy()
+    secs = time.perf_counter() - start
+    report('per-anchor measure', args.count, secs)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        tag.measure(tag.beacon, 3)
+    vsecs = time.perf_counter() - start
+    report('vectorised measure', args.count, vsecs)
+    print('{:<32s} {:.1f}x'.format('measure speedup', secs/vsecs))
+
+    server.stop()
+
+
+##
+## Anchor wire format
+##
+
+def bench_wire(args):
+
+    frame = tail.TailFrame()
+    frame.set_src_addr(bytes.fromhex('70b3d5b1e0000101'))
+    frame.set_dst_addr(0xffff)
+    frame.tail_protocol = 1
+    frame.tail_frmtype = 1
+    frame.tail_subtype = 0
+    frame.tail_flags = 0
+    frame.tail_beacon = bytes.fromhex('70b3d5b1e0000102')
+    data = frame.encode()
+
+    tsinfo = { key:random.randrange(1,1000) for key in tail.AnchorMsg.TSKEYS }
+    times = { 'swts': 1600000000123456789, 'hwts': 1600000000123456000, 'hires': 1600000000123456000 << 32 }
+    msg = dict(Type='RX', Anchor='70b3d5b1e0000001', Src='70b3d5b1e0000101', Times=times, TSInfo=tsinfo, Frame=data)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        jmsg = json.dumps(dict(msg, Frame=msg['Frame'].hex())).encode()
+    report('json encode', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        dmsg = json.loads(jmsg.decode())
+        dmsg['Frame'] = bytes.fromhex(dmsg['Frame'])
+    report('json decode', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        bmsg = tail.AnchorMsg.encode(**msg)
+    report('binary encode', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        dmsg = tail.AnchorMsg.decode(bmsg)
+    report('binary decode', args.count, time.perf_counter() - start)
+
+    print('{:<32s} json:{} bytes binary:{} bytes'.format('message size', len(jmsg), len(bmsg)))
+
+
+##
+## Beacon commands
+##
+
+def bench_beacon(args):
+
+    src = '70b3d5b1e0000001'
+    ref = '70b3d5b1e0000101'
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        frame = tail.TailFrame()
+        frame.set_src_addr(src)
+        frame.set_dst_addr(0xffff)
+        frame.tail_protocol = 1
+        frame.tail_frmtype = 1
+        frame.tail_subtype = 0
+        frame.tail_flags = 0
+        frame.tail_beacon = bytes.fromhex(ref)
+        jmsg = json.dumps(dict(Type='FRAME', Data=frame.encode().hex())).encode()
+    report('frame encode, json', args.count, time.perf_counter() - start)
+
+    beacon = tail.BeaconTemplate(src)
+    start = time.perf_counter()
+    for k in range(args.count):
+        jmsg = json.dumps(dict(Type='FRAME', Data=beacon.encode(ref).hex())).encode()
+    report('template, json', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        bmsg = tail.AnchorMsg.encode_beacon(ref)
+    report('binary command', args.count, time.perf_counter() - start)
+
+    print('{:<32s} json:{} bytes binary:{} bytes'.format('command size', len(jmsg), len(bmsg)))
+
+
+##
+## Frame decoding
+##
+
+def bench_frame(args):
+
+    frame = tail.TailFrame()
+    frame.set_src_addr(bytes.fromhex('70b3d5b1e0000101'))
+    frame.set_dst_addr(0xffff)
+    frame.tail_protocol = 1
+    frame.tail_frmtype = 15
+    frame.tail_timing = True
+    frame.tail_txtime = 123456789
+    frame.tail_rxtimes = { bytes.fromhex('70b3d5b1e00000{:02x}'.format(k)):k for k in range(args.anchors) }
+    frame.tail_rxinfos = { addr:(k,k,k,k) for (k,addr) in enumerate(frame.tail_rxtimes) }
+    data = frame.encode()
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        frame = tail.TailFrame(data)
+        frame.tail_rxtimes
+    report('decode, all fields', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        frame = tail.TailFrame(data)
+    report('decode, header fields', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        tail.TailFrame.peek(data)
+    report('peek', args.count, time.perf_counter() - start)
+
+    print('{:<32s} {} bytes, {} rx entries'.format('frame size', len(data), args.anchors))
+
+
+##
+## Pipe framing
+##
+
+class BlobSocket():
+
+    ## Stands in for a socket whose receive queue holds one burst
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.ptr = 0
+
+    def setsockopt(self, *args):
+        pass
+
+    def recv_into(self, view):
+        size = min(len(view), len(self.data) - self.ptr)
+        view[:size] = self.data[self.ptr:self.ptr+size]
+        self.ptr += size
+        return size
+
+
+def bench_pipe(args):
+
+    msg = json.dumps(dict(Type='TAG', Tag='70b3d5b1e1000000', Coord=[1.0,2.0,3.0]))
+    blob = (msg.encode() + b'\x1f') * args.messages
+
+    def legacy(data):
+        buff = b''
+        buff += data
+        msgs = []
+        while True:
+            while len(buff) > 0 and buff[0] == 31:
+                buff = buff[1:]
+            eom = buff.find(31)
+            if eom <= 0:
+                break
+            msgs.append(buff[0:eom].decode())
+            buff = buff[eom+1:]
+        return msgs
+
+    start = time.perf_counter()
+    msgs = legacy(blob)
+    report('legacy bytes reslicing', len(msgs), time.perf_counter() - start)
+
+    pipe = tail.TCPTailPipe(BlobSocket(blob))
+    fills = 0
+    start = time.perf_counter()
+    while len(pipe.msgs) < args.messages:
+        pipe.fillbuf()
+        fills += 1
+    msgs = pipe.getmsgs()
+    report('bytearray recv_into', len(msgs), time.perf_counter() - start)
+
+    print('{:<32s} {} messages, {} bytes, {} fills'.format('burst', len(msgs), len(blob), fills))
+
+
+##
+## Debug tracing
+##
+
+def bench_trace(args):
+
+    tinfo = { 'rxpacc':1024, 'cir_pwr':5000, 'fp_ampl1':8000, 'fp_ampl2':7000, 'fp_ampl3':6000 }
+
+    def eager(level, *args):
+        if tail.Trace.level >= level:
+            print(*args, file=sys.stderr)
+
+    tail.Trace.config(0, 0)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        eager(4, 'Tag::add_blink:   ANC:{} Rx:{:.1f}dBm'.format('70b3d5b1e0000001', rtlsd.TRX.calc_rx_level(tinfo)))
+    report('eager format, disabled', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        tail.dprint(4, 'Tag::add_blink:   ANC:{} Rx:{:.1f}dBm', '70b3d5b1e0000001', tail.Lazy(rtlsd.TRX.calc_rx_level, tinfo))
+    report('lazy dprint, disabled', args.count, time.perf_counter() - start)
+
+    tail.Trace.config(0, args.ring, 4)
+
+    start = time.perf_counter()
+    for k in range(args.count):
+        tail.dprint(4, 'Tag::add_blink:   ANC:{} Rx:{:.1f}dBm', '70b3d5b1e0000001', tail.Lazy(rtlsd.TRX.calc_rx_level, tinfo))
+    report('lazy dprint, ring buffer', args.count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    lines = tail.Trace.lines()
+    report('ring buffer dump', len(lines), time.perf_counter() - start)
+
+    tail.Trace.config(0, 0)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Tail server benchmarks")
+    parser.add_argument('-n', '--count', type=int, default=100000)
+
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    bench = subparsers.add_parser('timer', help='arm and expire timeouts')
+    bench.add_argument('-s', '--spread', type=float, default=1.0)
+    bench.set_defaults(func=bench_timer)
+
+    bench = subparsers.add_parser('tdoa', help='scalar vs. batch TDOA solvers')
+    bench.add_argument('-a', '--anchors', type=int, default=10)
+    bench.add_argument('-b', '--batch', type=int, default=100)
+    bench.add_argument('-s', '--size', type=float, default=20.0)
+    bench.add_argument('--seed', type=int, default=1)
+    bench.set_defaults(func=bench_tdoa)
+
+    bench = subparsers.add_parser('solver', help='TDOA solvers vs. HyperSolver workspace')
+    bench.add_argument('-a', '--anchors', type=int, default=10)
+    bench.add_argument('-s', '--size', type=float, default=20.0)
+    bench.add_argument('-m', '--move', type=float, default=0.05, help='warm start offset (m)')
+    bench.add_argument('--seed', type=int, default=1)
+    bench.set_defaults(func=bench_solver)
+
+    bench = subparsers.add_parser('measure', help='per-anchor vs. vectorised TDOA measurement')
+    bench.add_argument('-a', '--anchors', type=int, default=30)
+    bench.add_argument('-m', '--missing', type=int, default=3)
+    bench.add_argument('-H', '--heard', type=int, default=None)
+    bench.add_argument('-s', '--size', type=float, default=20.0)
+    bench.add_argument('--seed', type=int, default=1)
+    bench.set_defaults(func=bench_measure)
+
+    bench = subparsers.add_parser('wire', help='JSON vs. binary anchor messages')
+    bench.set_defaults(func=bench_wire)
+
+    bench = subparsers.add_parser('beacon', help='beacon frame encode vs. template vs. binary command')
+    bench.set_defaults(func=bench_beacon)
+
+    bench = subparsers.add_parser('frame', help='full vs. lazy vs. header-only frame decoding')
+    bench.add_argument('-a', '--anchors', type=int, default=16)
+    bench.set_defaults(func=bench_frame)
+
+    bench = subparsers.add_parser('pipe', help='TCP pipe framing of a message burst')
+    bench.add_argument('-m', '--messages', type=int, default=10000)
+    bench.set_defaults(func=bench_pipe)
+
+    bench = subparsers.add_parser('trace', help='eager vs. lazy debug tracing')
+    bench.add_argument('-r', '--ring', type=int, default=10000)
+    bench.set_defaults(func=bench_trace)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__": main()
@@ -162,8 +162,14 @@ class Receiver(threading.Thread):
                     try:
                         msg = json.loads(tpipe.recvmsg())
                         if msg['Type'] == 'TAG':
-                            self.room.update_tag(msg['Tag'], msg['Name'], msg['Coord'], msg['Colour'])
-                            print('TAG:{0} {1} {2} COORD:{3[0]:.3f},{3[1]:.3f},{3[2]:.3f}'.format(msg['Name'],msg['Tag'], msg['Colour'], msg['Coord']))
+                            tags = [ msg ]
+                        elif msg['Type'] == 'TAGS':
+                            tags = msg['Tags']
+                        else:
+                            tags = []
+                        for tag in tags:
+                            self.room.update_tag(tag['Tag'], tag['Name'], tag['Coord'], tag['Colour'])
+                            print('TAG:{0} {1} {2} COORD:{3[0]:.3f},{3[1]:.3f},{3[2]:.3f}'.format(tag['Name'],tag['Tag'], tag['Colour'], tag['Coord']))
 
                     except (ValueError,KeyError,AttributeError) as err:
                         eprint('{}: {}'.format(err.__class__.__name__, err))
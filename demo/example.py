@@ -26,7 +26,13 @@ def msg_loop(host,port):
         try:
             msg = json.loads(tpipe.recvmsg())
             if msg['Type'] == 'TAG':
-                print('{0} {1} {2} ({3[0]:.3f},{3[1]:.3f},{3[2]:.3f})'.format(msg['Name'], msg['Tag'], msg['Colour'], msg['Coord']))
+                tags = [ msg ]
+            elif msg['Type'] == 'TAGS':
+                tags = msg['Tags']
+            else:
+                tags = []
+            for tag in tags:
+                print('{0} {1} {2} ({3[0]:.3f},{3[1]:.3f},{3[2]:.3f})'.format(tag['Name'], tag['Tag'], tag['Colour'], tag['Coord']))
 
         except (ValueError,KeyError,AttributeError) as err:
             eprint('{}: {}'.format(err.__class__.__name__, err))
@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+#
+# Synthetic anchor load generator for rtlsd
+#
+# Impersonates the configured anchors on loopback addresses, sends the
+# RX/TX reports anchord would send for simulated tags moving in the room,
+# obeys the server's REGISTER/FRAME/BEACON commands, and listens to the
+# server's TAG and TAGS messages to measure fix rate, drop rate and latency.
+#
+# Use --generate to write a config whose anchors live on 127.0.x.y, run
+# rtlsd with it, then run the load generator with the same config.
+#
+
+import sys
+import time
+import math
+import json
+import heapq
+import random
+import select
+import socket
+import argparse
+import itertools
+
+import numpy as np
+
+from tail import *
+from tdoa import *
+from dwarf import *
+
+from numpy import dot
+
+
+class cfg():
+
+    debug = 0
+
+    dw1000_channel  = 5
+    dw1000_prf      = 64
+    dw1000_txlevel  = -12.3
+
+    server_host     = '::ffff:127.0.0.1'
+    anchor_port     = 8913
+    server_port     = 9475
+
+    tag_rate        = 1.0
+    tag_speed       = 1.0
+    tag_z           = -1.5
+    tag_delay       = 0.020
+
+    beacon_delay    = 0.001
+    frame_delay     = 0.002
+
+    clock_ppm       = 20.0
+    max_dist        = 25.0
+    rxpacc          = 1000
+
+    duration        = 10.0
+    report_interval = 1.0
+
+    config_json     = '/etc/tail.json'
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def loopback_host(index):
+    n = index + 2
+    return '127.0.{}.{}'.format(n >> 8, n & 0xff)
+
+
+class Stats():
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.blinks = 0
+        self.fixes = 0
+        self.drops = 0
+        self.reports = 0
+        self.lag = 0.0
+        self.latency = []
+
+    def add_fix(self, latency):
+        self.fixes += 1
+        self.latency.append(latency)
+
+    def merge(self, other):
+        self.blinks += other.blinks
+        self.fixes += other.fixes
+        self.drops += other.drops
+        self.reports += other.reports
+        self.lag = max(self.lag, other.lag)
+        self.latency += other.latency
+
+    def summary(self, name):
+        secs = time.time() - self.start
+        lat = sorted(self.latency)
+        if lat:
+            lats = 'p50:{:.1f}ms p99:{:.1f}ms max:{:.1f}ms'.format(1E3*lat[len(lat)//2], 1E3*lat[len(lat)*99//100], 1E3*lat[-1])
+        else:
+            lats = 'p50:- p99:- max:-'
+        drop = 100.0 * self.drops / max(1, self.fixes + self.drops)
+        return '{}: {:.1f} fixes/s {:.1f} blinks/s {:.0f} reports/s drop:{:.1f}% latency {} lag:{:.1f}ms'.format(
+            name, self.fixes/secs, self.blinks/secs, self.reports/secs, drop, lats, 1E3*self.lag)
+
+
+class SimAnchor():
+
+    def __init__(self, gen, index, name, eui, host, port, coord, **kwargs):
+        self.gen    = gen
+        self.index  = index
+        self.name   = name
+        self.eui    = eui
+        self.coord  = np.array(coord)
+        self.host   = host
+        self.port   = port
+        self.ppm    = random.uniform(-cfg.clock_ppm, cfg.clock_ppm) * 1E-6
+        self.offset = random.uniform(0, 17.2)
+        self.format = 'json'
+        self.tags   = set()
+        self.beacons = {}
+        self.sock   = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+
+    def rawts(self, t, delay=0.0):
+        ## Wall clock time is too coarse for picoseconds: keep the propagation delay apart
+        return int(((t - self.gen.epoch + delay) * (1 + self.ppm) + self.offset) * DW1000_CLOCK_HZ) % (1 << 40)
+
+    def tsinfo(self, t, distance=None):
+        tsi = dict.fromkeys(AnchorMsg.TSKEYS, 0)
+        if distance is None:
+            tsi['rawts'] = self.rawts(t)
+        else:
+            tsi['rawts'] = self.rawts(t, distance/Cabs)
+            level = RFCalcRxPower(cfg.dw1000_channel, max(distance, 0.5), cfg.dw1000_txlevel)
+            level = min(max(level, -140.0), -78.0)
+            power = RxdBu2Power(level, cfg.dw1000_prf)
+            tsi['lqi'] = 100
+            tsi['rxpacc'] = cfg.rxpacc
+            tsi['cir_pwr'] = int(power * cfg.rxpacc * cfg.rxpacc / 131072)
+            tsi['fp_ampl1'] = tsi['fp_ampl2'] = tsi['fp_ampl3'] = int(math.sqrt(power / 3) * cfg.rxpacc)
+            tsi['noise'] = 10
+        return tsi
+
+    def report(self, Type, Src, frame, t, distance=None):
+        tns = int(t * 1E9)
+        args = dict(Type=Type, Anchor=self.eui, Src=Src, Times={ 'swts': tns, 'hwts': tns, 'hires': tns << 32 },
+                    TSInfo=self.tsinfo(t,distance), Frame=frame)
+        if self.format == 'binary':
+            data = AnchorMsg.encode(**args)
+        else:
+            data = json.dumps(dict(args, Frame=frame.hex())).encode()
+        self.sock.sendto(data, self.gen.server)
+        self.gen.stats.reports += 1
+
+    def receive(self, src, frame, t, coord):
+        distance = dist(self.coord, coord)
+        if distance < cfg.max_dist:
+            self.report('RX', src, frame, t, distance)
+            return True
+        return False
+
+    def transmit(self, frame):
+        t = time.time()
+        self.report('TX', self.eui, frame, t)
+        for anchor in self.gen.anchors:
+            if anchor is not self:
+                anchor.receive(self.eui, frame, t, self.coord)
+
+    def beacon_frame(self, ref, sub=0, dst=0xffff, flags=0):
+        beacon = self.beacons.get((sub,dst))
+        if beacon is None:
+            beacon = self.beacons[(sub,dst)] = BeaconTemplate(bytes.fromhex(self.eui), dst, sub)
+        return beacon.encode(ref, flags)
+
+    def recvmsg(self):
+        (data,addr) = self.sock.recvfrom(4096)
+        ## Like anchord, only take commands from the server's anchor port
+        if addr[1] != self.gen.server[1]:
+            dprint(1, 'SimAnchor::recvmsg {} ignored command from {}', self.name, addr)
+            return
+        if AnchorMsg.is_binary(data):
+            mesg = AnchorMsg.decode(data)
+        else:
+            mesg = json.loads(data.decode())
+        dprint(3, 'SimAnchor::recvmsg {} {}', self.name, mesg)
+        Type = mesg.get('Type')
+        if Type == 'FRAME':
+            self.gen.schedule(cfg.frame_delay, self.transmit, bytes.fromhex(mesg['Data']))
+        elif Type == 'BEACON':
+            frame = self.beacon_frame(mesg['Beacon'], mesg.get('SubType',0), mesg.get('Dst',0xffff), mesg.get('Flags',0))
+            self.gen.schedule(cfg.frame_delay, self.transmit, frame)
+        elif Type == 'SCHEDULE':
+            for beacon in mesg['Beacons']:
+                frame = self.beacon_frame(beacon['Beacon'], beacon.get('SubType',0), beacon.get('Dst',0xffff), beacon.get('Flags',0))
+                self.gen.schedule(cfg.frame_delay + beacon.get('Delay',0.0), self.transmit, frame)
+        elif Type == 'REGISTER':
+            self.tags.add(mesg['Tag'])
+        elif Type == 'REMOVE':
+            self.tags.discard(mesg['Tag'])
+        elif Type == 'FORMAT':
+            if mesg.get('Format') == 'binary' and mesg.get('Version') == AnchorMsg.VERSION:
+                self.format = 'binary'
+            else:
+                self.format = 'json'
+
+
+class SimTag():
+
+    def __init__(self, gen, eui, name, **kwargs):
+        self.gen   = gen
+        self.eui   = eui
+        self.name  = name
+        self.time  = time.time()
+        self.coord = np.array((random.uniform(*gen.room[0]), random.uniform(*gen.room[1]), cfg.tag_z))
+        self.dest  = self.coord.copy()
+        self.blink = None
+        frame = TailFrame()
+        frame.set_src_addr(bytes.fromhex(eui))
+        frame.set_dst_addr(0xffff)
+        frame.tail_protocol = 1
+        frame.tail_frmtype = 0
+        self.blink_frame = frame.encode()
+        frame.tail_frmtype = 3
+        frame.tail_owr = True
+        frame.tail_txtime = 0
+        self.ranging_frame = frame.encode()
+
+    def move(self, t):
+        step = cfg.tag_speed * (t - self.time)
+        self.time = t
+        diff = self.dest - self.coord
+        span = math.sqrt(dot(diff,diff))
+        if span <= step:
+            self.coord = self.dest
+            self.dest = np.array((random.uniform(*self.gen.room[0]), random.uniform(*self.gen.room[1]), cfg.tag_z))
+        else:
+            self.coord = self.coord + diff * (step / span)
+
+    def transmit_blink(self):
+        t = time.time()
+        self.move(t)
+        if self.blink is not None:
+            self.gen.stats.drops += 1
+        self.blink = t
+        self.gen.stats.blinks += 1
+        for anchor in self.gen.anchors:
+            if anchor.receive(self.eui, self.blink_frame, t, self.coord):
+                if self.eui in anchor.tags:
+                    anchor.tags.discard(self.eui)
+                    self.gen.schedule(cfg.beacon_delay, anchor.transmit, anchor.beacon_frame(self.eui))
+        self.gen.schedule(cfg.tag_delay, self.transmit_ranging)
+        self.gen.schedule(random.uniform(0.9, 1.1) / cfg.tag_rate, self.transmit_blink)
+
+    def transmit_ranging(self):
+        t = time.time()
+        for anchor in self.gen.anchors:
+            anchor.receive(self.eui, self.ranging_frame, t, self.coord)
+
+    def fix(self, coord):
+        if self.blink is not None:
+            self.gen.stats.add_fix(time.time() - self.blink)
+            dprint(2, 'SimTag::fix {} error:{:.3f}m', self.name, Lazy(dist, self.coord, np.array(coord)))
+            self.blink = None
+
+
+class LoadGen():
+
+    def __init__(self, config):
+        self.epoch = time.time()
+        self.events = []
+        self.seqn = itertools.count()
+        self.stats = Stats()
+        self.total = Stats()
+        self.server = (cfg.server_host, cfg.anchor_port)
+        coords = np.array([ anchor['coord'] for anchor in config['ANCHORS'] ])
+        self.room = ((coords[:,0].min(), coords[:,0].max()), (coords[:,1].min(), coords[:,1].max()))
+        self.anchors = [ SimAnchor(self, index, **args) for (index,args) in enumerate(config['ANCHORS']) ]
+        self.tags = { args['eui']:SimTag(self, **args) for args in config['TAGS'] }
+        self.poll = select.poll()
+        self.socks = {}
+        for anchor in self.anchors:
+            self.poll.register(anchor.sock, select.POLLIN)
+            self.socks[anchor.sock.fileno()] = anchor
+        self.pipe = TCPTailPipe()
+        self.pipe.connect(cfg.server_host, cfg.server_port)
+        self.poll.register(self.pipe.sock, select.POLLIN)
+
+    def schedule(self, delay, func, *args):
+        heapq.heappush(self.events, (time.time() + delay, next(self.seqn), func, args))
+
+    def recv_client(self):
+        self.pipe.fillbuf()
+        while self.pipe.hasmsg():
+            mesg = json.loads(self.pipe.getmsg())
+            if mesg.get('Type') == 'TAG':
+                tags = [ mesg ]
+            elif mesg.get('Type') == 'TAGS':
+                tags = mesg['Tags']
+            else:
+                tags = []
+            for tag in tags:
+                if tag['Tag'] in self.tags:
+                    self.tags[tag['Tag']].fix(tag['Coord'])
+
+    def run(self, duration):
+        for tag in self.tags.values():
+            self.schedule(random.uniform(0, 1/cfg.tag_rate), tag.transmit_blink)
+        start = time.time()
+        report = start + cfg.report_interval
+        while True:
+            now = time.time()
+            if now - start > duration:
+                break
+            if now > report:
+                print(self.stats.summary('{:6.1f}s'.format(now - start)), flush=True)
+                self.total.merge(self.stats)
+                self.stats.reset()
+                report += cfg.report_interval
+            timeout = min(report, self.events[0][0] if self.events else report) - now
+            for (fd,flags) in self.poll.poll(max(0, math.ceil(timeout * 1000))):
+                if fd in self.socks:
+                    self.socks[fd].recvmsg()
+                elif fd == self.pipe.fileno():
+                    self.recv_client()
+            now = time.time()
+            while self.events and self.events[0][0] <= now:
+                (due,_,func,args) = heapq.heappop(self.events)
+                self.stats.lag = max(self.stats.lag, now - due)
+                func(*args)
+        self.total.merge(self.stats)
+        print(self.total.summary('total'))
+
+
+def generate(config, filename, tags, tiles, algo):
+    anchors = []
+    width = max(a['coord'][0] for a in config['ANCHORS']) - min(a['coord'][0] for a in config['ANCHORS']) + 2.0
+    height = max(a['coord'][1] for a in config['ANCHORS']) - min(a['coord'][1] for a in config['ANCHORS']) + 2.0
+    cols = math.ceil(math.sqrt(tiles))
+    for tile in range(tiles):
+        (dx,dy) = ((tile % cols) * width, (tile // cols) * height)
+        for args in config['ANCHORS']:
+            index = len(anchors)
+            anchor = dict(args)
+            anchor['host'] = '::ffff:' + loopback_host(index)
+            anchor['coord'] = [ args['coord'][0] + dx, args['coord'][1] + dy, args['coord'][2] ]
+            if tile > 0:
+                anchor['name'] = '{}.{}'.format(args['name'], tile)
+                anchor['eui'] = '{:016x}'.format(int(args['eui'],16) + (tile << 16))
+            anchors.append(anchor)
+    config['ANCHORS'] = anchors
+    if tags is not None:
+        config['TAGS'] = [ { 'eui':'70b3d5b1e1{:06x}'.format(i), 'name':'L{}'.format(i), 'algo':algo } for i in range(tags) ]
+    config.get('RTLSD',{}).pop('force_beacon', None)
+    config.get('RTLSD',{}).pop('force_common', None)
+    with open(filename, 'w') as f:
+        json.dump(config, f, indent=4)
+    print('Wrote {}: {} anchors, {} tags'.format(filename, len(config['ANCHORS']), len(config['TAGS'])))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Tail anchor load generator")
+
+    parser.add_argument('-D', '--debug', action='count', default=0)
+    parser.add_argument('-c', '--config', type=str, default=None)
+    parser.add_argument('-s', '--server', type=str, default=None)
+    parser.add_argument('-t', '--time', type=float, default=None)
+    parser.add_argument('-r', '--rate', type=float, default=None, help='blinks/s per tag')
+    parser.add_argument('--speed', type=float, default=None, help='tag speed m/s')
+    parser.add_argument('-n', '--tags', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--generate', type=str, default=None, help='write a loopback config and exit')
+    parser.add_argument('--tiles', type=int, default=1, help='repeat the anchor layout for --generate')
+    parser.add_argument('--algo', type=str, default='wls', help='tag algorithm for --generate')
+
+    args = parser.parse_args()
+
+    if args.config:
+        cfg.config_json = args.config
+
+    with open(cfg.config_json, 'r') as f:
+        config = json.load(f)
+
+    if args.generate:
+        generate(config, args.generate, args.tags, args.tiles, args.algo)
+        return
+
+    for (key,value) in config.get('RTLSD',{}).items():
+        if key in ('anchor_port','server_port','max_dist'):
+            setattr(cfg,key,value)
+    for (key,value) in config.get('DW1000',{}).items():
+        if hasattr(cfg,key):
+            setattr(cfg,key,value)
+
+    cfg.debug = args.debug
+
+    Trace.config(cfg.debug)
+    if args.server:
+        cfg.server_host = args.server
+    if args.time:
+        cfg.duration = args.time
+    if args.rate:
+        cfg.tag_rate = args.rate
+    if args.speed is not None:
+        cfg.tag_speed = args.speed
+    if args.tags is not None:
+        config['TAGS'] = config['TAGS'][:args.tags]
+
+    random.seed(args.seed)
+
+    gen = LoadGen(config)
+
+    try:
+        gen.run(cfg.duration)
+
+    except KeyboardInterrupt:
+        gen.total.merge(gen.stats)
+        print(gen.total.summary('total'))
+
+
+if __name__ == "__main__": main()
@@ -7,11 +7,20 @@ import os
 import sys
 import time
 import sched
+import struct
+import math
+import heapq
 import random
+import itertools
+import collections
 import threading
+import multiprocessing
 import json
+import zlib
 import socket
 import select
+import signal
+import asyncio
 import logging
 import argparse
 import traceback
@@ -30,6 +39,9 @@ class cfg():
 
     debug = 0
 
+    trace_ring      = 0
+    trace_level     = 4
+
     dw1000_profile  = None
     dw1000_channel  = 5
     dw1000_pcode    = 12
@@ -43,6 +55,9 @@ class cfg():
     anchor_addr     = '::'
     anchor_port     = 8913
 
+    anchor_format       = 'binary'
+    anchor_format_retry = 10.0
+
     server_addr     = '::'
     server_port     = 9475
   
@@ -55,17 +70,29 @@ class cfg():
     anchor_response_timer = 0.010
     anchor_ranging_timer  = 0.010
     anchor_timeout_timer  = 0.050
+    anchor_schedule       = False
 
     default_algo    = 'wls'
     force_algo      = None
+
+    laterate_batch       = True
+    laterate_batch_timer = 0.010
+
+    warm_start      = False
+    warm_residual   = 0.1
    
     tag_z_estimate  = -2.50
 
     max_dist        = 25.0
     max_ddoa        = 25.0
 
+    anchor_range    = 50.0
+    anchor_grid     = 10.0
+
     min_change      = 0.01
     max_change      = 5.00
+
+    publish_interval = 0.0
     
     coord_filter_len  = 1
     cqual_filter_len  = 10
@@ -78,6 +105,24 @@ class cfg():
     random_common   = False
 
     sleep_min       = 0.0005
+    timer_compact   = 1024
+
+    frame_cache      = 256
+    frame_cache_time = 0.5
+
+    stats_interval  = 0
+
+    event_loop      = 'poll'
+
+    workers         = 0
+    shard_ring      = 0
+
+    client_queue_len = 1024
+    client_overflow  = 'drop'
+
+    capture_file    = None
+    replay_file     = None
+    replay_speed    = 1.0
 
     config_json     = '/etc/tail.json'
 
@@ -85,16 +130,77 @@ class cfg():
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-def dprint(level, *args, **kwargs):
-    if cfg.debug >= level:
-        print(*args, file=sys.stderr, flush=True, **kwargs)
-
 def errhandler(msg,err):
     eprint('\n*** EXCEPTION {}:\n{}***\n'.format(msg,traceback.format_exc()))
 
 
+class Clock():
+
+    ##
+    ## Server time source. Normally the wall clock; during capture replay
+    ## a virtual clock moved forward by the replay loop.
+    ##
+
+    def __init__(self):
+        self.virtual = False
+        self.now = 0.0
+
+    def time(self):
+        if self.virtual:
+            return self.now
+        return time.time()
+
+    def set(self, now):
+        self.virtual = True
+        self.now = max(self.now, now)
+
+clock = Clock()
+
+
+class Capture():
+
+    ##
+    ## Anchor traffic capture file: a magic header followed by records of
+    ## [time:d port:H hostlen:B datalen:H] host data
+    ##
+
+    MAGIC  = b'TAILCAP1'
+    RECORD = struct.Struct('<dHBH')
+
+    def __init__(self, filename, mode='rb'):
+        self.file = open(filename, mode)
+        if 'w' in mode:
+            self.file.write(Capture.MAGIC)
+        elif self.file.read(len(Capture.MAGIC)) != Capture.MAGIC:
+            raise ValueError('{} is not a capture file'.format(filename))
+
+    def close(self):
+        self.file.close()
+
+    def write(self, now, addr, data):
+        host = addr[0].encode()
+        self.file.write(Capture.RECORD.pack(now, addr[1], len(host), len(data)) + host + data)
+
+    def read(self):
+        head = self.file.read(Capture.RECORD.size)
+        if len(head) < Capture.RECORD.size:
+            return None
+        (now,port,hlen,dlen) = Capture.RECORD.unpack(head)
+        host = self.file.read(hlen).decode()
+        data = self.file.read(dlen)
+        if len(data) < dlen:
+            return None
+        return (now, (host,port,0,0), data)
+
+    def peek(self):
+        pos = self.file.tell()
+        rec = self.read()
+        self.file.seek(pos)
+        return rec
+
+
 def woodoo(T):
-    dprint(4, 'woodoo: {}'.format(T))
+    dprint(4, 'woodoo: {}', T)
     T41 = T[3] - T[0]
     T32 = T[2] - T[1]
     T54 = T[4] - T[3]
@@ -103,9 +209,22 @@ def woodoo(T):
     T62 = T[5] - T[1]
     ToF = (T41*T63 - T32*T54) / (T51+T62)
     DoF = (ToF / DW1000_CLOCK_HZ) * Cabs
-    dprint(4, 'woodoo: {}'.format(DoF))
+    dprint(4, 'woodoo: {}', DoF)
     return DoF
 
+def woodoo_batch(T0,T1,T2,T3,T4,T5):
+    ## Vector form of woodoo over int64 timestamp arrays; ok is False where the
+    ## denominator is zero. Differences are exact in int64 before going to float.
+    T41 = (T3 - T0).astype(float)
+    T32 = (T2 - T1).astype(float)
+    T54 = (T4 - T3).astype(float)
+    T63 = (T5 - T2).astype(float)
+    DEN = (T4 - T0) + (T5 - T1)
+    ok = (DEN != 0)
+    ToF = (T41*T63 - T32*T54) / np.where(ok, DEN, 1)
+    DoF = (ToF / DW1000_CLOCK_HZ) * Cabs
+    return (DoF,ok)
+
 
 class Timeout():
 
@@ -115,6 +234,7 @@ class Timeout():
         self.delay   = delay
         self.func    = func
         self.args    = args
+        self.entry   = None
         self.armed   = False
         self.expired = False
 
@@ -133,7 +253,7 @@ class Timeout():
                 delay = self.delay
             self.armed   = True
             self.expired = False
-            self.expiry  = time.time() + delay
+            self.expiry  = clock.time() + delay
             self.timer.arm(self)
 
     def unarm(self):
@@ -145,37 +265,68 @@ class Timeout():
 
 
 class Timer(threading.Thread):
-    
-    def __init__(self):
+
+    ##
+    ## Timeouts are kept in a binary heap of [expiry,seqn,timeout] entries.
+    ## The entry is the stable handle of an armed Timeout: unarming only
+    ## clears the timeout from its entry, and the dead entry is dropped
+    ## when it reaches the top of the heap, or when dead entries start
+    ## to dominate the heap.
+    ##
+
+    def __init__(self, threaded=True):
         threading.Thread.__init__(self)
         self.running = False
         self.lock = threading.Condition()
-        self.list = {}
-        self.start()
+        self.heap = []
+        self.dead = 0
+        self.seqn = itertools.count()
+        if threaded:
+            self.start()
 
     def arm(self,timeout):
         self.lock.acquire()
-        self.list[timeout.expiry] = timeout
-        self.lock.notify_all()
+        entry = [timeout.expiry, next(self.seqn), timeout]
+        timeout.entry = entry
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.lock.notify()
         self.lock.release()
 
     def unarm(self,timeout):
         self.lock.acquire()
-        if timeout.expiry in self.list:
-            self.list.pop(timeout.expiry)
-            self.lock.notify_all()
+        entry = timeout.entry
+        if entry is not None:
+            entry[2] = None
+            timeout.entry = None
+            self.dead += 1
+            if self.dead > cfg.timer_compact and self.dead > len(self.heap) // 2:
+                self.compact()
         self.lock.release()
 
+    def compact(self):
+        self.heap = [ entry for entry in self.heap if entry[2] is not None ]
+        heapq.heapify(self.heap)
+        self.dead = 0
+
+    def pending(self):
+        return len(self.heap) - self.dead
+
     def run(self):
         self.running = True
         self.lock.acquire()
         while self.running:
-            if self.list:
-                next = min(self.list)
-                sleep = next - time.time()
+            if self.heap:
+                entry = self.heap[0]
+                tout = entry[2]
+                if tout is None:
+                    heapq.heappop(self.heap)
+                    self.dead -= 1
+                    continue
+                sleep = entry[0] - clock.time()
                 if sleep < cfg.sleep_min:
-                    tout = self.list[next]
-                    self.list.pop(next)
+                    heapq.heappop(self.heap)
+                    tout.entry = None
                     tout.expire()
                 else:
                     self.lock.wait(sleep / 2)
@@ -183,6 +334,21 @@ class Timer(threading.Thread):
                 self.lock.wait(1)
         self.lock.release()
 
+    def run_until(self, now):
+        ## Threadless mode: expire everything due by now on the virtual clock
+        self.lock.acquire()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            tout = entry[2]
+            if tout is None:
+                self.dead -= 1
+            else:
+                clock.set(entry[0])
+                tout.entry = None
+                tout.expire()
+        clock.set(now)
+        self.lock.release()
+
     def stop(self):
         self.lock.acquire()
         self.running = False
@@ -190,6 +356,146 @@ class Timer(threading.Thread):
         self.lock.release()
 
 
+class AsyncTimer():
+
+    ##
+    ## Timer for the asyncio event loop. An armed Timeout is a call_at
+    ## handle on the loop, so timeouts run on the same thread as the
+    ## socket I/O and the server state needs no locking.
+    ##
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.count = 0
+
+    def arm(self,timeout):
+        delay = timeout.expiry - clock.time()
+        timeout.entry = self.loop.call_at(self.loop.time() + delay, AsyncTimer.expire, self, timeout)
+        self.count += 1
+
+    def unarm(self,timeout):
+        if timeout.entry is not None:
+            timeout.entry.cancel()
+            timeout.entry = None
+            self.count -= 1
+
+    def expire(self,timeout):
+        timeout.entry = None
+        self.count -= 1
+        timeout.expire()
+
+    def pending(self):
+        return self.count
+
+    def stop(self):
+        pass
+
+
+class Histogram():
+
+    ##
+    ## HDR style log-linear histogram of non-negative integers: values
+    ## below 2*SUB are exact, above that each power of two is split into
+    ## SUB buckets, i.e. about 6% resolution at any magnitude.
+    ##
+
+    BITS = 4
+    SUB  = 1 << BITS
+    SIZE = 40 * SUB
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * Histogram.SIZE
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        if value < 2 * Histogram.SUB:
+            index = value
+        else:
+            exp = value.bit_length() - Histogram.BITS - 1
+            index = min(exp * Histogram.SUB + (value >> exp), Histogram.SIZE - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def value_at(self, index):
+        if index < 2 * Histogram.SUB:
+            return index
+        exp = index // Histogram.SUB - 1
+        return ((index - exp * Histogram.SUB + 1) << exp) - 1
+
+    def percentile(self, pct):
+        limit = self.count * pct / 100
+        total = 0
+        for (index,count) in enumerate(self.counts):
+            total += count
+            if count and total >= limit:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / max(1, self.count)
+
+    def report(self):
+        return { 'count': self.count, 'min': self.min, 'max': self.max, 'mean': self.mean(),
+                 'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99), 'p999': self.percentile(99.9) }
+
+
+class Stats():
+
+    ##
+    ## Server counters and stage histograms; times are recorded in microseconds.
+    ##
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = clock.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, key, value):
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.record(value)
+
+    def solve(self, warm, iters):
+        self.count('solver.warm' if warm else 'solver.cold')
+        self.record('iterations', iters)
+
+    def time(self, key, secs):
+        self.record(key, int(secs * 1E6))
+
+    def report(self):
+        return { 'Time': clock.time() - self.start,
+                 'Counters': dict(self.counters),
+                 'Histograms': { key:hist.report() for (key,hist) in self.histograms.items() } }
+
+    def dump(self):
+        ret = 'Stats over {:.1f}s, times in us:'.format(clock.time() - self.start)
+        for key in sorted(self.counters):
+            ret += '\n  {:<24s} {}'.format(key, self.counters[key])
+        for key in sorted(self.histograms):
+            hist = self.histograms[key]
+            ret += '\n  {:<24s} n:{} mean:{:.0f} p50:{} p90:{} p99:{} max:{}'.format(key, hist.count, hist.mean(),
+                        hist.percentile(50), hist.percentile(90), hist.percentile(99), hist.max)
+        return ret
+
+
 class GeoFilter():
 
     def __init__(self, zero, lenght):
@@ -219,21 +525,122 @@ class GeoFilter():
         return np.sqrt(self.var_filt)
 
 
+class AnchorGrid():
+
+    ##
+    ## Uniform grid over anchor x/y coordinates for neighbourhood queries.
+    ##
+
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = {}
+
+    def key(self, coord):
+        return (int(coord[0] // self.cell), int(coord[1] // self.cell))
+
+    def add(self, anchor):
+        self.cells.setdefault(self.key(anchor.coord), set()).add(anchor)
+
+    def remove(self, anchor):
+        key = self.key(anchor.coord)
+        cell = self.cells.get(key)
+        if cell is not None:
+            cell.discard(anchor)
+            if not cell:
+                self.cells.pop(key)
+
+    def near(self, coord, radius):
+        (x,y) = self.key(coord)
+        r = int(math.ceil(radius / self.cell))
+        found = []
+        for i in range(x-r, x+r+1):
+            for j in range(y-r, y+r+1):
+                for anchor in self.cells.get((i,j), ()):
+                    if dist(anchor.coord, coord) <= radius:
+                        found.append(anchor)
+        return found
+
+
+class Geometry():
+
+    ##
+    ## Anchor geometry indexed by Anchor.index: coordinates, pairwise
+    ## distances and the neighbourhood grid. Adding an anchor computes
+    ## one new row/column; removing one only clears its presence bit.
+    ##
+
+    def __init__(self):
+        self.anchors = []
+        self.coords  = np.zeros((0,3))
+        self.present = np.zeros(0, dtype=bool)
+        self.dists   = np.zeros((0,0))
+        self.grid    = AnchorGrid(cfg.anchor_grid)
+        self.neighbours = {}
+
+    def add(self, anchor):
+        n = len(self.anchors)
+        row = dist(self.coords, anchor.coord) if n else np.zeros(0)
+        self.anchors.append(anchor)
+        self.coords = np.vstack((self.coords, anchor.coord))
+        self.present = np.append(self.present, True)
+        self.dists = np.pad(self.dists, ((0,1),(0,1)))
+        self.dists[n,:n] = row
+        self.dists[:n,n] = row
+        self.grid.add(anchor)
+        self.neighbours.clear()
+
+    def remove(self, anchor):
+        self.anchors[anchor.index] = None
+        self.present[anchor.index] = False
+        self.grid.remove(anchor)
+        self.neighbours.clear()
+
+    def distance(self, anchor_a, anchor_b):
+        return self.dists[anchor_a.index,anchor_b.index]
+
+    def get_neighbours(self, anchor):
+        ## Mask over anchor indices within cfg.anchor_range of the anchor, and its count
+        if anchor not in self.neighbours:
+            if cfg.anchor_range:
+                mask = np.zeros(len(self.anchors), dtype=bool)
+                for near in self.grid.near(anchor.coord, cfg.anchor_range):
+                    mask[near.index] = True
+            else:
+                mask = self.present.copy()
+            self.neighbours[anchor] = (mask, int(np.count_nonzero(mask)))
+        return self.neighbours[anchor]
+
+
 class TRX():
 
+    ##
+    ## One received/transmitted frame. RF levels are derived once here,
+    ## and the TSInfo dict is not kept. A TRX rebuilt from a ring record
+    ## keeps only the raw frame, decoded if its IEs are asked for.
+    ##
+
+    __slots__ = ('origin','anchor','key','index','src','frame','raw','rawts','ts','time','lqi','noise','ttcki','ttcko','rx_level','fp_level')
+
     def __init__(self,origin,src,anchor,frame,tinfo):
         self.origin = origin
         self.anchor = anchor
         self.key    = anchor.key
+        self.index  = anchor.index
         self.src    = src
         self.frame  = frame
-        self.tinfo  = tinfo
+        self.raw    = None
+        self.lqi    = tinfo['lqi']
+        self.noise  = tinfo['noise']
+        self.ttcki  = tinfo['ttcki']
+        self.ttcko  = tinfo['ttcko']
         self.rawts  = tinfo['rawts']
         self.ts     = tinfo['rawts'] + self.get_offset()
-        self.time   = time.time()
+        self.time   = clock.time()
+        self.rx_level = TRX.calc_rx_level(tinfo)
+        self.fp_level = TRX.calc_fp_level(tinfo)
 
     def is_rx(self):
-        return (self.tinfo['lqi'] > 0)
+        return (self.lqi > 0)
 
     def get_offset(self):
         if self.is_rx():
@@ -251,11 +658,11 @@ class TRX():
         rxlevel = self.get_rx_level()
         fplevel = self.get_fp_level()
         diff = fplevel - rflevel
-        dprint(4, 'TRX::get_comp: SRC:{} ANCHOR:{} DIST:{:.3f}m RxLevel:{:.2f}dBm FpLevel:{:.2f}dBm RfLevel:{:.2f}dBm Diff:{:.2f}dBm'.format(self.src.name,self.anchor.name,distance,rxlevel,fplevel,rflevel,diff))
+        dprint(4, 'TRX::get_comp: SRC:{} ANCHOR:{} DIST:{:.3f}m RxLevel:{:.2f}dBm FpLevel:{:.2f}dBm RfLevel:{:.2f}dBm Diff:{:.2f}dBm', self.src.name,self.anchor.name,distance,rxlevel,fplevel,rflevel,diff)
 
-    def get_rx_level(self):
-        POW = self.tinfo['cir_pwr']
-        RXP = self.tinfo['rxpacc']
+    def calc_rx_level(tinfo):
+        POW = tinfo['cir_pwr']
+        RXP = tinfo['rxpacc']
         if POW>0 and RXP>0:
             power = (POW << 17) / (RXP*RXP)
             level = RxPower2dBm(power, cfg.dw1000_prf)
@@ -263,11 +670,11 @@ class TRX():
         else:
             return -120
 
-    def get_fp_level(self):
-        FP1 = self.tinfo['fp_ampl1']
-        FP2 = self.tinfo['fp_ampl2']
-        FP3 = self.tinfo['fp_ampl3']
-        RXP = self.tinfo['rxpacc']
+    def calc_fp_level(tinfo):
+        FP1 = tinfo['fp_ampl1']
+        FP2 = tinfo['fp_ampl2']
+        FP3 = tinfo['fp_ampl3']
+        RXP = tinfo['rxpacc']
         if FP1>0 and FP2>0 and FP3>0 and RXP>0:
             power = (FP1*FP1 + FP2*FP2 + FP3*FP3) / (RXP*RXP)
             level = RxPower2dBm(power, cfg.dw1000_prf)
@@ -275,32 +682,136 @@ class TRX():
         else:
             return -120
 
+    def get_rx_level(self):
+        return self.rx_level
+
+    def get_fp_level(self):
+        return self.fp_level
+
     def get_noise(self):
-        N = self.tinfo['noise']
-        return N
+        return self.noise
 
     def get_xtal_ratio(self):
-        I = self.tinfo['ttcki']
-        O = self.tinfo['ttcko']
-        return O/I
+        return self.ttcko/self.ttcki
+
+    def get_ies(self):
+        if self.frame is None and self.raw is not None:
+            self.frame = TailFrame(self.raw)
+        if self.frame is None:
+            return None
+        return self.frame.tail_ies
+
+    def record(origin, src, anchor, frmtype, subtype, data, tinfo):
+        ## TRXRing.RECORD tuple; the caller checks the frame fits the slot
+        return (anchor.node, src.node, origin.node, frmtype, subtype, len(data),
+                tinfo['rawts'], clock.time(), tinfo['lqi'], tinfo['noise'], tinfo['ttcki'], tinfo['ttcko'],
+                TRX.calc_rx_level(tinfo), TRX.calc_fp_level(tinfo), data)
+
+    def from_record(server, rec):
+        (anchor,src,origin,frmtype,subtype,size,rawts,tms,lqi,noise,ttcki,ttcko,rx_level,fp_level,data) = rec
+        self = TRX.__new__(TRX)
+        self.origin = server.nodes[origin]
+        self.anchor = server.nodes[anchor]
+        self.key    = self.anchor.key
+        self.index  = self.anchor.index
+        self.src    = server.nodes[src]
+        self.frame  = None
+        self.raw    = data[:size] if size else None
+        self.lqi    = lqi
+        self.noise  = noise
+        self.ttcki  = ttcki
+        self.ttcko  = ttcko
+        self.rawts  = rawts
+        self.ts     = rawts + self.get_offset()
+        self.time   = tms
+        self.rx_level = rx_level
+        self.fp_level = fp_level
+        return self
+
+
+class Window():
+
+    ##
+    ## Per-tag (or per-anchor TWR) ranging window: three rows of TRXs
+    ## and timestamps, indexed by Anchor.index. Allocated once and reset
+    ## between rounds; only the slots that were filled get cleared.
+    ## rows[sub] lists the anchor indices heard in each row, in order.
+    ##
+
+    __slots__ = ('size','trxs','times','mask','rows')
+
+    def __init__(self, size):
+        self.size  = 0
+        self.rows  = ( [], [], [] )
+        self.resize(size)
+
+    def resize(self, size):
+        size = max(size, 1)
+        trxs = [ [None] * size for sub in range(3) ]
+        times = np.zeros((3,size), dtype=np.int64)
+        mask = np.zeros((3,size), dtype=bool)
+        if self.size:
+            for sub in range(3):
+                trxs[sub][:self.size] = self.trxs[sub]
+            times[:,:self.size] = self.times
+            mask[:,:self.size] = self.mask
+        self.size  = size
+        self.trxs  = trxs
+        self.times = times
+        self.mask  = mask
+
+    def reset(self):
+        for sub in range(3):
+            for index in self.rows[sub]:
+                self.trxs[sub][index] = None
+            self.mask[sub,self.rows[sub]] = False
+            self.rows[sub].clear()
+
+    def heard(self, sub=0):
+        return self.rows[sub]
+
+    def add(self, sub, trx):
+        index = trx.index
+        if index >= self.size:
+            self.resize(max(index + 1, 2 * self.size))
+        if not self.mask[sub,index]:
+            self.rows[sub].append(index)
+        self.trxs[sub][index] = trx
+        self.times[sub,index] = trx.ts
+        self.mask[sub,index] = True
+
+    def has(self, sub, anchor):
+        return (anchor.index < self.size and self.trxs[sub][anchor.index] is not None)
+
+    def get(self, sub, anchor):
+        if anchor.index < self.size:
+            trx = self.trxs[sub][anchor.index]
+            if trx is not None:
+                return trx
+        raise KeyError(anchor.eui)
+
+    def timestamp(self, sub, anchor):
+        return self.get(sub, anchor).timestamp()
 
 
 class Tag():
 
-    def __init__(self, server, eui, name, colour=None, algo=cfg.default_algo):
+    def __init__(self, server, eui, name, colour=None, algo=cfg.default_algo, group=None):
         self.server = server
         self.eui = eui
         self.key = bytes.fromhex(eui)
         self.name = name
         self.algo = algo
         self.colour = colour
+        self.group = group
         self.beacon = None
         self.common = None
         self.coord = np.zeros(3)
+        self.ies = None
         self.coord_filt = GeoFilter(np.zeros(3), cfg.coord_filter_len)
         self.cqual_filt = GeoFilter(np.zeros(3), cfg.cqual_filter_len)
         self.blink = None
-        self.blinks = None
+        self.blinks = Window(len(server.geometry.anchors))
         self.ranging = False
         self.beacon_timer = Timeout(server.timer, cfg.tag_beacon_timer, Tag.beacon_expire, (self,))
         self.ranging_timer = Timeout(server.timer, cfg.tag_ranging_timer, Tag.ranging_expire, (self,))
@@ -309,8 +820,8 @@ class Tag():
     def start_ranging(self):
         self.beacon_timer.arm()
         self.timeout_timer.arm()
-        self.ranging_start = time.time()
-        self.blinks = ( {}, {}, {} )
+        self.ranging_start = clock.time()
+        self.blinks.reset()
         self.blink = None
         self.ranging = True
 
@@ -323,191 +834,154 @@ class Tag():
     def distance_to(self, obj):
         return dist(self.coord, obj.coord)
 
-    def update_coord(self, new_coord):
+    def warm_coord(self):
+        if cfg.warm_start and self.coord_filt.count > 0:
+            return self.coord_filt.avg()
+        return None
+
+    def update_coord(self, new_coord, blink=None):
+        start = time.perf_counter()
+        if blink is None:
+            blink = self.blink
         self.coord_filt.update(new_coord)
         self.cqual_filt.update(new_coord)
+        moved = False
         if dist(self.cqual_filt.avg(), self.coord_filt.avg()) < cfg.max_change:
             if dist(self.coord, self.coord_filt.avg()) > cfg.min_change:
                 self.coord = self.coord_filt.avg()
-        if self.blink:
-            ies = self.blink.frame.tail_ies
-            tms = self.blink.time
+                moved = True
+        if blink:
+            ies = blink.get_ies()
+            tms = blink.time
+            self.server.stats.time('blink_to_fix', clock.time() - tms)
         else:
             ies = None
             tms = None
-        self.server.send_client_msg(Type='TAG', Tag=self.eui, Name=self.name, Colour=self.colour, Coord=self.coord.tolist(), Time=tms, IES=ies)
+        self.server.stats.count('tag.fix')
+        self.server.stats.time('update', time.perf_counter() - start)
+        ## Publish only what changed: nothing if neither the position nor the IEs did
+        msg = dict(Tag=self.eui, Name=self.name, Colour=self.colour, Coord=self.coord.tolist(), Time=tms)
+        if ies is not None and ies != self.ies:
+            msg['IES'] = self.ies = ies
+        elif not moved:
+            self.server.stats.count('tag.unchanged')
+            return
+        self.server.publisher.publish(self, msg)
+
+    def measure(self, ref, dim, base=None):
+        ##
+        ## Assemble the TDOA problem for the anchors heard in this window:
+        ## timestamps of each anchor and the reference anchor across the
+        ## three rows, vectorised woodoo, and the max_ddoa gate. Anchors
+        ## outside the beacon's neighbourhood are ignored. With a base
+        ## anchor (swls) the ranges are relative to the base-ref distance.
+        ##
+        server = self.server
+        stats = server.stats
+        geo = server.geometry
+        W = self.blinks
+        R = ref.index
+        (near,count) = geo.get_neighbours(self.beacon)
+        H = np.sort(np.array(W.heard(0), dtype=np.intp))
+        if R < W.size and W.mask[:,R].all():
+            inside = near[H]
+            sel = inside & W.mask[1,H] & W.mask[2,H] & (H != R)
+            if base is not None:
+                sel &= (H != base.index)
+            I = H[sel]
+            far = len(H) - int(np.count_nonzero(inside))
+            if far:
+                stats.count('measure.out_of_range', far)
+        else:
+            I = H[0:0]
+        missing = count - int(near[R]) - len(I)
+        if base is not None:
+            missing -= int(near[base.index])
+        if missing:
+            stats.count('measure.not_found', missing)
+        T = W.times[:,I]
+        TR = W.times[:,R] if len(I) else np.zeros(3, dtype=np.int64)
+        (L,ok) = woodoo_batch(T[0], TR[0], TR[1], T[1], T[2], TR[2])
+        if base is None:
+            C = geo.dists[R,I]
+            D = C - 2*L
+        else:
+            B = geo.dists[base.index,R]
+            C = geo.dists[base.index,I]
+            D = (C - B) - 2*L
+        good = ok & (-cfg.max_ddoa < D) & (D < cfg.max_ddoa)
+        if not ok.all():
+            stats.count('measure.bad_times', int(np.count_nonzero(~ok)))
+        if not good.all():
+            stats.count('measure.bad_tdoa', int(np.count_nonzero(ok & ~good)))
+        if Trace.limit >= 3:
+            dprint(3, ' * Beacon: {} {}', self.beacon.name,self.beacon.eui)
+            if base is not None:
+                dprint(3, ' * Common: {} {}', ref.name,ref.eui)
+            for i in np.setdiff1d(np.flatnonzero(near), I):
+                anchor = geo.anchors[i]
+                if anchor is not ref and anchor is not base:
+                    dprint(3, ' * Anchor: {} {} NOT FOUND', anchor.name,anchor.eui)
+            for (k,i) in enumerate(I):
+                anchor = geo.anchors[i]
+                if not ok[k]:
+                    dprint(3, ' * Anchor: {} {} BAD TIMES', anchor.name,anchor.eui)
+                elif not good[k]:
+                    dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA', anchor.name,anchor.eui,D[k])
+                elif base is None:
+                    dprint(3, ' * Anchor: {} {} LAT:{:.3f} C:{:.3f} D:{:.3f}', anchor.name,anchor.eui,L[k],C[k],D[k])
+                else:
+                    dprint(3, ' * Anchor: {} {} LAT:{:.3f} B:{:.3f} C:{:.3f} D:{:.3f}', anchor.name,anchor.eui,L[k],B,C[k],D[k])
+        COORDS = geo.coords[I[good],0:dim]
+        RANGES = D[good]
+        SIGMAS = np.full(len(RANGES), 0.1)
+        return (ref.coord[0:dim], COORDS, RANGES, SIGMAS)
+
+    def measure_wls2d(self):
+        return self.measure(self.beacon, 2)
 
     def laterate_wls2d(self):
-        dprint(3, ' * Beacon: {} {}'.format(self.beacon.name,self.beacon.eui))
-        bkey = self.beacon.key
-        COORDS = []
-        RANGES = []
-        SIGMAS = []
-        T = [ 0, 0, 0, 0, 0, 0 ]
-        for (akey,anchor) in self.server.anchor_keys.items():
-            if akey != bkey:
-                try:
-                    T[0] = self.blinks[0][akey].timestamp()
-                    T[1] = self.blinks[0][bkey].timestamp()
-                    T[2] = self.blinks[1][bkey].timestamp()
-                    T[3] = self.blinks[1][akey].timestamp()
-                    T[4] = self.blinks[2][akey].timestamp()
-                    T[5] = self.blinks[2][bkey].timestamp()
-                    C = self.beacon.distance_to(anchor)
-                    L = woodoo(T)
-                    D = C - 2*L
-                    if -cfg.max_ddoa < D < cfg.max_ddoa:
-                        COORDS.append((anchor.coord[0],anchor.coord[1]))
-                        RANGES.append(D)
-                        SIGMAS.append(0.1)
-                        dprint(3, ' * Anchor: {} {} LAT:{:.3f} C:{:.3f} D:{:.3f}'.format(anchor.name,anchor.eui,L,C,D))
-                    else:
-                        dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA'.format(anchor.name,anchor.eui,D))
-                except KeyError:
-                    dprint(3, ' * Anchor: {} {} NOT FOUND'.format(anchor.name,anchor.eui))
-                except ZeroDivisionError:
-                    dprint(3, ' * Anchor: {} {} BAD TIMES'.format(anchor.name,anchor.eui))
-        (coord,cond) = hyperlater2D((self.beacon.coord[0],self.beacon.coord[1]), COORDS, RANGES, SIGMAS, delta=0.01)
+        (ref,coords,ranges,sigmas) = self.measure_wls2d()
+        (coord,cond) = self.server.solver.hyperlater2D(ref, coords, ranges, sigmas, delta=0.01, x_init=self.warm_coord(), r_max=cfg.warm_residual)
+        self.server.stats.solve(self.server.solver.warm, self.server.solver.iters)
         self.update_coord(coord)
         
+    def measure_wls3d(self):
+        return self.measure(self.beacon, 3)
+
     def laterate_wls3d(self):
-        dprint(3, ' * Beacon: {} {}'.format(self.beacon.name,self.beacon.eui))
-        bkey = self.beacon.key
-        COORDS = []
-        RANGES = []
-        SIGMAS = []
-        T = [ 0, 0, 0, 0, 0, 0 ]
-        for (akey,anchor) in self.server.anchor_keys.items():
-            if akey != bkey:
-                try:
-                    T[0] = self.blinks[0][akey].timestamp()
-                    T[1] = self.blinks[0][bkey].timestamp()
-                    T[2] = self.blinks[1][bkey].timestamp()
-                    T[3] = self.blinks[1][akey].timestamp()
-                    T[4] = self.blinks[2][akey].timestamp()
-                    T[5] = self.blinks[2][bkey].timestamp()
-                    C = self.beacon.distance_to(anchor)
-                    L = woodoo(T)
-                    D = C - 2*L
-                    if -cfg.max_ddoa < D < cfg.max_ddoa:
-                        COORDS.append(anchor.coord)
-                        RANGES.append(D)
-                        SIGMAS.append(0.1)
-                        dprint(3, ' * Anchor: {} {} LAT:{:.3f} C:{:.3f} D:{:.3f}'.format(anchor.name,anchor.eui,L,C,D))
-                    else:
-                        dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA'.format(anchor.name,anchor.eui,D))
-                except KeyError:
-                    dprint(3, ' * Anchor: {} {} NOT FOUND'.format(anchor.name,anchor.eui))
-                except ZeroDivisionError:
-                    dprint(3, ' * Anchor: {} {} BAD TIMES'.format(anchor.name,anchor.eui))
-        (coord,cond) = hyperlater3D(self.beacon.coord, COORDS, RANGES, SIGMAS, delta=0.01)
+        (ref,coords,ranges,sigmas) = self.measure_wls3d()
+        (coord,cond) = self.server.solver.hyperlater3D(ref, coords, ranges, sigmas, delta=0.01, x_init=self.warm_coord(), r_max=cfg.warm_residual)
+        self.server.stats.solve(self.server.solver.warm, self.server.solver.iters)
         self.update_coord(coord)
         
+    def measure_wls3dp(self):
+        return self.measure(self.beacon, 3)
+
     def laterate_wls3dp(self):
-        dprint(3, ' * Beacon: {} {}'.format(self.beacon.name,self.beacon.eui))
-        bkey = self.beacon.key
-        COORDS = []
-        RANGES = []
-        SIGMAS = []
-        T = [ 0, 0, 0, 0, 0, 0 ]
-        for (akey,anchor) in self.server.anchor_keys.items():
-            if akey != bkey:
-                try:
-                    T[0] = self.blinks[0][akey].timestamp()
-                    T[1] = self.blinks[0][bkey].timestamp()
-                    T[2] = self.blinks[1][bkey].timestamp()
-                    T[3] = self.blinks[1][akey].timestamp()
-                    T[4] = self.blinks[2][akey].timestamp()
-                    T[5] = self.blinks[2][bkey].timestamp()
-                    C = self.beacon.distance_to(anchor)
-                    L = woodoo(T)
-                    D = C - 2*L
-                    if -cfg.max_ddoa < D < cfg.max_ddoa:
-                        COORDS.append(anchor.coord)
-                        RANGES.append(D)
-                        SIGMAS.append(0.1)
-                        dprint(3, ' * Anchor: {} {} LAT:{:.3f} C:{:.3f} D:{:.3f}'.format(anchor.name,anchor.eui,L,C,D))
-                    else:
-                        dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA'.format(anchor.name,anchor.eui,D))
-                except KeyError:
-                    dprint(3, ' * Anchor: {} {} NOT FOUND'.format(anchor.name,anchor.eui))
-                except ZeroDivisionError:
-                    dprint(3, ' * Anchor: {} {} BAD TIMES'.format(anchor.name,anchor.eui))
-        (coord,cond) = hyperlater3Dp(self.beacon.coord, COORDS, RANGES, SIGMAS, delta=0.01, z_est=cfg.tag_z_estimate)
+        (ref,coords,ranges,sigmas) = self.measure_wls3dp()
+        (coord,cond) = self.server.solver.hyperlater3Dp(ref, coords, ranges, sigmas, delta=0.01, z_est=cfg.tag_z_estimate, x_init=self.warm_coord(), r_max=cfg.warm_residual)
+        self.server.stats.solve(self.server.solver.warm, self.server.solver.iters)
         self.update_coord(coord)
         
-    def laterate_swls(self):
+    def measure_swls(self):
         self.select_common()
-        dprint(3, ' * Beacon: {} {}'.format(self.beacon.name,self.beacon.eui))
-        dprint(3, ' * Common: {} {}'.format(self.common.name,self.common.eui))
-        ckey = self.common.key
-        bkey = self.beacon.key
-        COORDS = []
-        RANGES = []
-        SIGMAS = []
-        T = [ 0, 0, 0, 0, 0, 0 ]
-        for (akey,anchor) in self.server.anchor_keys.items():
-            if akey not in (bkey,ckey):
-                try:
-                    T[0] = self.blinks[0][akey].timestamp()
-                    T[1] = self.blinks[0][ckey].timestamp()
-                    T[2] = self.blinks[1][ckey].timestamp()
-                    T[3] = self.blinks[1][akey].timestamp()
-                    T[4] = self.blinks[2][akey].timestamp()
-                    T[5] = self.blinks[2][ckey].timestamp()
-                    B = self.beacon.distance_to(self.common)
-                    C = self.beacon.distance_to(anchor)
-                    L = woodoo(T)
-                    D = (C - B) - 2*L
-                    if -cfg.max_ddoa < D < cfg.max_ddoa:
-                        COORDS.append(anchor.coord)
-                        RANGES.append(D)
-                        SIGMAS.append(0.1)
-                        dprint(3, ' * Anchor: {} {} LAT:{:.3f} B:{:.3f} C:{:.3f} D:{:.3f}'.format(anchor.name,anchor.eui,L,B,C,D))
-                    else:
-                        dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA'.format(anchor.name,anchor.eui,D))
-                except KeyError:
-                    dprint(3, ' * Anchor: {} {} NOT FOUND'.format(anchor.name,anchor.eui))
-                except ZeroDivisionError:
-                    dprint(3, ' * Anchor: {} {} BAD TIMES'.format(anchor.name,anchor.eui))
-        (coord,cond) = hyperlater3D(self.common.coord, COORDS, RANGES, SIGMAS, delta=0.005)
+        return self.measure(self.common, 3, self.beacon)
+
+    def laterate_swls(self):
+        (ref,coords,ranges,sigmas) = self.measure_swls()
+        (coord,cond) = self.server.solver.hyperlater3D(ref, coords, ranges, sigmas, delta=0.005, x_init=self.warm_coord(), r_max=cfg.warm_residual)
+        self.server.stats.solve(self.server.solver.warm, self.server.solver.iters)
         self.update_coord(coord)
     
-    def laterate_swls3dp(self):
+    def measure_swls3dp(self):
         self.select_common()
-        dprint(3, ' * Beacon: {} {}'.format(self.beacon.name,self.beacon.eui))
-        dprint(3, ' * Common: {} {}'.format(self.common.name,self.common.eui))
-        ckey = self.common.key
-        bkey = self.beacon.key
-        COORDS = []
-        RANGES = []
-        SIGMAS = []
-        T = [ 0, 0, 0, 0, 0, 0 ]
-        for (akey,anchor) in self.server.anchor_keys.items():
-            if akey not in (bkey,ckey):
-                try:
-                    T[0] = self.blinks[0][akey].timestamp()
-                    T[1] = self.blinks[0][ckey].timestamp()
-                    T[2] = self.blinks[1][ckey].timestamp()
-                    T[3] = self.blinks[1][akey].timestamp()
-                    T[4] = self.blinks[2][akey].timestamp()
-                    T[5] = self.blinks[2][ckey].timestamp()
-                    B = self.beacon.distance_to(self.common)
-                    C = self.beacon.distance_to(anchor)
-                    L = woodoo(T)
-                    D = (C - B) - 2*L
-                    if -cfg.max_ddoa < D < cfg.max_ddoa:
-                        COORDS.append(anchor.coord)
-                        RANGES.append(D)
-                        SIGMAS.append(0.1)
-                        dprint(3, ' * Anchor: {} {} LAT:{:.3f} B:{:.3f} C:{:.3f} D:{:.3f}'.format(anchor.name,anchor.eui,L,B,C,D))
-                    else:
-                        dprint(3, ' * Anchor: {} {} D:{:.3f} BAD TDOA'.format(anchor.name,anchor.eui,D))
-                except KeyError:
-                    dprint(3, ' * Anchor: {} {} NOT FOUND'.format(anchor.name,anchor.eui))
-                except ZeroDivisionError:
-                    dprint(3, ' * Anchor: {} {} BAD TIMES'.format(anchor.name,anchor.eui))
-        (coord,cond) = hyperlater3Dp(self.common.coord, COORDS, RANGES, SIGMAS, delta=0.005, z_est=cfg.tag_z_estimate)
+        return self.measure(self.common, 3, self.beacon)
+
+    def laterate_swls3dp(self):
+        (ref,coords,ranges,sigmas) = self.measure_swls3dp()
+        (coord,cond) = self.server.solver.hyperlater3Dp(ref, coords, ranges, sigmas, delta=0.005, z_est=cfg.tag_z_estimate, x_init=self.warm_coord(), r_max=cfg.warm_residual)
+        self.server.stats.solve(self.server.solver.warm, self.server.solver.iters)
         self.update_coord(coord)
     
     def laterate_test1(self):
@@ -545,114 +1019,229 @@ class Tag():
         'test3'    : laterate_test3,
     }
 
-    def laterate(self):
+    batch_algos = {
+        'wls'      : (measure_wls3d,   hyperlater3D_batch,  { 'delta':0.01 }),
+        'wls2d'    : (measure_wls2d,   hyperlater2D_batch,  { 'delta':0.01 }),
+        'wls3d'    : (measure_wls3d,   hyperlater3D_batch,  { 'delta':0.01 }),
+        'wls3dp'   : (measure_wls3dp,  hyperlater3Dp_batch, { 'delta':0.01,  'z_est':None }),
+        'swls'     : (measure_swls,    hyperlater3D_batch,  { 'delta':0.005 }),
+        'swls3d'   : (measure_swls,    hyperlater3D_batch,  { 'delta':0.005 }),
+        'swls3dp'  : (measure_swls3dp, hyperlater3Dp_batch, { 'delta':0.005, 'z_est':None }),
+    }
+
+    def get_algo(self):
         if cfg.force_algo:
-            algo = cfg.force_algo
-        else:
-            algo = self.algo
+            return cfg.force_algo
+        return self.algo
+
+    def laterate(self):
+        algo = self.get_algo()
         try:
             if algo in Tag.algos:
+                start = time.perf_counter()
                 Tag.algos[algo](self)
-                dprint(1, 'Tag::laterate[{0}]: {1} ({2[0]:.3f},{2[1]:.3f},{2[2]:.3f})'.format(algo, self.name, self.coord))
+                self.server.stats.time('laterate', time.perf_counter() - start)
+                dprint(1, 'Tag::laterate[{0}]: {1} ({2[0]:.3f},{2[1]:.3f},{2[2]:.3f})', algo, self.name, self.coord)
             else:
                 raise ValueError('Invalid algorithm \'{}\''.format(algo))
         except (KeyError,ValueError,AttributeError,LinAlgError) as err:
-            dprint(1, 'Tag::laterate failed: {}'.format(err))
+            self.server.stats.count('laterate.' + err.__class__.__name__)
+            dprint(1, 'Tag::laterate failed: {}', err)
     
     def select_beacon(self):
         if cfg.force_beacon:
             self.beacon = cfg.force_beacon
             self.beacon.register_tag(self)
-            dprint(3, 'Tag::select_beacon: FORCED Tag:{} => Anchor:{}'.format(self.name, self.beacon.name))
+            dprint(3, 'Tag::select_beacon: FORCED Tag:{} => Anchor:{}', self.name, self.beacon.name)
             return
         if cfg.random_beacon:
             N = len(self.server.anchor_refs)
             I = random.randrange(0,N)
             self.beacon = list(self.server.anchor_refs.values())[I]
             self.beacon.register_tag(self)
-            dprint(3, 'Tag::select_beacon: RANDOM Tag:{} => Anchor:{}'.format(self.name, self.beacon.name))
+            dprint(3, 'Tag::select_beacon: RANDOM Tag:{} => Anchor:{}', self.name, self.beacon.name)
             return
         if True:
             levels = {}
-            for key in self.server.anchor_refs:
-                if key in self.blinks[0]:
-                    rx = self.blinks[0][key]
-                    levels[key] = rx.get_rx_level()
+            for index in sorted(self.blinks.heard(0)):
+                anchor = self.server.geometry.anchors[index]
+                if anchor is not None and anchor.refok:
+                    rx = self.blinks.get(0, anchor)
+                    levels[anchor] = rx.get_rx_level()
             if levels:
-                key = max(levels, key=levels.get)
-                self.beacon = self.server.anchor_keys[key]
+                self.beacon = max(levels, key=levels.get)
                 self.beacon.register_tag(self)
-                dprint(3, 'Tag::select_beacon: BEST Tag:{} => Anchor:{}'.format(self.name, self.beacon.name))
+                dprint(3, 'Tag::select_beacon: BEST Tag:{} => Anchor:{}', self.name, self.beacon.name)
                 return
         raise ValueError('beacon anchor selection not possible')
     
     def select_common(self):
         if cfg.force_common:
             self.common = cfg.force_common
-            dprint(3, 'Tag::select_common: FORCED Tag:{} => Anchor:{}'.format(self.name, self.common.name))
+            dprint(3, 'Tag::select_common: FORCED Tag:{} => Anchor:{}', self.name, self.common.name)
             return
         if cfg.random_common:
             N = len(self.server.anchor_refs)
             I = random.randrange(0,N)
             self.common = list(self.server.anchor_refs.values())[I]
-            dprint(3, 'Tag::select_common: RANDOM Tag:{} => Anchor:{}'.format(self.name, self.beacon.name))
+            dprint(3, 'Tag::select_common: RANDOM Tag:{} => Anchor:{}', self.name, self.beacon.name)
             return
         if self.beacon:
             levels = {}
-            for key in self.server.anchor_refs:
-                if key != self.beacon.key:
-                    if key in self.blinks[0] and key in self.blinks[1] and key in self.blinks[2]:
-                        rx0 = self.blinks[0][key]
-                        rx1 = self.blinks[1][key]
-                        rx2 = self.blinks[2][key]
-                        levels[key] = rx0.get_rx_level() + rx1.get_rx_level() + rx2.get_rx_level()
+            (near,count) = self.server.geometry.get_neighbours(self.beacon)
+            for index in sorted(self.blinks.heard(2)):
+                anchor = self.server.geometry.anchors[index]
+                if anchor is not None and anchor.refok and anchor is not self.beacon and near[index]:
+                    if self.blinks.has(0, anchor) and self.blinks.has(1, anchor):
+                        rx0 = self.blinks.get(0, anchor)
+                        rx1 = self.blinks.get(1, anchor)
+                        rx2 = self.blinks.get(2, anchor)
+                        levels[anchor] = rx0.get_rx_level() + rx1.get_rx_level() + rx2.get_rx_level()
             if levels:
-                key = max(levels, key=levels.get)
-                self.common = self.server.anchor_keys[key]
-                dprint(3, 'Tag::select_common: BEST Tag:{} => Anchor:{}'.format(self.name, self.common.name))
+                self.common = max(levels, key=levels.get)
+                dprint(3, 'Tag::select_common: BEST Tag:{} => Anchor:{}', self.name, self.common.name)
                 return
         raise ValueError('common anchor selection not possible')
     
     def beacon_expire(self):
-        dprint(3, 'Tag::beacon_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Tag::beacon_expire @ {}', clock.time() - self.ranging_start)
         if self.beacon:
             self.beacon.transmit_beacon(self.eui)
 
     def ranging_expire(self):
-        dprint(3, 'Tag::ranging_expire @ {}'.format(time.time() - self.ranging_start))
-        self.laterate()
+        dprint(3, 'Tag::ranging_expire @ {}', clock.time() - self.ranging_start)
+        if cfg.laterate_batch and self.get_algo() in Tag.batch_algos:
+            self.server.laterator.add(self)
+        else:
+            self.laterate()
         self.select_beacon()
         self.finish_ranging()
 
     def timeout_expire(self):
-        dprint(3, 'Tag::timeout_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Tag::timeout_expire @ {}', clock.time() - self.ranging_start)
         self.select_beacon()
         self.finish_ranging()
     
     def add_blink(self,trx):
-        dprint(4, 'Tag::add_blink:   ANC:{} Rx:{:.1f}dBm'.format(trx.anchor.eui, trx.get_rx_level()))
+        dprint(4, 'Tag::add_blink:   ANC:{} Rx:{:.1f}dBm', trx.anchor.eui, Lazy(trx.get_rx_level))
         if not self.ranging:
             self.start_ranging()
-        self.blinks[0][trx.key] = trx
+        self.blinks.add(0, trx)
         self.blink = trx
 
     def add_beacon(self,trx):
         if self.ranging:
             tag = trx.origin.eui
             anc = trx.anchor.eui
-            src = trx.frame.get_src_eui()
+            src = trx.src.eui
             if src == trx.origin.beacon.eui:
-                dprint(4, 'Tag::add_beacon:  ANC:{} SRC:{} Rx:{:.1f}dBm'.format(anc, src, trx.get_rx_level()))
-                self.blinks[1][trx.key] = trx
+                dprint(4, 'Tag::add_beacon:  ANC:{} SRC:{} Rx:{:.1f}dBm', anc, src, Lazy(trx.get_rx_level))
+                self.blinks.add(1, trx)
                 self.beacon_timer.unarm()
 
     def add_ranging(self,trx):
         if self.ranging:
-            dprint(4, 'Tag::add_ranging: ANC:{} Rx:{:.1f}dBm'.format(trx.anchor.eui, trx.get_rx_level()))
-            self.blinks[2][trx.key] = trx
+            dprint(4, 'Tag::add_ranging: ANC:{} Rx:{:.1f}dBm', trx.anchor.eui, Lazy(trx.get_rx_level))
+            self.blinks.add(2, trx)
             self.ranging_timer.arm()
 
 
+class Laterator():
+
+    ##
+    ## Tags are measured as soon as their ranging window closes, but
+    ## solved together in one batch per algorithm: the first queued tag
+    ## arms cfg.laterate_batch_timer, and every tag closing before it
+    ## fires joins the batch.
+    ##
+
+    def __init__(self, server):
+        self.server = server
+        self.batch  = {}
+        self.timer  = Timeout(server.timer, cfg.laterate_batch_timer, Laterator.batch_expire, (self,))
+
+    def add(self, tag):
+        algo = tag.get_algo()
+        (measure,solver,args) = Tag.batch_algos[algo]
+        try:
+            start = time.perf_counter()
+            prob = measure(tag)
+            self.server.stats.time('measure', time.perf_counter() - start)
+            self.batch.setdefault(algo, []).append((tag,tag.blink,prob))
+            self.timer.arm()
+        except (KeyError,ValueError,AttributeError,LinAlgError) as err:
+            self.server.stats.count('laterate.' + err.__class__.__name__)
+            dprint(1, 'Tag::laterate failed: {}', err)
+
+    def batch_expire(self):
+        (batch,self.batch) = (self.batch,{})
+        for (algo,items) in batch.items():
+            (measure,solver,args) = Tag.batch_algos[algo]
+            (tags,blinks,probs) = zip(*items)
+            (refs,coords,ranges,sigmas) = zip(*probs)
+            (B,R,S,M) = hyperpack(coords, ranges, sigmas, len(refs[0]))
+            if 'z_est' in args:
+                args = dict(args, z_est=cfg.tag_z_estimate)
+            info = {}
+            if cfg.warm_start:
+                Z = np.full((len(tags),3), np.nan)
+                for (k,tag) in enumerate(tags):
+                    coord = tag.warm_coord()
+                    if coord is not None:
+                        Z[k] = coord
+                args = dict(args, x_init=Z, r_max=cfg.warm_residual)
+            start = time.perf_counter()
+            (X,C,OK) = solver(refs, B, R, S, M, info=info, **args)
+            self.server.stats.time('solve_batch', time.perf_counter() - start)
+            self.server.stats.record('batch_size', len(tags))
+            for (warm,iters,ok) in zip(info['warm'],info['iters'],OK):
+                if ok:
+                    self.server.stats.solve(warm, iters)
+            dprint(2, 'Laterator::batch_expire[{}]: {} tags', algo, len(tags))
+            for (tag,blink,coord,ok) in zip(tags,blinks,X,OK):
+                if ok:
+                    try:
+                        tag.update_coord(coord, blink)
+                        dprint(1, 'Tag::laterate[{0}]: {1} ({2[0]:.3f},{2[1]:.3f},{2[2]:.3f})', algo, tag.name, tag.coord)
+                    except (KeyError,ValueError,AttributeError,LinAlgError) as err:
+                        self.server.stats.count('laterate.' + err.__class__.__name__)
+                        dprint(1, 'Tag::laterate failed: {}', err)
+                else:
+                    self.server.stats.count('laterate.batch_solve')
+                    dprint(1, 'Tag::laterate failed: {} batch solve', tag.name)
+
+
+class Publisher():
+
+    ##
+    ## Outbound position updates. With cfg.publish_interval zero each
+    ## update is sent at once as a TAG message. Otherwise updates are
+    ## coalesced per tag, and the latest of each is sent once per interval
+    ## in a single TAGS message.
+    ##
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = {}
+        self.timer = Timeout(server.timer, cfg.publish_interval, Publisher.expire, (self,))
+
+    def publish(self, tag, msg):
+        if self.server.upstream is not None:
+            self.server.send_upstream(msg)
+        elif cfg.publish_interval > 0:
+            if tag.eui in self.pending:
+                self.server.stats.count('publish.coalesced')
+            self.pending[tag.eui] = (tag,msg)
+            self.timer.arm()
+        else:
+            self.server.send_tag_msg(tag, Type='TAG', **msg)
+
+    def expire(self):
+        (pending,self.pending) = (self.pending,{})
+        if pending:
+            self.server.send_tags_msg(list(pending.values()))
+
+
 class Anchor():
 
     def __init__(self, server, name, eui, host, port, coord, ref, rx_antd=0.0, tx_antd=0.0):
@@ -668,19 +1257,25 @@ class Anchor():
         self.tx_antd = tx_antd
         self.raddr   = socket.getaddrinfo(host, port, socket.AF_INET6)[0][4]
         self.key     = self.raddr[0]
+        self.index   = len(server.geometry.anchors)
         self.ranging_start  = None
         self.ranging_iter   = None
         self.ranging_peer   = None
-        self.ranging_blinks = None
+        self.ranging_blinks = Window(self.index + 1)
         self.wakeup_timer   = Timeout(server.timer, cfg.anchor_wakeup_timer[0], Anchor.wakeup_expire, (self,))
         self.request_timer  = Timeout(server.timer, cfg.anchor_request_timer, Anchor.request_expire, (self,))
         self.response_timer = Timeout(server.timer, cfg.anchor_response_timer, Anchor.response_expire, (self,))
         self.ranging_timer  = Timeout(server.timer, cfg.anchor_ranging_timer, Anchor.ranging_expire, (self,))
         self.timeout_timer  = Timeout(server.timer, cfg.anchor_timeout_timer, Anchor.timeout_expire, (self,))
+        self.format_time    = 0.0
+        self.binary         = False
+        self.beacons        = {}
 
         if cfg.anchor_wakeup_timer[0]:
             self.wakeup_timer.arm()
 
+        self.request_format()
+
     def distance_to(self, obj):
         return dist(self.coord, obj.coord)
 
@@ -692,8 +1287,37 @@ class Anchor():
 
     def sendmsg(self, **args):
         data = json.dumps(args)
-        dprint(3, 'Anchor::sendmsg {}'.format(data))
-        self.sock.sendto(data.encode(), self.raddr)
+        dprint(3, 'Anchor::sendmsg {}', data)
+        self.send(data.encode())
+
+    def sendraw(self, data):
+        dprint(3, 'Anchor::sendraw {} bytes', len(data))
+        self.send(data)
+
+    def send(self, data):
+        ## Anchors only accept commands from the server's own port, so a
+        ## shard hands them to the ingest process to send
+        if cfg.replay_file is None:
+            if self.server.upstream is not None:
+                self.server.send_upstream_anchor(self, data)
+            else:
+                self.sock.sendto(data, self.raddr)
+
+    def request_format(self):
+        ## The ingest process negotiates the format for its shards
+        if cfg.anchor_format != 'json' and self.server.upstream is None:
+            self.format_time = clock.time()
+            self.sendmsg(Type='FORMAT', Format=cfg.anchor_format, Version=AnchorMsg.VERSION)
+
+    def binary_received(self):
+        ## The anchor speaks our AnchorMsg version, commands included
+        self.binary = True
+
+    def json_received(self):
+        self.binary = False
+        if cfg.anchor_format != 'json':
+            if clock.time() - self.format_time > cfg.anchor_format_retry:
+                self.request_format()
 
     def register_tag(self, tag):
         self.sendmsg(Type='REGISTER', Tag=tag.eui)
@@ -702,46 +1326,57 @@ class Anchor():
         self.sendmsg(Type='REMOVE', Tag=tag.eui)
 
     def transmit_beacon(self, ref, sub=0, dst=0xffff, flags=0):
-        frame = TailFrame()
-        frame.set_src_addr(self.eui)
-        frame.set_dst_addr(dst)
-        frame.tail_protocol = 1
-        frame.tail_frmtype = 1
-        frame.tail_subtype = sub
-        frame.tail_flags = flags
-        frame.tail_beacon = bytes.fromhex(ref)
-        self.sendmsg(Type='FRAME', Data=frame.encode().hex())
+        if self.binary:
+            self.sendraw(AnchorMsg.encode_beacon(ref, sub, flags, dst))
+        else:
+            beacon = self.beacons.get((sub,dst))
+            if beacon is None:
+                beacon = self.beacons[(sub,dst)] = BeaconTemplate(self.eui, dst, sub)
+            self.sendmsg(Type='FRAME', Data=beacon.encode(ref, flags).hex())
+
+    def schedule_beacons(self, *beacons):
+        self.sendmsg(Type='SCHEDULE', Beacons=beacons)
 
     def start_ranging_with(self, anchor):
-        dprint(3, 'Anchor::start_ranging_with: {} <> {}'.format(self.eui,anchor.eui))
+        dprint(3, 'Anchor::start_ranging_with: {} <> {}', self.eui,anchor.eui)
         self.ranging_peer = anchor
-        self.ranging_start = time.time()
-        self.ranging_blinks = ( {}, {}, {} )
+        self.ranging_start = clock.time()
+        self.ranging_blinks.reset()
         self.timeout_timer.arm()
-        self.request_timer.arm()
-        self.transmit_beacon(self.eui, sub=1, dst=self.ranging_peer.eui)
+        if cfg.anchor_schedule:
+            ## The anchors run the whole 1-2-3 sequence themselves
+            req = cfg.anchor_request_timer
+            rsp = req + cfg.anchor_response_timer
+            self.schedule_beacons(dict(Delay=0.0, Beacon=self.eui, SubType=1, Dst=anchor.eui),
+                                  dict(Delay=rsp, Beacon=self.eui, SubType=3, Dst=anchor.eui))
+            anchor.schedule_beacons(dict(Delay=req, Beacon=self.eui, SubType=2, Dst=self.eui))
+            self.ranging_timer.arm(rsp + cfg.anchor_ranging_timer)
+        else:
+            self.request_timer.arm()
+            self.transmit_beacon(self.eui, sub=1, dst=self.ranging_peer.eui)
 
     def finish_ranging(self):
         self.timeout_timer.unarm()
         self.request_timer.unarm()
         self.response_timer.unarm()
+        self.ranging_timer.unarm()
         self.ranging_peer = None
-        self.ranging_blinks = None
+        self.ranging_blinks.reset()
 
     def two_way_ranging(self):
         try:
             T = [ 0, 0, 0, 0, 0, 0 ]
-            T[0] = self.ranging_blinks[0][self.key].timestamp()
-            T[1] = self.ranging_blinks[0][self.ranging_peer.key].timestamp()
-            T[2] = self.ranging_blinks[1][self.ranging_peer.key].timestamp()
-            T[3] = self.ranging_blinks[1][self.key].timestamp()
-            T[4] = self.ranging_blinks[2][self.key].timestamp()
-            T[5] = self.ranging_blinks[2][self.ranging_peer.key].timestamp()
+            T[0] = self.ranging_blinks.timestamp(0, self)
+            T[1] = self.ranging_blinks.timestamp(0, self.ranging_peer)
+            T[2] = self.ranging_blinks.timestamp(1, self.ranging_peer)
+            T[3] = self.ranging_blinks.timestamp(1, self)
+            T[4] = self.ranging_blinks.timestamp(2, self)
+            T[5] = self.ranging_blinks.timestamp(2, self.ranging_peer)
             D = woodoo(T)
             self.server.add_anchor_twr(self, self.ranging_peer, D)
         
         except (KeyError,ValueError,AttributeError,LinAlgError) as err:
-            dprint(1, 'Anchor::TWR failed: {}'.format(err))
+            dprint(1, 'Anchor::TWR failed: {}', err)
 
     def wakeup_expire(self):
         dprint(3, 'Anchor::wakeup_expire')
@@ -755,54 +1390,370 @@ class Anchor():
             self.ranging_iter = iter(self.server.anchor_keys)
 
     def timeout_expire(self):
-        dprint(3, 'Anchor::timeout_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Anchor::timeout_expire @ {}', clock.time() - self.ranging_start)
         self.finish_ranging()
         
     def request_expire(self):
-        dprint(3, 'Anchor::request_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Anchor::request_expire @ {}', clock.time() - self.ranging_start)
         if self.ranging_peer:
             self.ranging_peer.transmit_beacon(self.eui, sub=2, dst=self.eui)
             self.response_timer.arm()
 
     def response_expire(self):
-        dprint(3, 'Anchor::response_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Anchor::response_expire @ {}', clock.time() - self.ranging_start)
         if self.ranging_peer:
             self.transmit_beacon(self.eui, sub=3, dst=self.ranging_peer.eui)
             self.ranging_timer.arm()
 
     def ranging_expire(self):
-        dprint(3, 'Anchor::ranging_expire @ {}'.format(time.time() - self.ranging_start))
+        dprint(3, 'Anchor::ranging_expire @ {}', clock.time() - self.ranging_start)
         if self.ranging_peer:
             self.two_way_ranging()
             self.finish_ranging()
 
     def add_beacon(self,trx,sub):
-        dprint(4, 'Anchor::add_beacon[{}]: {} Rx:{:.1f}dBm'.format(sub, trx.anchor.eui, trx.get_rx_level()))
+        dprint(4, 'Anchor::add_beacon[{}]: {} Rx:{:.1f}dBm', sub, trx.anchor.eui, Lazy(trx.get_rx_level))
         if self.ranging_peer:
-            self.ranging_blinks[sub][trx.key] = trx
+            self.ranging_blinks.add(sub, trx)
         
 
 class Client():
 
+    ##
+    ## Outbound messages arrive already encoded and are queued here; only
+    ## the poll loop writes to the socket, draining the queue on POLLOUT.
+    ## The queue holds at most cfg.client_queue_len messages. On overflow
+    ## cfg.client_overflow decides: 'drop' the oldest message, 'coalesce'
+    ## with the queued message for the same tag (else drop the oldest),
+    ## or 'disconnect' the client.
+    ##
+
     def __init__(self, pipe):
         self.pipe = pipe
         self.key  = self.pipe.remote
         self.fd   = self.pipe.sock.fileno()
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.index = {}
+        self.buff = None
+        self.polling = False
+        self.closing = False
+        self.subscription = None
+        self.pipe.sock.setblocking(False)
+
+    def encode(**args):
+        return json.dumps(args).encode() + b'\x1f'
 
     def sendmsg(self, **args):
-        data = json.dumps(args)
-        dprint(3, 'Client::sendmsg {}'.format(data))
-        self.pipe.sendmsg(data)
+        return self.push(Client.encode(**args))
+
+    def push(self, data, key=None):
+        ## Returns True when the queue was idle and the poll loop needs a wakeup
+        dprint(3, 'Client::push {}', Lazy(data.decode))
+        with self.lock:
+            if self.closing:
+                return False
+            idle = (not self.queue and self.buff is None)
+            if len(self.queue) >= cfg.client_queue_len:
+                if cfg.client_overflow == 'disconnect':
+                    self.closing = True
+                    raise ConnectionAbortedError('client queue overflow')
+                if cfg.client_overflow == 'coalesce' and key in self.index:
+                    self.index[key][1] = data
+                    return False
+                self.pop()
+            entry = [key,data]
+            self.queue.append(entry)
+            if key is not None and cfg.client_overflow == 'coalesce':
+                self.index[key] = entry
+            return idle
+
+    def pop(self):
+        entry = self.queue.popleft()
+        if entry[0] is not None and self.index.get(entry[0]) is entry:
+            del self.index[entry[0]]
+        return entry[1]
+
+    def pending(self):
+        return len(self.queue)
+
+    def flush(self):
+        ## Send what the socket takes without blocking; True when all is out
+        with self.lock:
+            while True:
+                if self.buff is None:
+                    if not self.queue:
+                        return True
+                    if len(self.queue) == 1:
+                        self.buff = memoryview(self.pop())
+                    else:
+                        self.buff = memoryview(b''.join([ self.pop() for i in range(min(len(self.queue), 64)) ]))
+                try:
+                    n = self.pipe.sock.send(self.buff)
+                except BlockingIOError:
+                    return False
+                if n < len(self.buff):
+                    self.buff = self.buff[n:]
+                else:
+                    self.buff = None
 
     def recvmsg(self):
-        while self.pipe.hasmsg():
-            msg = self.pipe.getmsg()
-            dprint(1, 'Client::recvmsg: {}'.format(msg))
+        msgs = []
+        try:
+            self.pipe.fillbuf()
+        except BlockingIOError:
+            pass
+        for msg in self.pipe.getmsgs():
+            dprint(1, 'Client::recvmsg: {}', msg)
+            msgs.append(json.loads(msg))
+        return msgs
+
+
+class Subscription():
+
+    ##
+    ## Client-side TAG filter, compiled once from a SUBSCRIBE message into
+    ## a list of predicates over (tag, coord, now). Every given field must
+    ## match; absent fields match everything:
+    ##
+    ##   Tags:     [ eui, ... ]
+    ##   Groups:   [ group, ... ]
+    ##   Box:      [ [x0,y0(,z0)], [x1,y1(,z1)] ]
+    ##   Zones:    [ name, ... ] from the ZONES config section
+    ##   Interval: minimum seconds between updates of the same tag
+    ##
+
+    def __init__(self, server, msg):
+        self.spec = {}
+        self.tests = []
+        self.interval = 0.0
+        self.last = {}
+        if msg.get('Tags'):
+            euis = frozenset(eui.lower() for eui in msg['Tags'])
+            self.tests.append(lambda tag,coord: tag.eui in euis)
+            self.spec['Tags'] = sorted(euis)
+        if msg.get('Groups'):
+            groups = frozenset(msg['Groups'])
+            self.tests.append(lambda tag,coord: tag.group in groups)
+            self.spec['Groups'] = sorted(groups)
+        boxes = []
+        if msg.get('Box'):
+            boxes.append(Subscription.box(msg['Box']))
+            self.spec['Box'] = msg['Box']
+        if msg.get('Zones'):
+            for name in msg['Zones']:
+                boxes.append(Subscription.box(server.zones[name]))
+            self.spec['Zones'] = msg['Zones']
+        if boxes:
+            self.tests.append(lambda tag,coord: any(Subscription.inside(box,coord) for box in boxes))
+        if msg.get('Interval'):
+            self.interval = float(msg['Interval'])
+            self.spec['Interval'] = self.interval
+
+    def box(corners):
+        (lo,hi) = corners
+        if len(lo) != len(hi) or len(lo) not in (2,3):
+            raise ValueError('invalid box {}'.format(corners))
+        return tuple((min(a,b),max(a,b)) for (a,b) in zip(lo,hi))
+
+    def inside(box, coord):
+        for ((lo,hi),x) in zip(box,coord):
+            if not lo <= x <= hi:
+                return False
+        return True
+
+    def match(self, tag, coord, now):
+        for test in self.tests:
+            if not test(tag,coord):
+                return False
+        if self.interval:
+            if now - self.last.get(tag.key, 0.0) < self.interval:
+                return False
+            self.last[tag.key] = now
+        return True
 
         
+class TRXRing():
+
+    ##
+    ## Single-producer single-consumer ring of decoded TRX records in
+    ## shared memory, inherited by the shard across fork. The header
+    ## holds the head and tail record counts: only the producer moves
+    ## the head, only the consumer the tail.
+    ##
+
+    FRAME = 128
+
+    RECORD = np.dtype([
+        ('anchor',   '<i4'),
+        ('src',      '<i4'),
+        ('origin',   '<i4'),
+        ('frmtype',  'u1'),
+        ('subtype',  'u1'),
+        ('size',     'u1'),
+        ('rawts',    '<u8'),
+        ('time',     '<f8'),
+        ('lqi',      '<u2'),
+        ('noise',    '<u2'),
+        ('ttcki',    '<u4'),
+        ('ttcko',    '<u4'),
+        ('rx_level', '<f4'),
+        ('fp_level', '<f4'),
+        ('frame',    'V{}'.format(FRAME)),
+    ])
+
+    def __init__(self, size):
+        ## shared_memory needs Python 3.8; imported only when a ring is used
+        from multiprocessing import shared_memory
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=16 + size * TRXRing.RECORD.itemsize)
+        self.ctrl = np.ndarray(2, dtype='<u8', buffer=self.shm.buf)
+        self.recs = np.ndarray(size, dtype=TRXRing.RECORD, buffer=self.shm.buf, offset=16)
+        self.ctrl[:] = 0
+
+    def put(self, rec):
+        ## None when full, else True if the ring was empty (the consumer may sleep)
+        head = int(self.ctrl[0])
+        tail = int(self.ctrl[1])
+        if head - tail >= self.size:
+            return None
+        self.recs[head % self.size] = rec
+        self.ctrl[0] = head + 1
+        return (head == tail)
+
+    def get(self, count):
+        ## Up to count records as tuples, stopping at the wrap
+        head = int(self.ctrl[0])
+        tail = int(self.ctrl[1])
+        start = tail % self.size
+        end = min(start + min(head - tail, count), self.size)
+        recs = self.recs[start:end].tolist()
+        self.ctrl[1] = tail + len(recs)
+        return recs
+
+    def close(self, unlink=False):
+        del self.ctrl
+        del self.recs
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class Shard():
+
+    ##
+    ## A worker process of a sharded server. The ingest process routes
+    ## anchor messages over a SOCK_SEQPACKET pair as host NUL data: tag
+    ## traffic to the shard owning the tag, anchor traffic to every shard
+    ## so that each keeps the same TWR and geometry state. The worker has
+    ## its own Server, and hands its position updates back to the ingest
+    ## process, which publishes them to the clients.
+    ##
+    ## With cfg.shard_ring the ingest process decodes the frames itself
+    ## and passes TRX records through a TRXRing instead; the socket then
+    ## only carries a doorbell when the ring turns non-empty.
+    ##
+
+    def __init__(self, index):
+        self.index = index
+        self.ring = None
+        if cfg.shard_ring > 0:
+            self.ring = TRXRing(cfg.shard_ring)
+        (self.sock,remote) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.process = multiprocessing.get_context('fork').Process(target=Shard.run, args=(self,remote), daemon=True)
+        self.process.start()
+        remote.close()
+        self.sock.setblocking(False)
+        self.fd = self.sock.fileno()
+
+    def run(self, sock):
+        self.sock.close()
+        cfg.capture_file = None
+        ## Anchor ranging runs in shard 0 only. Its TWR averages are not
+        ## sent to the other shards: nothing reads them outside shard 0,
+        ## as lateration uses the surveyed distances in Geometry.dists.
+        if self.index > 0:
+            cfg.anchor_wakeup_timer = (None,None)
+        server = Server(cfg.anchor_addr, 0)
+        server.upstream = sock
+        server.configure(cfg.config)
+        dprint(1, 'Shard {} starting...', self.index)
+        try:
+            if self.ring:
+                self.run_ring(server, sock)
+            else:
+                while True:
+                    data = sock.recv(8192)
+                    if not data:
+                        break
+                    (host,_,data) = data.partition(b'\0')
+                    server.recv_anchor_data(data, (host.decode(),0,0,0))
+        except KeyboardInterrupt:
+            pass
+        server.stop()
+
+    def run_ring(self, server, sock):
+        ## A missed doorbell costs at most one poll timeout. Frames too
+        ## long for a ring slot still arrive on the socket.
+        poll = select.poll()
+        poll.register(sock, select.POLLIN)
+        while True:
+            if poll.poll(10):
+                data = sock.recv(8192)
+                if not data:
+                    break
+                if len(data) > 1:
+                    (host,_,data) = data.partition(b'\0')
+                    server.recv_anchor_data(data, (host.decode(),0,0,0))
+            while True:
+                recs = self.ring.get(256)
+                if not recs:
+                    break
+                for rec in recs:
+                    server.recv_anchor_record(rec)
+        self.ring.close()
+
+    def send(self, addr, data):
+        self.sock.send(addr[0].encode() + b'\0' + data)
+
+    def put(self, rec):
+        wake = self.ring.put(rec)
+        if wake is None:
+            return False
+        if wake:
+            try:
+                self.sock.send(b'\1')
+            except BlockingIOError:
+                pass
+        return True
+
+    def close(self):
+        if self.ring:
+            self.ring.close(unlink=True)
+        self.sock.close()
+
+
+class AnchorProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.recv_anchor_datagram(data, addr)
+
+    def error_received(self, err):
+        self.server.stats.count('anchor.error')
+
+
 class Server():
 
-    def __init__(self, addr=cfg.anchor_addr, port=cfg.anchor_port):
+    ##
+    ## Runs either a select.poll loop with timeouts on a Timer thread, or
+    ## with a loop given, everything on that asyncio event loop.
+    ##
+
+    def __init__(self, addr=cfg.anchor_addr, port=cfg.anchor_port, loop=None):
+        self.loop = loop
         self.laddr = (addr,port,0,0)
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -811,38 +1762,129 @@ class Server():
         self.sockets.register(self.sock, select.POLLIN)
         self.clients = {}
         self.cliefds = {}
+        self.dirty = collections.deque()
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        os.set_blocking(self.wakeup[1], False)
+        self.sockets.register(self.wakeup[0], select.POLLIN)
         self.tags = {}
+        self.zones = {}
+        self.frames = collections.OrderedDict()
+        self.geometry = Geometry()
         self.anchor_refs = {}
         self.anchor_keys = {}
         self.anchor_euis = {}
         self.anchor_twrs = {}
-        self.timer = Timer()
+        if loop is None:
+            self.timer = Timer(cfg.replay_file is None)
+        else:
+            self.timer = AsyncTimer(loop)
+        self.stats = Stats()
+        self.stats_timer = Timeout(self.timer, cfg.stats_interval, Server.stats_expire, (self,))
+        if cfg.stats_interval:
+            self.stats_timer.arm()
+        self.capture = None
+        if cfg.capture_file:
+            self.capture = Capture(cfg.capture_file, 'wb')
+        self.laterator = Laterator(self)
+        self.publisher = Publisher(self)
+        self.solver = HyperSolver()
+        self.nodes = []
+        self.upstream = None
+        self.shards = []
+        self.shardfds = {}
+        self.shard_map = {}
 
     def stop(self):
         self.timer.stop()
+        if self.capture:
+            self.capture.close()
+        for shard in self.shards:
+            shard.close()
+
+    def configure(self, config):
+        for arg in config.get('ANCHORS'):
+            self.add_anchor(arg)
+        for arg in config.get('TAGS'):
+            self.add_tag(arg)
+        for (name,box) in config.get('ZONES', {}).items():
+            self.add_zone(name, box)
+        if isinstance(cfg.force_beacon, str):
+            for anchor in self.anchor_keys.values():
+                if anchor.name == cfg.force_beacon:
+                    cfg.force_beacon = anchor
+                    break
+        if isinstance(cfg.force_common, str):
+            for anchor in self.anchor_keys.values():
+                if anchor.name == cfg.force_common:
+                    cfg.force_common = anchor
+                    break
+
+    def add_shards(self, shards):
+        ## Tags are dealt round-robin to the shards in config order
+        self.shards = shards
+        for shard in shards:
+            self.shardfds[shard.fd] = shard
+            if self.loop is None:
+                self.sockets.register(shard.fd, select.POLLIN)
+            else:
+                self.loop.add_reader(shard.fd, Server.recv_shard_msg, self, shard)
+        self.map_shards()
+
+    def rem_shard(self, shard):
+        ## The shard's tags move to the others; with none left, laterate here
+        eprint('Shard {} exited'.format(shard.index))
+        self.shards.remove(shard)
+        self.shardfds.pop(shard.fd)
+        if self.loop is None:
+            self.sockets.unregister(shard.fd)
+        else:
+            self.loop.remove_reader(shard.fd)
+        shard.sock.close()
+        self.map_shards()
+
+    def map_shards(self):
+        self.shard_map = {}
+        if self.shards:
+            for (index,arg) in enumerate(cfg.config.get('TAGS')):
+                self.shard_map[arg['eui']] = self.shards[index % len(self.shards)]
 
     def add_client(self, client):
         self.clients[client.key] = client
         self.cliefds[client.fd] = client
-        self.sockets.register(client.pipe.sock, select.POLLIN)
-        dprint(4, 'Server::add_client {}'.format(client.key))
+        if self.loop is None:
+            self.sockets.register(client.fd, select.POLLIN)
+        else:
+            self.loop.add_reader(client.fd, Server.recv_client_msg, self, client)
+        dprint(4, 'Server::add_client {}', client.key)
 
     def rem_client(self, client):
-        dprint(4, 'Server::rem_client {}'.format(client.key))
-        self.clients.pop(client.key)
-        self.cliefds.pop(client.fd)
-        self.sockets.unregister(client.pipe.sock)
+        dprint(4, 'Server::rem_client {}', client.key)
+        if self.clients.pop(client.key, None) is client:
+            self.cliefds.pop(client.fd)
+            if self.loop is None:
+                self.sockets.unregister(client.fd)
+            else:
+                self.loop.remove_reader(client.fd)
+                self.loop.remove_writer(client.fd)
+            client.pipe.close()
         
     def add_anchor(self, args):
-        dprint(4, 'Server::add_anchor {}'.format(args))
+        dprint(4, 'Server::add_anchor {}', args)
         anchor = Anchor(self, **args)
+        anchor.node = len(self.nodes)
+        self.nodes.append(anchor)
+        self.geometry.add(anchor)
         self.anchor_keys[anchor.key] = anchor
         self.anchor_euis[anchor.eui] = anchor
         if anchor.refok:
             self.anchor_refs[anchor.key] = anchor
+        if len(self.anchor_keys) > self.solver.size:
+            self.solver.resize(len(self.anchor_keys))
 
     def rem_anchor(self, anchor):
-        dprint(4, 'Server::rem_anchor {}'.format(anchor.key))
+        dprint(4, 'Server::rem_anchor {}', anchor.key)
+        self.geometry.remove(anchor)
         self.anchor_keys.pop(anchor.key, None)
         self.anchor_euis.pop(anchor.eui, None)
         self.anchor_refs.pop(anchor.key, None)
@@ -865,104 +1907,427 @@ class Server():
 
     def get_anchor_twr(self, anchor_a, anchor_b):
         key = (anchor_a,anchor_b)
-        dis = anchor_a.distance_to(anchor_b)
-        twr = dis
         if key in self.anchor_twrs:
-            twr = self.anchor_twrs[key].avg()
-        return twr
+            return self.anchor_twrs[key].avg()
+        return self.geometry.distance(anchor_a, anchor_b)
 
     def add_anchor_twr(self, anchor_a, anchor_b, distance):
         if -cfg.max_dist < distance < cfg.max_dist:
             key1 = (anchor_a,anchor_b)
             key2 = (anchor_b,anchor_a)
             if key1 not in self.anchor_twrs:
-                filt = GeoFilter(np.array(1), cfg.anchor_filter_len)
+                filt = GeoFilter(np.array(1.0), cfg.anchor_filter_len)
                 self.anchor_twrs[key1] = filt
                 self.anchor_twrs[key2] = filt
             self.anchor_twrs[key1].update(distance)
             avg = self.anchor_twrs[key1].avg()
-            dprint(3, 'add_anchor_twr: {}<>{} DIS:{:.3f} AVG:{:.3f}'.format(anchor_a.eui, anchor_b.eui, distance, avg))
+            dprint(3, 'add_anchor_twr: {}<>{} DIS:{:.3f} AVG:{:.3f}', anchor_a.eui, anchor_b.eui, distance, avg)
 
     def add_tag(self, args):
-        dprint(4, 'Server::add_tag {}'.format(args))
+        dprint(4, 'Server::add_tag {}', args)
         tag = Tag(self,**args)
+        tag.node = len(self.nodes)
+        self.nodes.append(tag)
         self.tags[tag.eui] = tag
         self.tags[tag.key] = tag
         
     def rem_tag(self, tag):
-        dprint(4, 'Server::rem_tag {}'.format(tag.key))
+        dprint(4, 'Server::rem_tag {}', tag.key)
         self.tags.pop(tag.eui, None)
         self.tags.pop(tag.key, None)
         
     def get_tag(self, key):
         return self.tags[key]
 
+    def add_zone(self, name, box):
+        dprint(4, 'Server::add_zone {} {}', name, box)
+        Subscription.box(box)
+        self.zones[name] = box
+
     def send_client_msg(self, **args):
-        for key in list(self.clients):
-            client = self.clients[key]
-            try:
-                client.sendmsg(**args)
-            except ConnectionError:
-                self.rem_client(client)
+        ## Encode once and queue for every client; sockets are written by the poll loop
+        start = time.perf_counter()
+        data = Client.encode(**args)
+        for client in list(self.clients.values()):
+            self.send_client(client, data, args.get('Tag'))
+        self.stats.time('fanout', time.perf_counter() - start)
+
+    def send_tag_msg(self, tag, **args):
+        ## As send_client_msg, but only to subscribed clients, encoding only if one matches
+        start = time.perf_counter()
+        data = None
+        coord = args['Coord']
+        now = clock.time()
+        for client in list(self.clients.values()):
+            if client.subscription is None or client.subscription.match(tag, coord, now):
+                if data is None:
+                    data = Client.encode(**args)
+                self.send_client(client, data, tag.eui)
+        self.stats.time('fanout', time.perf_counter() - start)
+
+    def send_tags_msg(self, entries):
+        ## One TAGS message per client; clients selecting the same tags share the encoding
+        start = time.perf_counter()
+        now = clock.time()
+        cache = {}
+        for client in list(self.clients.values()):
+            if client.subscription is None:
+                msgs = [ msg for (tag,msg) in entries ]
+            else:
+                msgs = [ msg for (tag,msg) in entries if client.subscription.match(tag, msg['Coord'], now) ]
+            if msgs:
+                key = tuple(msg['Tag'] for msg in msgs)
+                if key not in cache:
+                    cache[key] = Client.encode(Type='TAGS', Time=now, Tags=msgs)
+                self.send_client(client, cache[key])
+        self.stats.count('publish.tags', len(entries))
+        self.stats.time('fanout', time.perf_counter() - start)
+
+    def send_client(self, client, data, key=None):
+        ## Queue only; an idle client wakes the poll loop, which writes the
+        ## socket and watches POLLOUT while the queue is not drained.
+        try:
+            full = (client.pending() >= cfg.client_queue_len)
+            if client.push(data, key):
+                self.wake_client(client)
+            if full and not client.closing:
+                self.stats.count('client.' + cfg.client_overflow)
+        except ConnectionAbortedError:
+            self.stats.count('client.disconnect')
+            self.wake_client(client)
+
+    def wake_client(self, client):
+        self.dirty.append(client)
+        if self.loop is not None:
+            if len(self.dirty) == 1:
+                self.loop.call_soon(Server.recv_wakeup, self)
+            return
+        try:
+            os.write(self.wakeup[1], b'\0')
+        except BlockingIOError:
+            pass
+
+    def recv_wakeup(self):
+        try:
+            os.read(self.wakeup[0], 4096)
+        except BlockingIOError:
+            pass
+        while self.dirty:
+            self.send_client_data(self.dirty.popleft())
+
+    def send_client_data(self, client):
+        if client.closing:
+            self.rem_client(client)
+            return
+        try:
+            done = client.flush()
+        except OSError:
+            self.rem_client(client)
+            return
+        if done == client.polling:
+            self.poll_client(client, not done)
+
+    def poll_client(self, client, output):
+        ## Watch the client for writability while its queue is not drained
+        if self.loop is None:
+            self.sockets.modify(client.fd, (select.POLLIN | select.POLLOUT) if output else select.POLLIN)
+        elif output:
+            self.loop.add_writer(client.fd, Server.send_client_data, self, client)
+        else:
+            self.loop.remove_writer(client.fd)
+        client.polling = output
 
     def recv_anchor_frame(self,anchor,msg):
-        dprint(5, 'Server::recv_anchor_frame MSG:{}'.format(msg))
+        dprint(5, 'Server::recv_anchor_frame MSG:{}', msg)
         tinfo = msg['TSInfo']
-        frame = TailFrame(bytes.fromhex(msg['Frame']))
+        frame = self.decode_frame(msg['Frame'])
         src = self.get(msg['Src'])
-        if frame.tail_frmtype == 0:
-            src.add_blink(TRX(src,src,anchor,frame,tinfo))
-        elif frame.tail_frmtype == 3:
-            src.add_ranging(TRX(src,src,anchor,frame,tinfo))
-        elif frame.tail_frmtype == 1:
+        if frame.tail_frmtype == 1:
             ref = self.get(frame.tail_beacon.hex())
-            if frame.tail_subtype == 0:
-                ref.add_beacon(TRX(ref,src,anchor,frame,tinfo))
-            elif frame.tail_subtype == 1:
-                ref.add_beacon(TRX(ref,src,anchor,frame,tinfo), 0)
-            elif frame.tail_subtype == 2:
-                ref.add_beacon(TRX(ref,src,anchor,frame,tinfo), 1)
-            elif frame.tail_subtype == 3:
-                ref.add_beacon(TRX(ref,src,anchor,frame,tinfo), 2)
-                
+        else:
+            ref = src
+        self.recv_trx(TRX(ref,src,anchor,frame,tinfo), frame.tail_frmtype, frame.tail_subtype)
+
+    def decode_frame(self, data):
+        ## Every anchor that heard a transmission reports the same bytes;
+        ## decode once and share the frame between their TRXs
+        if cfg.frame_cache <= 0:
+            return TailFrame(data)
+        now = clock.time()
+        entry = self.frames.get(data)
+        if entry is not None:
+            if now - entry[1] < cfg.frame_cache_time:
+                self.stats.count('frame.cached')
+                return entry[0]
+            del self.frames[data]
+        frame = TailFrame(data)
+        self.stats.count('frame.decoded')
+        self.frames[data] = (frame,now)
+        if len(self.frames) > cfg.frame_cache:
+            self.expire_frames(now)
+        return frame
+
+    def expire_frames(self, now):
+        ## Insertion order is decode time order: drop the stale ones,
+        ## then the oldest until back under the bound
+        while self.frames:
+            (data,entry) = next(iter(self.frames.items()))
+            if now - entry[1] < cfg.frame_cache_time and len(self.frames) <= cfg.frame_cache:
+                break
+            del self.frames[data]
+
+    def recv_trx(self, trx, frmtype, subtype):
+        if frmtype == 0:
+            trx.origin.add_blink(trx)
+        elif frmtype == 3:
+            trx.origin.add_ranging(trx)
+        elif frmtype == 1:
+            if subtype == 0:
+                trx.origin.add_beacon(trx)
+            elif subtype in (1,2,3):
+                trx.origin.add_beacon(trx, subtype - 1)
+
+    def recv_anchor_record(self, rec):
+        try:
+            self.stats.count('anchor.msg')
+            self.recv_trx(TRX.from_record(self, rec), rec[3], rec[4])
+        except Exception as err:
+            self.stats.count('anchor.error')
+            errhandler('recv_anchor_record: Unable to process', err)
+
     def recv_anchor_msg(self):
+        (data,addr) = self.sock.recvfrom(4096)
+        self.recv_anchor_datagram(data, addr)
+
+    def recv_anchor_datagram(self, data, addr):
+        if self.capture:
+            self.capture.write(clock.time(), addr, data)
+        if self.shards:
+            self.route_anchor_data(data, addr)
+        else:
+            self.recv_anchor_data(data, addr)
+
+    def route_anchor_data(self, data, addr):
+        ## Tag frames go to the tag's shard, anchor frames to all
+        try:
+            self.stats.count('anchor.msg')
+            if AnchorMsg.is_binary(data):
+                msg = AnchorMsg.decode(data)
+            else:
+                msg = json.loads(data.decode())
+                if 'Frame' in msg:
+                    msg['Frame'] = bytes.fromhex(msg['Frame'])
+            if msg.get('Type') not in ('RX','TX'):
+                ## A shard would only reject it
+                self.stats.count('route.ignored')
+                return
+            (frmtype,subtype,_,beacon) = TailFrame.peek(msg['Frame'])
+            if frmtype == 1:
+                key = beacon
+            else:
+                key = msg['Src']
+            if key is None or key in self.anchor_euis:
+                shards = self.shards
+                self.stats.count('route.anchor')
+            elif key in self.shard_map:
+                shards = (self.shard_map[key],)
+                self.stats.count('route.tag')
+            else:
+                shards = (self.shards[zlib.crc32(key.encode()) % len(self.shards)],)
+                self.stats.count('route.unknown')
+            if cfg.shard_ring and frmtype is not None and len(msg['Frame']) <= TRXRing.FRAME:
+                src = self.get(msg['Src'])
+                ref = self.get(key) if frmtype == 1 else src
+                rec = TRX.record(ref, src, self.get_anchor(addr[0]), frmtype, subtype, msg['Frame'], msg['TSInfo'])
+                for shard in shards:
+                    if not shard.put(rec):
+                        self.stats.count('route.drop')
+            else:
+                if cfg.shard_ring:
+                    ## Not a tail frame, or too long for a ring slot: the shard decodes it
+                    self.stats.count('route.oversize' if frmtype is not None else 'route.other')
+                for shard in shards:
+                    try:
+                        shard.send(addr, data)
+                    except OSError:
+                        self.stats.count('route.drop')
+        except KeyError as err:
+            self.stats.count('anchor.unknown')
+        except Exception as err:
+            self.stats.count('anchor.error')
+            errhandler('route_anchor_data: Unable to decode', err)
+
+    def send_upstream(self, msg):
+        self.send_upstream_data(json.dumps(msg).encode())
+
+    def send_upstream_anchor(self, anchor, data):
+        self.send_upstream_data(b'\0' + anchor.eui.encode() + b'\0' + data)
+
+    def send_upstream_data(self, data):
+        ## With the ingest process gone, shut the socket down so that the
+        ## shard's receive loop ends and the shard exits
         try:
-            (data,addr) = self.sock.recvfrom(4096)
+            self.upstream.send(data)
+        except BlockingIOError:
+            self.stats.count('upstream.drop')
+        except OSError as err:
+            self.stats.count('upstream.error')
+            errhandler('send_upstream: Ingest process lost', err)
+            try:
+                self.upstream.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def recv_shard_msg(self, shard):
+        while True:
+            try:
+                data = shard.sock.recv(65536)
+            except BlockingIOError:
+                return
+            if not data:
+                self.rem_shard(shard)
+                return
+            if data[0] == 0:
+                (eui,_,data) = data[1:].partition(b'\0')
+                anchor = self.anchor_euis.get(eui.decode())
+                if anchor is not None:
+                    anchor.send(data)
+            else:
+                msg = json.loads(data)
+                self.publisher.publish(self.tags[msg['Tag']], msg)
+
+    def recv_anchor_data(self, data, addr):
+        try:
+            start = time.perf_counter()
+            self.stats.count('anchor.msg')
             anc = self.get_anchor(addr[0])
-            msg = json.loads(data.decode())
+            if AnchorMsg.is_binary(data):
+                msg = AnchorMsg.decode(data)
+                anc.binary_received()
+            else:
+                msg = json.loads(data.decode())
+                anc.json_received()
+                if 'Frame' in msg:
+                    msg['Frame'] = bytes.fromhex(msg['Frame'])
+            decoded = time.perf_counter()
+            self.stats.time('decode', decoded - start)
             if msg['Type'] in ('RX','TX'):
                 self.recv_anchor_frame(anc,msg)
+                self.stats.time('dispatch', time.perf_counter() - decoded)
             else:
                 raise ValueError
                 
         except KeyError as err:
-            pass
+            self.stats.count('anchor.unknown')
         except Exception as err:
+            self.stats.count('anchor.error')
             errhandler('recv_anchor_msg: Unable to decode', err)
 
+    def recv_client_msg(self, client):
+        try:
+            for msg in client.recvmsg():
+                if msg.get('Type') == 'STATS':
+                    self.send_client(client, Client.encode(Type='STATS', Stats=self.stats.report()))
+                    if msg.get('Reset'):
+                        self.stats.reset()
+                elif msg.get('Type') == 'TRACE':
+                    self.send_client(client, Client.encode(Type='TRACE', Trace=Trace.lines()))
+                elif msg.get('Type') == 'SUBSCRIBE':
+                    self.recv_subscribe(client, msg)
+        except ConnectionError:
+            self.rem_client(client)
+
+    def recv_subscribe(self, client, msg):
+        try:
+            sub = Subscription(self, msg)
+        except (KeyError,ValueError,TypeError) as err:
+            self.send_client(client, Client.encode(Type='ERROR', Error='SUBSCRIBE: {}'.format(err)))
+            return
+        client.subscription = sub if sub.spec else None
+        self.send_client(client, Client.encode(Type='SUBSCRIBE', Filter=sub.spec))
+
+    def stats_expire(self):
+        self.stats_timer.arm()
+        eprint(self.stats.dump())
+
             
-    def socket_loop(self):
+    def socket_listen(self):
+        self.tpipe = TCPTailPipe()
+        self.tpipe.listen(cfg.server_addr, cfg.server_port)
+        if self.loop is None:
+            self.sockets.register(self.tpipe.sock, select.POLLIN)
+        else:
+            self.loop.add_reader(self.tpipe.sock, Server.accept_client, self)
 
-        tpipe = TCPTailPipe()
-        tpipe.listen(cfg.server_addr, cfg.server_port)
-    
-        self.sockets.register(tpipe.sock, select.POLLIN)
+    def accept_client(self):
+        self.add_client(Client(self.tpipe.accept()))
+
+    def socket_poll(self, timeout):
+        for (fd,flags) in self.sockets.poll(timeout):
+            try:
+                if flags & select.POLLIN:
+                    if fd == self.sock.fileno():
+                        self.recv_anchor_msg()
+                    elif fd == self.wakeup[0]:
+                        self.recv_wakeup()
+                    elif fd == self.tpipe.sock.fileno():
+                        self.accept_client()
+                    elif fd in self.cliefds:
+                        self.recv_client_msg(self.cliefds[fd])
+                    elif fd in self.shardfds:
+                        self.recv_shard_msg(self.shardfds[fd])
+                if flags & select.POLLOUT:
+                    if fd in self.cliefds:
+                        self.send_client_data(self.cliefds[fd])
+                if flags & (select.POLLHUP | select.POLLERR):
+                    if fd in self.cliefds:
+                        self.rem_client(self.cliefds[fd])
+
+            except (KeyError,ValueError) as err:
+                errhandler('socket_loop', err)
 
+    def socket_loop(self):
+        self.socket_listen()
         while True:
-            for (fd,flags) in self.sockets.poll(1000):
-                try:
-                    if flags & select.POLLIN:
-                        if fd == self.sock.fileno():
-                            self.recv_anchor_msg()
-                        elif fd == tpipe.sock.fileno():
-                            self.add_client(Client(tpipe.accept()))
-                        elif fd in self.cliefds:
-                            self.cliefds[fd].recvmsg()
-                        
-                except (KeyError,ValueError) as err:
-                    errhandler('socket_loop', err)
-        
-        socks.unregister(tpipe.sock)
+            self.socket_poll(1000)
+
+    def async_loop(self):
+        ## Anchors on a datagram endpoint, clients on reader/writer callbacks
+        self.sockets.unregister(self.sock)
+        self.socket_listen()
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: AnchorProtocol(self), sock=self.sock))
+        self.loop.run_forever()
+
+    def replay_loop(self, capture, speed):
+        ## Live anchor traffic is ignored; clients are still served
+        self.sockets.unregister(self.sock)
+        self.socket_listen()
+        count = 0
+        start = time.time()
+        first = None
+        while True:
+            rec = capture.read()
+            if rec is None:
+                break
+            (now,addr,data) = rec
+            if first is None:
+                first = now
+            while speed > 0:
+                delay = (now - first) / speed - (time.time() - start)
+                if delay <= 0:
+                    break
+                self.socket_poll(int(min(delay, 0.010) * 1000))
+                self.timer.run_until(min(now, first + (time.time() - start) * speed))
+            if speed <= 0 and count % 100 == 0:
+                self.socket_poll(0)
+            self.timer.run_until(now)
+            self.recv_anchor_data(data, addr)
+            count += 1
+        if first is not None:
+            self.timer.run_until(clock.time() + 1.0)
+            secs = time.time() - start
+            span = clock.time() - first
+            dprint(1, 'Replayed {} messages, {:.3f}s in {:.3f}s ({:.1f}x)', count, span, secs, span/max(secs,1E-9))
 
 
 def main():
@@ -976,6 +2341,18 @@ def main():
     parser.add_argument('--force-common', type=str, default=None)
     parser.add_argument('--random-beacon', action='store_true', default=False)
     parser.add_argument('--random-common', action='store_true', default=False)
+    parser.add_argument('--schedule', action='store_true', default=False, help='anchors run the ranging beacon sequence')
+    parser.add_argument('--stats', type=float, default=None, help='stats dump interval')
+    parser.add_argument('--publish', type=float, default=None, help='publish interval, 0 for every fix')
+    parser.add_argument('--capture', type=str, default=None)
+    parser.add_argument('--replay', type=str, default=None)
+    parser.add_argument('--speed', type=float, default=None, help='replay speed, 0 for max')
+    parser.add_argument('--workers', type=int, default=None, help='laterate in N shard processes')
+    parser.add_argument('--ring', type=int, default=None, help='decode in the ingest process, pass shards N-record rings')
+    parser.add_argument('--frame-cache', type=int, default=None, help='decoded frame cache size, 0 to disable')
+    parser.add_argument('--asyncio', action='store_true', default=False, help='run on an asyncio event loop')
+    parser.add_argument('--trace-ring', type=int, default=None, help='trace ring buffer size')
+    parser.add_argument('--trace-level', type=int, default=None, help='trace ring buffer level')
     
     args = parser.parse_args()
 
@@ -1011,32 +2388,76 @@ def main():
         cfg.random_beacon = args.random_beacon
     if args.random_common:
         cfg.random_common = args.random_common
+    if args.schedule:
+        cfg.anchor_schedule = args.schedule
+    if args.stats is not None:
+        cfg.stats_interval = args.stats
+    if args.publish is not None:
+        cfg.publish_interval = args.publish
+    if args.capture:
+        cfg.capture_file = args.capture
+    if args.replay:
+        cfg.replay_file = args.replay
+    if args.speed is not None:
+        cfg.replay_speed = args.speed
+    if args.trace_ring is not None:
+        cfg.trace_ring = args.trace_ring
+    if args.asyncio:
+        cfg.event_loop = 'asyncio'
+    if args.frame_cache is not None:
+        cfg.frame_cache = args.frame_cache
+    if args.workers is not None:
+        cfg.workers = args.workers
+    if args.ring is not None:
+        cfg.shard_ring = args.ring
+    if args.trace_level is not None:
+        cfg.trace_level = args.trace_level
+
+    if cfg.replay_file:
+        capture = Capture(cfg.replay_file)
+        first = capture.peek()
+        if first is not None:
+            clock.set(first[0])
+        random.seed(0)
 
     WPANFrame.verbosity = max((0, cfg.debug - 1))
 
-    server = Server()
+    Trace.config(cfg.debug, cfg.trace_ring, cfg.trace_level)
 
-    for arg in cfg.config.get('ANCHORS'):
-        server.add_anchor(arg)
+    if cfg.trace_ring:
+        signal.signal(signal.SIGUSR1, lambda signum,frame: Trace.dump())
 
-    for arg in cfg.config.get('TAGS'):
-        server.add_tag(arg)
+    ## Fork the shards before the server starts any threads
+    shards = []
+    if cfg.workers > 0 and not cfg.replay_file:
+        shards = [ Shard(index) for index in range(cfg.workers) ]
 
-    if cfg.force_beacon:
-        for (key,anchor) in server.anchor_keys.items():
-            if anchor.name == cfg.force_beacon:
-                cfg.force_beacon = anchor
-                break
-    if cfg.force_common:
-        for (key,anchor) in server.anchor_keys.items():
-            if anchor.name == cfg.force_common:
-                cfg.force_common = anchor
-                break
+    loop = None
+    if cfg.event_loop == 'asyncio' and not cfg.replay_file:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    ## Anchor ranging runs in shard 0 only (see Shard.run)
+    if shards:
+        cfg.anchor_wakeup_timer = (None,None)
+
+    server = Server(cfg.anchor_addr, cfg.anchor_port, loop)
+
+    server.configure(cfg.config)
+
+    if shards:
+        server.add_shards(shards)
     
     dprint(1, 'Tail RTLS daemon starting...')
 
     try:
-        server.socket_loop()
+        if cfg.replay_file:
+            server.replay_loop(capture, cfg.replay_speed)
+            server.stop()
+        elif loop:
+            server.async_loop()
+        else:
+            server.socket_loop()
 
     except KeyboardInterrupt:
         server.stop()
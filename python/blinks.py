@@ -514,7 +514,6 @@ class Blinks():
         self.bid = 1
         self.blinks = {}
         self.timer = Timer()
-        self.verbose = 0
         rpc.register('TX', self.handle_blink)
         rpc.register('RX', self.handle_blink)
 
@@ -638,16 +637,15 @@ class Blinks():
                 with self.blinks[missing]['wait']:
                     self.blinks[missing]['wait'].wait(delay)
             delay = (until - time.time()) / 2
-        if self.verbose > 0:
+        if Trace.limit > 0:
             for bid in bids:
                 for anc in ancs:
                     if anc.eui not in self.blinks[bid]['anchors']:
-                        eprint(f'wait_blinks: ID:{bid} ANCHORS:{anc.name} missing')
+                        dprint(1, 'wait_blinks: ID:{} ANCHORS:{} missing', bid, anc.name)
         
 
     def handle_blink(self,data):
-        if self.verbose > 1:
-            eprint(f'handle_blink: {data}')
+        dprint(2, 'handle_blink: {}', data)
         eui = data.get('Anchor')
         src = data.get('Src')
         tms = data.get('Times')
@@ -12,6 +12,7 @@ import struct
 import socket
 import netifaces
 import traceback
+import collections
 
 from ctypes import *
 
@@ -33,6 +34,80 @@ def errhandler(msg,err):
     eprint('\n*** EXCEPTION {}:\n{}***\n'.format(msg,traceback.format_exc()))
 
 
+##
+## Debug tracing
+##
+## dprint(level, fmt, *args) only formats when the message is printed,
+## and returns at once when the level is above both the print and the
+## ring buffer thresholds. Expensive arguments can be wrapped as
+## Lazy(func, *args) so that the call is deferred as well.
+##
+## The optional ring buffer keeps the last N trace records unformatted,
+## as (time,level,fmt,args) tuples; they are rendered by Trace.dump().
+## Lazy arguments in the ring are evaluated at dump time.
+##
+
+class Lazy:
+
+    __slots__ = ('func','args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __format__(self, spec):
+        return format(self.func(*self.args), spec)
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class Trace:
+
+    level      = 0
+    limit      = 0
+    ring       = None
+    ring_level = 0
+
+    def config(level=None, ring_size=None, ring_level=None):
+        if level is not None:
+            Trace.level = level
+        if ring_size is not None:
+            Trace.ring = collections.deque(maxlen=ring_size) if ring_size > 0 else None
+        if ring_level is not None:
+            Trace.ring_level = ring_level
+        if Trace.ring is None:
+            Trace.limit = Trace.level
+        else:
+            Trace.limit = max(Trace.level, Trace.ring_level)
+
+    def format(when, level, fmt, args):
+        try:
+            text = fmt.format(*args) if args else fmt
+        except Exception as err:
+            text = '{} {} <{}>'.format(fmt, args, err)
+        return '{:.6f} [{}] {}'.format(when, level, text)
+
+    def lines():
+        if Trace.ring is None:
+            return []
+        return [ Trace.format(*rec) for rec in list(Trace.ring) ]
+
+    def dump(file=sys.stderr):
+        for line in Trace.lines():
+            print(line, file=file)
+        file.flush()
+
+
+def dprint(level, fmt, *args):
+    if level > Trace.limit:
+        return
+    if level <= Trace.level:
+        print(fmt.format(*args) if args else fmt, file=sys.stderr, flush=True)
+    if Trace.ring is not None and level <= Trace.ring_level:
+        Trace.ring.append((time.time(), level, fmt, args))
+
+
 
 ##
 ## Network pipe for transferring json messages
@@ -70,13 +145,22 @@ class TailPipe:
 
 class TCPTailPipe(TailPipe):
 
+    ##
+    ## Messages are separated by 0x1f. Data is received straight into a
+    ## bytearray; buff[head:tail] is the unconsumed part. Each fill splits
+    ## off all complete messages into a queue, so only a trailing partial
+    ## message is ever moved, and only when the free space runs low.
+    ##
+
+    RECV_SIZE = 65536
+
     def __init__(self,sock=None):
         TailPipe.__init__(self,sock)
         if self.sock is None:
             self.sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.buff = b''
+        self.clear()
         
     def getsaddr(host,port):
         return TailPipe.getsaddr(host,port,socket.SOCK_STREAM)
@@ -86,7 +170,10 @@ class TCPTailPipe(TailPipe):
         self.clear()
 
     def clear(self):
-        self.buff = b''
+        self.buff = bytearray(TCPTailPipe.RECV_SIZE)
+        self.head = 0
+        self.tail = 0
+        self.msgs = collections.deque()
 
     def recvraw(self):
         data = self.sock.recv(4096)
@@ -95,25 +182,48 @@ class TCPTailPipe(TailPipe):
         return data
 
     def fillbuf(self):
-        self.buff += self.recvraw()
+        ## One recv; returns the number of complete messages it yielded
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif len(self.buff) - self.tail < TCPTailPipe.RECV_SIZE // 4:
+            size = self.tail - self.head
+            self.buff[0:size] = self.buff[self.head:self.tail]
+            self.head = 0
+            self.tail = size
+        if len(self.buff) - self.tail < TCPTailPipe.RECV_SIZE // 4:
+            self.buff.extend(bytes(len(self.buff)))
+        with memoryview(self.buff) as view:
+            cnt = self.sock.recv_into(view[self.tail:])
+            if cnt < 1:
+                raise ConnectionResetError
+            scan = self.tail
+            self.tail += cnt
+            return self.split(view, scan)
+
+    def split(self, view, scan):
+        count = 0
+        eom = self.buff.find(31, scan, self.tail)
+        while eom >= 0:
+            if eom > self.head:
+                self.msgs.append(str(view[self.head:eom], 'utf-8'))
+                count += 1
+            self.head = eom + 1
+            eom = self.buff.find(31, self.head, self.tail)
+        return count
 
-    def stripbuf(self):
-        while len(self.buff) > 0 and self.buff[0] == 31:
-            self.buff = self.buff[1:]
-    
     def hasmsg(self):
-        self.stripbuf()
-        return (self.buff.find(31) > 0)
+        return bool(self.msgs)
 
     def getmsg(self):
-        self.stripbuf()
-        eom = self.buff.find(31)
-        if eom > 0:
-            msg = self.buff[0:eom]
-            self.buff = self.buff[eom+1:]
-            return msg.decode()
+        if self.msgs:
+            return self.msgs.popleft()
         return None
 
+    def getmsgs(self):
+        msgs = list(self.msgs)
+        self.msgs.clear()
+        return msgs
+
     def getmsgfrom(self):
         return (self.getmsg(),self.remote)
     
@@ -161,7 +271,7 @@ class UDPTailPipe(TailPipe):
         if self.sock is None:
             self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.buff = []
+        self.buff = collections.deque()
 
     def getsaddr(host,port):
         return TailPipe.getsaddr(host,port,socket.SOCK_DGRAM)
@@ -177,7 +287,7 @@ class UDPTailPipe(TailPipe):
         self.clear()
 
     def clear(self):
-        self.buff = []
+        self.buff = collections.deque()
 
     def recvraw(self):
         (data,addr) = self.sock.recvfrom(4096)
@@ -187,19 +297,25 @@ class UDPTailPipe(TailPipe):
 
     def fillbuf(self):
         self.buff.append(self.recvraw())
+        return 1
 
     def hasmsg(self):
         return bool(self.buff)
 
     def getmsg(self):
         if self.hasmsg():
-            (data,addr) = self.buff.pop(0)
+            (data,addr) = self.buff.popleft()
             return data.decode()
         return None
     
+    def getmsgs(self):
+        msgs = [ data.decode() for (data,addr) in self.buff ]
+        self.buff.clear()
+        return msgs
+
     def getmsgfrom(self):
         if self.hasmsg():
-            (data,addr) = self.buff.pop(0)
+            (data,addr) = self.buff.popleft()
             return (data.decode(),addr)
         return None
     
@@ -213,6 +329,9 @@ class UDPTailPipe(TailPipe):
             self.fillbuf()
         return self.getmsgfrom()
 
+    def sendraw(self,data):
+        self.sock.sendto(data,self.remote)
+
     def sendmsg(self,data):
         self.sock.sendto(data.encode(),self.remote)
 
@@ -394,12 +513,105 @@ class Timestamp(Structure):
         return ret
 
 
+##
+## Binary anchor messages
+##
+## Fixed layout alternative to the JSON RX/TX messages, little endian:
+##   magic:B version:B type:B flags:B anchor:8s src:8s
+##   swts:Q hwts:Q hires_nsec:Q hires_frac:I
+##   TimestampInfo fields
+##   raw frame bytes
+##
+## The magic byte is never '{', so JSON and binary can share a socket.
+##
+
+class AnchorMsg:
+
+    MAGIC   = 0xa7
+    VERSION = 2
+
+    TYPES = { 'RX':1, 'TX':2, 'BEACON':3 }
+    NAMES = { 1:'RX', 2:'TX', 3:'BEACON' }
+
+    FLAG_SRC   = 0x01
+    FLAG_TIMES = 0x02
+
+    HEADER = struct.Struct('<BBBB8s8sQQQI')
+    TSINFO = struct.Struct('<QHHHHHHHHHIIIIhh')
+    BEACON = struct.Struct('<BBBBBB8s8s')
+    TSKEYS = tuple(x[0] for x in TimestampInfo._fields_)
+
+    def is_binary(data):
+        return (len(data) > 0 and data[0] == AnchorMsg.MAGIC)
+
+    def encode(Type, Anchor, Src, Times, TSInfo, Frame):
+        flags = 0
+        src = bytes(8)
+        if Src is not None:
+            flags |= AnchorMsg.FLAG_SRC
+            src = bytes.fromhex(Src)
+        swts = hwts = hires = 0
+        if Times['hires'] is not None:
+            flags |= AnchorMsg.FLAG_TIMES
+            swts = Times['swts']
+            hwts = Times['hwts']
+            hires = Times['hires']
+        head = AnchorMsg.HEADER.pack(AnchorMsg.MAGIC, AnchorMsg.VERSION, AnchorMsg.TYPES[Type], flags,
+                                     bytes.fromhex(Anchor), src, swts, hwts, hires >> 32, hires & 0xffffffff)
+        tsinfo = AnchorMsg.TSINFO.pack(*[ TSInfo[key] for key in AnchorMsg.TSKEYS ])
+        return head + tsinfo + Frame
+
+    def encode_beacon(Beacon, SubType=0, Flags=0, Dst=0xffff):
+        ## Server to anchor: transmit a beacon, 2 or 8 byte destination
+        if isinstance(Dst,str):
+            (mode,dst) = (WPANFrame.ADDR_EUI64, bytes.fromhex(Dst))
+        else:
+            (mode,dst) = (WPANFrame.ADDR_SHORT, WPANFrame.U16.pack(Dst))
+        return AnchorMsg.BEACON.pack(AnchorMsg.MAGIC, AnchorMsg.VERSION, AnchorMsg.TYPES['BEACON'],
+                                     SubType, Flags, mode, bytes.fromhex(Beacon), dst)
+
+    def decode(data):
+        if len(data) > 2 and data[2] == AnchorMsg.TYPES['BEACON']:
+            return AnchorMsg.decode_beacon(data)
+        (magic,version,mtype,flags,anc,src,swts,hwts,hrns,hrfr) = AnchorMsg.HEADER.unpack_from(data,0)
+        if magic != AnchorMsg.MAGIC or version != AnchorMsg.VERSION:
+            raise ValueError('Invalid anchor message magic:{} version:{}'.format(magic,version))
+        ptr = AnchorMsg.HEADER.size
+        tsinfo = dict(zip(AnchorMsg.TSKEYS, AnchorMsg.TSINFO.unpack_from(data,ptr)))
+        ptr += AnchorMsg.TSINFO.size
+        if flags & AnchorMsg.FLAG_TIMES:
+            times = { 'swts': swts, 'hwts': hwts, 'hires': (hrns << 32) | hrfr }
+        else:
+            times = { 'swts': None, 'hwts': None, 'hires': None }
+        if flags & AnchorMsg.FLAG_SRC:
+            src = src.hex()
+        else:
+            src = None
+        return { 'Type':AnchorMsg.NAMES[mtype], 'Anchor':anc.hex(), 'Src':src, 'Times':times, 'TSInfo':tsinfo, 'Frame':data[ptr:] }
+
+    def decode_beacon(data):
+        (magic,version,mtype,sub,flags,mode,ref,dst) = AnchorMsg.BEACON.unpack_from(data,0)
+        if magic != AnchorMsg.MAGIC or version != AnchorMsg.VERSION:
+            raise ValueError('Invalid anchor message magic:{} version:{}'.format(magic,version))
+        if mode == WPANFrame.ADDR_EUI64:
+            dst = dst.hex()
+        else:
+            (dst,) = WPANFrame.U16.unpack_from(dst,0)
+        return { 'Type':'BEACON', 'Beacon':ref.hex(), 'SubType':sub, 'Flags':flags, 'Dst':dst }
+
+
 ##
 ## Support functions
 ##
 
 def byteswap(data):
-    return bytes(reversed(tuple(data)))
+    return bytes(data[::-1])
+
+def swapfrom(data,ptr,size):
+    ## byteswap(data[ptr:ptr+size]) as a single slice, without the intermediate copy
+    if ptr + size > len(data):
+        raise struct.error('{} bytes at {} beyond end of frame'.format(size,ptr))
+    return data[ptr+size-1:ptr-1:-1] if ptr else data[size-1::-1]
 
 def bit(pos):
     return (1<<pos)
@@ -413,6 +625,31 @@ def getbits(data,pos,cnt):
 def makebits(data,pos,cnt):
     return (data & ((1<<cnt)-1)) << pos
 
+def lazyattr(name):
+    ## Frame attribute stored as name, decoded on first access
+    def get(self):
+        if self.tail_lazy is not None:
+            self.decode_lazy()
+        return getattr(self,name)
+    def set(self,value):
+        if self.tail_lazy is not None:
+            self.decode_lazy()
+        setattr(self,name,value)
+    return property(get,set)
+
+def swapattr(name,mode):
+    ## Frame address stored as name; decode leaves its offset, swapped on first access
+    def get(self):
+        addr = getattr(self,name)
+        if type(addr) is int:
+            size = 8 if getattr(self,mode) == WPANFrame.ADDR_EUI64 else 2
+            addr = swapfrom(self.frame,addr,size)
+            setattr(self,name,addr)
+        return addr
+    def set(self,value):
+        setattr(self,name,value)
+    return property(get,set)
+
 
 
 ##
@@ -421,6 +658,15 @@ def makebits(data,pos,cnt):
 
 class WPANFrame:
 
+    U8      = struct.Struct('<B')
+    U16     = struct.Struct('<H')
+    U32     = struct.Struct('<I')
+    U64     = struct.Struct('<Q')
+    U16U8   = struct.Struct('<HB')
+    BYTES16 = struct.Struct('16s')
+    TS40    = struct.Struct('5s')
+    RXINFO  = struct.Struct('<4H')
+
     DSN = 0
     
     ADDR_NONE  = 0
@@ -431,6 +677,9 @@ class WPANFrame:
     if_short   = None
 
     verbosity  = 0
+
+    src_addr   = swapattr('_src_addr','src_mode')
+    dst_addr   = swapattr('_dst_addr','dst_mode')
     
     def __init__(self, data=None, ancl=None):
         self.timestamp      = None
@@ -447,11 +696,11 @@ class WPANFrame:
         self.panid_comp     = True
         
         self.dst_mode       = 0
-        self.dst_addr       = None
+        self._dst_addr      = None
         self.dst_panid      = 0xffff
         
         self.src_mode       = 0
-        self.src_addr       = None
+        self._src_addr      = None
         self.src_panid      = 0xffff
 
         if data is not None:
@@ -576,7 +825,7 @@ class WPANFrame:
         ptr = 0
         self.frame = data
         self.frame_len = len(data)
-        (fc,sq) = struct.unpack_from('<HB',data,ptr)
+        (fc,sq) = WPANFrame.U16U8.unpack_from(data,ptr)
         ptr += 3
         self.frame_control = fc
         self.frame_seqnum = sq
@@ -589,38 +838,36 @@ class WPANFrame:
         self.src_mode = getbits(fc,14,2)
         self.panid_comp = testbit(fc,6)
         if self.dst_mode != 0:
-            (panid,) = struct.unpack_from('<H',data,ptr)
+            (panid,) = WPANFrame.U16.unpack_from(data,ptr)
             self.dst_panid = panid
             ptr += 2
             if self.dst_mode == self.ADDR_SHORT:
-                (addr,) = struct.unpack_from('2s',data,ptr)
-                self.dst_addr = byteswap(addr)
+                self._dst_addr = ptr
                 ptr += 2
             elif self.dst_mode == self.ADDR_EUI64:
-                (addr,) = struct.unpack_from('8s',data,ptr)
-                self.dst_addr = byteswap(addr)
+                self._dst_addr = ptr
                 ptr += 8
         else:
             self.dst_panid = None
-            self.dst_addr  = None
+            self._dst_addr = None
         if self.src_mode != 0:
             if self.panid_comp:
                 self.src_panid = self.dst_panid
             else:
-                (panid,) = struct.unpack_from('<H',data,ptr)
+                (panid,) = WPANFrame.U16.unpack_from(data,ptr)
                 self.src_panid = panid
                 ptr += 2
             if self.src_mode == self.ADDR_SHORT:
-                (addr,) = struct.unpack_from('2s',data,ptr)
-                self.src_addr = byteswap(addr)
+                self._src_addr = ptr
                 ptr += 2
             elif self.src_mode == self.ADDR_EUI64:
-                (addr,) = struct.unpack_from('8s',data,ptr)
-                self.src_addr = byteswap(addr)
+                self._src_addr = ptr
                 ptr += 8
         else:
             self.src_panid = None
-            self.src_addr  = None
+            self._src_addr = None
+        if ptr > len(data):
+            raise struct.error('WPAN header beyond end of frame')
         if self.security:
             raise NotImplementedError('decode WPAN security')
         self.header_len = ptr
@@ -732,8 +979,17 @@ class TailFrame(WPANFrame):
         0x40 : lambda x: round(x*5/32768, 3),
     }
 
+    ## Cookies, IEs and rx time tables are only decoded when asked for
+    tail_cookie  = lazyattr('_tail_cookie')
+    tail_ies     = lazyattr('_tail_ies')
+    tail_rxtime  = lazyattr('_tail_rxtime')
+    tail_rxtimes = lazyattr('_tail_rxtimes')
+    tail_rxinfo  = lazyattr('_tail_rxinfo')
+    tail_rxinfos = lazyattr('_tail_rxinfos')
+
     def __init__(self, data=None, ancl=None, protocol=0):
         WPANFrame.__init__(self)
+        self.tail_lazy      = None
         self.tail_protocol  = protocol
         self.tail_payload   = None
         self.tail_listen    = False
@@ -762,9 +1018,37 @@ class TailFrame(WPANFrame):
         if ancl is not None:
             self.decode_ancl(ancl)
             
+    def peek(data):
+        ## Header-only look at a frame: (frame type, subtype, source EUI,
+        ## beacon ref), None where absent, without building a TailFrame
+        (fc,) = WPANFrame.U16.unpack_from(data,0)
+        ptr = 3
+        dst_mode = getbits(fc,10,2)
+        src_mode = getbits(fc,14,2)
+        if dst_mode == WPANFrame.ADDR_SHORT:
+            ptr += 4
+        elif dst_mode == WPANFrame.ADDR_EUI64:
+            ptr += 10
+        src = None
+        if src_mode != 0:
+            if not testbit(fc,6):
+                ptr += 2
+            if src_mode == WPANFrame.ADDR_EUI64:
+                src = swapfrom(data,ptr,8).hex()
+                ptr += 8
+            elif src_mode == WPANFrame.ADDR_SHORT:
+                ptr += 2
+        if len(data) < ptr + 2 or data[ptr] != TailFrame.PROTO_1:
+            return (None,None,src,None)
+        frmtype = getbits(data[ptr+1],4,4)
+        subtype = getbits(data[ptr+1],0,4)
+        beacon = None
+        if frmtype == 1:
+            beacon = swapfrom(data,ptr+3,8).hex()
+        return (frmtype,subtype,src,beacon)
+
     def tsdecode(data):
-        times = struct.unpack_from('<Q', data.ljust(8, b'\0'))[0]
-        return times
+        return int.from_bytes(data, 'little')
 
     def tsencode(times):
         data = struct.pack('<Q',times)[0:5]
@@ -772,11 +1056,11 @@ class TailFrame(WPANFrame):
 
     def decode(self,data):
         ptr = WPANFrame.decode(self,data)
-        (magic,) = struct.unpack_from('<B',data,ptr)
+        (magic,) = WPANFrame.U8.unpack_from(data,ptr)
         ptr += 1
         if magic == TailFrame.PROTO_1:
             self.tail_protocol = 1
-            (frame,) = struct.unpack_from('<B',data,ptr)
+            (frame,) = WPANFrame.U8.unpack_from(data,ptr)
             ptr += 1
             self.tail_frmtype = getbits(frame,4,4)
             self.tail_subtype = getbits(frame,0,4)
@@ -784,119 +1068,70 @@ class TailFrame(WPANFrame):
                 self.tail_eies_present   = testbit(frame,1)
                 self.tail_ies_present    = testbit(frame,2)
                 self.tail_cookie_present = testbit(frame,3)
-                (flags,) = struct.unpack_from('<B',data,ptr)
+                (flags,) = WPANFrame.U8.unpack_from(data,ptr)
                 ptr += 1
                 self.tail_flags  = flags
                 self.tail_listen = testbit(flags,7)
                 self.tail_accel  = testbit(flags,6)
                 self.tail_dcin   = testbit(flags,5)
                 self.tail_salt   = testbit(flags,4)
-                if self.tail_cookie_present:
-                    (cookie,) = struct.unpack_from('16s',data,ptr)
-                    ptr += 16
-                    self.tail_cookie = cookie
-                if self.tail_ies_present:
-                    (iec,) = struct.unpack_from('<B',data,ptr)
-                    ptr += 1
-                    self.tail_ies = {}
-                    for i in range(iec):
-                        (id,) = struct.unpack_from('<B',data,ptr)
-                        ptr += 1
-                        idf = getbits(id,6,2)
-                        if idf == 0:
-                            (val,) = struct.unpack_from('<B',data,ptr)
-                            ptr += 1
-                        elif idf == 1:
-                            (val,) = struct.unpack_from('<H',data,ptr)
-                            ptr += 2
-                        elif idf == 2:
-                            (val,) = struct.unpack_from('<I',data,ptr)
-                            ptr += 4
-                        else:
-                            (val,) = struct.unpack_from('<p',data,ptr)
-                            ptr += len(val) + 1
-                        if id in TailFrame.IE_CONV:
-                            val = TailFrame.IE_CONV[id](val)
-                        if id in TailFrame.IE_KEYS:
-                            self.tail_ies[TailFrame.IE_KEYS[id]] = val
-                        else:
-                            self.tail_ies['IE{:02X}'.format(id)] = val
+                if self.tail_cookie_present or self.tail_ies_present:
+                    self.tail_lazy = (TailFrame.decode_blink_ies, data, ptr)
                 if self.tail_eies_present:
                     raise NotImplementedError('decode tail EIEs')
             elif self.tail_frmtype == 1:
-                (flags,) = struct.unpack_from('<B',data,ptr)
+                (flags,) = WPANFrame.U8.unpack_from(data,ptr)
                 ptr += 1
                 self.tail_flags = flags
-                (id,) = struct.unpack_from('8s',data,ptr)
-                self.tail_beacon = byteswap(id)
+                self.tail_beacon = swapfrom(data,ptr,8)
                 ptr += 8
             elif self.tail_frmtype == 2:
                 pass
                 ## TBD
             elif self.tail_frmtype == 3:
                 self.tail_owr = testbit(self.tail_subtype,3)
-                (txtime,) = struct.unpack_from('5s',data,ptr)
+                (txtime,) = WPANFrame.TS40.unpack_from(data,ptr)
                 ptr += 5
                 self.tail_txtime = TailFrame.tsdecode(txtime)
                 if not self.tail_owr:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
-                    ptr += 1
-                    bits = 0
-                    self.tail_rxtimes = {}
-                    for i in range(0,cnt,8):
-                        (val,) = struct.unpack_from('<B',data,ptr)
-                        ptr += 1
-                        bits |= val << i
-                    for i in range(cnt):
-                        if testbit(bits,i):
-                            (addr,) = struct.unpack_from('8s',data,ptr)
-                            ptr += 8
-                        else:
-                            (addr,) = struct.unpack_from('2s',data,ptr)
-                            ptr += 2
-                        (rxdata,) = struct.unpack_from('5s',data,ptr)
-                        ptr += 5
-                        rxtime = TailFrame.tsdecode(rxdata)
-                        self.tail_rxtimes[byteswap(addr)] = rxtime
-                        if WPANFrame.match_if(byteswap(addr)):
-                            self.tail_rxtime = rxtime
+                    self.tail_lazy = (TailFrame.decode_rxtables, data, ptr)
             elif self.tail_frmtype == 4:
                 if self.tail_subtype == 0:
-                    (magic,) = struct.unpack_from('<H',data,ptr)
+                    (magic,) = WPANFrame.U16.unpack_from(data,ptr)
                     ptr += 2
                     self.tail_reset_magic = magic
                 elif self.tail_subtype == 1:
-                    (iter,) = struct.unpack_from('<H',data,ptr)
+                    (iter,) = WPANFrame.U16.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_iterator = iter
                 elif self.tail_subtype == 2:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
+                    (cnt,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_config = {}
                     for i in range(cnt):
-                        (key,) = struct.unpack_from('<H',data,ptr)
+                        (key,) = WPANFrame.U16.unpack_from(data,ptr)
                         ptr += 2
                         self.tail_config[key] = None
                 elif self.tail_subtype == 3:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
+                    (cnt,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_config = {}
                     for i in range(cnt):
-                        (key,) = struct.unpack_from('<H',data,ptr)
+                        (key,) = WPANFrame.U16.unpack_from(data,ptr)
                         ptr += 2
                         (val,) = struct.unpack_from('<p',data,ptr)
                         ptr += len(val) + 1
                         self.tail_config[key] = val
                 elif self.tail_subtype == 4:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
+                    (cnt,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_config = {}
                     for i in range(cnt):
-                        (key,) = struct.unpack_from('<H',data,ptr)
+                        (key,) = WPANFrame.U16.unpack_from(data,ptr)
                         ptr += 2
                         self.tail_config[key] = None
                 elif self.tail_subtype == 5:
-                    (salt,) = struct.unpack_from('<16s',data,ptr)
+                    (salt,) = WPANFrame.BYTES16.unpack_from(data,ptr)
                     ptr += 16
                     self.tail_salt = salt
                 elif self.tailubtype == 15:
@@ -907,19 +1142,19 @@ class TailFrame(WPANFrame):
                     raise NotImplementedError('decode config request: {}'.format(self.tail_subtype))
             elif self.tail_frmtype == 5:
                 if self.tail_subtype == 0:
-                    (magic,) = struct.unpack_from('<H',data,ptr)
+                    (magic,) = WPANFrame.U16.unpack_from(data,ptr)
                     ptr += 2
                 elif self.tail_subtype == 1:
-                    (iter,cnt,) = struct.unpack_from('<HB',data,ptr)
+                    (iter,cnt,) = WPANFrame.U16U8.unpack_from(data,ptr)
                     ptr += 3
                     self.tail_iterator = iter
                     self.tail_config = {}
                     for i in range(cnt):
-                        (key,) = struct.unpack_from('<H',data,ptr)
+                        (key,) = WPANFrame.U16.unpack_from(data,ptr)
                         ptr += 2
                         self.tail_config[key] = None
                 elif self.tail_subtype == 2:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
+                    (cnt,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_config = {}
                     for i in range(cnt):
@@ -927,15 +1162,15 @@ class TailFrame(WPANFrame):
                         ptr += len(val) + 3
                         self.tail_config[key] = val
                 elif self.tail_subtype == 3:
-                    (code,) = struct.unpack_from('<B',data,ptr)
+                    (code,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_code = code
                 elif self.tail_subtype == 4:
-                    (code,) = struct.unpack_from('<B',data,ptr)
+                    (code,) = WPANFrame.U8.unpack_from(data,ptr)
                     ptr += 1
                     self.tail_code = code
                 elif self.tail_subtype == 5:
-                    (salt,) = struct.unpack_from('<16s',data,ptr)
+                    (salt,) = WPANFrame.BYTES16.unpack_from(data,ptr)
                     ptr += 16
                     self.tail_salt = salt
                 elif self.tail_subtype == 15:
@@ -950,41 +1185,11 @@ class TailFrame(WPANFrame):
                 rxtime = testbit(self.tail_subtype,1)
                 rxinfo = testbit(self.tail_subtype,0)
                 if txtime:
-                    (tstamp,) = struct.unpack_from('5s',data,ptr)
+                    (tstamp,) = WPANFrame.TS40.unpack_from(data,ptr)
                     ptr += 5
                     self.tail_txtime = TailFrame.tsdecode(tstamp)
-                if rxtime:
-                    self.tail_rxtimes = {}
-                if rxinfo:
-                    self.tail_rxinfos = {}
                 if rxtime or rxinfo:
-                    (cnt,) = struct.unpack_from('<B',data,ptr)
-                    ptr += 1
-                    bits = 0
-                    for i in range(0,cnt,8):
-                        (val,) = struct.unpack_from('<B',data,ptr)
-                        ptr += 1
-                        bits |= val << i
-                    for i in range(cnt):
-                        if testbit(bits,i):
-                            (addr,) = struct.unpack_from('8s',data,ptr)
-                            ptr += 8
-                        else:
-                            (addr,) = struct.unpack_from('2s',data,ptr)
-                            ptr += 2
-                        if rxtime:
-                            (val,) = struct.unpack_from('5s',data,ptr)
-                            ptr += 5
-                            tstamp = TailFrame.tsdecode(val)
-                            self.tail_rxtimes[byteswap(addr)] = tstamp
-                            if WPANFrame.match_if(byteswap(addr)):
-                                self.tail_rxtime = tstamp
-                        if rxinfo:
-                            rxinfo = struct.unpack_from('<4H',data,ptr)
-                            ptr += 8
-                            self.tail_rxinfos[byteswap(addr)] = rxinfo
-                            if WPANFrame.match_if(byteswap(addr)):
-                                self.tail_rxinfo = rxinfo
+                    self.tail_lazy = (TailFrame.decode_rxtables, data, ptr)
             else:
                 raise NotImplementedError('decode tail frametype: {}'.format(self.tail_frmtype))
     ## Tail encrypted protocol
@@ -995,6 +1200,94 @@ class TailFrame(WPANFrame):
         else:
             self.tail_protocol = 0
             self.tail_payload = data[ptr-1:]
+
+    def decode_lazy(self):
+        ## A truncated table fails here, on first access, and leaves the
+        ## lazy attributes None as if the frame had not carried them
+        (func,data,ptr) = self.tail_lazy
+        self.tail_lazy = None
+        try:
+            func(self,data,ptr)
+        except struct.error as err:
+            self._tail_cookie  = None
+            self._tail_ies     = None
+            self._tail_rxtime  = None
+            self._tail_rxtimes = None
+            self._tail_rxinfo  = None
+            self._tail_rxinfos = None
+            dprint(1, 'TailFrame::decode_lazy: {}: {}', func.__name__, err)
+
+    def decode_blink_ies(self,data,ptr):
+        if self.tail_cookie_present:
+            (cookie,) = WPANFrame.BYTES16.unpack_from(data,ptr)
+            ptr += 16
+            self.tail_cookie = cookie
+        if self.tail_ies_present:
+            (iec,) = WPANFrame.U8.unpack_from(data,ptr)
+            ptr += 1
+            ies = {}
+            for i in range(iec):
+                (id,) = WPANFrame.U8.unpack_from(data,ptr)
+                ptr += 1
+                idf = getbits(id,6,2)
+                if idf == 0:
+                    (val,) = WPANFrame.U8.unpack_from(data,ptr)
+                    ptr += 1
+                elif idf == 1:
+                    (val,) = WPANFrame.U16.unpack_from(data,ptr)
+                    ptr += 2
+                elif idf == 2:
+                    (val,) = WPANFrame.U32.unpack_from(data,ptr)
+                    ptr += 4
+                else:
+                    (val,) = struct.unpack_from('<p',data,ptr)
+                    ptr += len(val) + 1
+                if id in TailFrame.IE_CONV:
+                    val = TailFrame.IE_CONV[id](val)
+                if id in TailFrame.IE_KEYS:
+                    ies[TailFrame.IE_KEYS[id]] = val
+                else:
+                    ies['IE{:02X}'.format(id)] = val
+            self.tail_ies = ies
+
+    def decode_rxtables(self,data,ptr):
+        ## Ranging (3) frames carry rx times; timing (15) frames rx times and/or infos
+        if self.tail_frmtype == 3:
+            (rxtime,rxinfo) = (True,False)
+        else:
+            rxtime = testbit(self.tail_subtype,1)
+            rxinfo = testbit(self.tail_subtype,0)
+        rxtimes = {} if rxtime else None
+        rxinfos = {} if rxinfo else None
+        (cnt,) = WPANFrame.U8.unpack_from(data,ptr)
+        ptr += 1
+        bits = 0
+        for i in range(0,cnt,8):
+            (val,) = WPANFrame.U8.unpack_from(data,ptr)
+            ptr += 1
+            bits |= val << i
+        for i in range(cnt):
+            if testbit(bits,i):
+                addr = swapfrom(data,ptr,8)
+                ptr += 8
+            else:
+                addr = swapfrom(data,ptr,2)
+                ptr += 2
+            if rxtime:
+                (val,) = WPANFrame.TS40.unpack_from(data,ptr)
+                ptr += 5
+                tstamp = TailFrame.tsdecode(val)
+                rxtimes[addr] = tstamp
+                if WPANFrame.match_if(addr):
+                    self.tail_rxtime = tstamp
+            if rxinfo:
+                info = WPANFrame.RXINFO.unpack_from(data,ptr)
+                ptr += 8
+                rxinfos[addr] = info
+                if WPANFrame.match_if(addr):
+                    self.tail_rxinfo = info
+        self.tail_rxtimes = rxtimes
+        self.tail_rxinfos = rxinfos
             
     def encode(self):
         data = WPANFrame.encode(self)
@@ -1297,6 +1590,32 @@ class TailFrame(WPANFrame):
                 str += fattrnl('Raw Payload', tail_payload.hex(), 2)
         return str
 
+
+class BeaconTemplate():
+
+    ## A beacon frame encoded once per source, destination and subtype.
+    ## Each transmission only patches the sequence number, flags and ref.
+
+    def __init__(self, src, dst=0xffff, sub=0):
+        frame = TailFrame()
+        frame.set_src_addr(src)
+        frame.set_dst_addr(dst)
+        frame.frame_seqnum = 0
+        frame.tail_protocol = 1
+        frame.tail_frmtype = 1
+        frame.tail_subtype = sub
+        frame.tail_flags = 0
+        frame.tail_beacon = bytes(8)
+        self.data = bytearray(frame.encode())
+        self.ptr = len(self.data) - 9
+
+    def encode(self, ref, flags=0):
+        self.data[2] = WPANFrame.DSN
+        WPANFrame.DSN = (WPANFrame.DSN + 1) & 0xff
+        self.data[self.ptr] = flags
+        self.data[self.ptr+1:self.ptr+9] = byteswap(bytes.fromhex(ref))
+        return bytes(self.data)
+
     
 ## Missing values in socket
     
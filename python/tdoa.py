@@ -14,7 +14,7 @@ from numpy import dot
 ## Functions
 
 def dsq(a):
-    return np.sum((a*a).T,0)
+    return np.sum(a*a,-1)
 
 def norm(a):
     return np.sqrt(dsq(a))
@@ -22,6 +22,11 @@ def norm(a):
 def dist(x,y):
     return norm(x-y)
 
+def hyperresidual(b0,x,bi,di):
+    ## RMS of the TDOA range residuals at x
+    E = dist(bi,x) - dist(b0,x) - di
+    return math.sqrt(np.mean(E*E))
+
 def hypercone(b0,bi,di):
     dim = len(b0)
     bi0 = bi - b0
@@ -168,3 +173,507 @@ def hyperlater3Dp(ref_coord,coords,ranges,sigmas,delta=None,theta=0.045,maxiter=
         Y,C = hyperjump3Dp(B0,X,B,R,S,theta)
     return Y,C
 
+
+## Solver workspace
+##
+## HyperSolver runs the same iteration as hyperlater2D/3D/3Dp but keeps
+## its matrices in preallocated buffers. The measurement rows are filled
+## once per problem; each jump only rewrites the constraint rows and the
+## weights, which are applied by row scaling. The condition number costs
+## a full SVD and is only computed when asked for.
+
+class HyperSolver():
+
+    def __init__(self, size=16):
+        self.iters = 0
+        self.warm = False
+        self.bufs = {}
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self.dis = np.zeros(size)
+        self.bis = np.zeros((size,3))
+        for cols in (3,4):
+            rows = size + cols - 1
+            self.bufs[cols] = (
+                np.zeros((rows,cols)),
+                np.zeros((rows,cols)),
+                np.zeros(rows),
+                np.zeros(rows),
+                np.zeros((cols,cols)),
+                np.zeros(cols),
+            )
+
+    def setup(self, n, cols):
+        if n > self.size:
+            self.resize(max(n, 2*self.size))
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.bufs[cols]
+        m = n + cols - 1
+        self.n = n
+        self.work = (Gb[:m],GW[:m],hb[:m],Ws[:m],Gbb,Gbh)
+        Gb[n:m] = 0
+        hb[n:m] = 0
+        return self.work
+
+    def weights(self, bi, bs, sigma):
+        n = self.n
+        bis = self.bis[:n,:bi.shape[1]]
+        dis = self.dis[:n]
+        Ws = self.work[3]
+        np.subtract(bi, bs[0:bi.shape[1]], out=bis)
+        np.multiply(bis, bis, out=bis)
+        np.sum(bis, 1, out=dis)
+        np.sqrt(dis, out=dis)
+        np.multiply(dis, sigma, out=Ws[:n])
+        np.multiply(Ws[:n], Ws[:n], out=Ws[:n])
+        np.reciprocal(Ws[:n], out=Ws[:n])
+
+    def solve(self):
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.work
+        np.multiply(Gb, Ws[:,np.newaxis], out=GW)
+        np.dot(GW.T, Gb, out=Gbb)
+        np.dot(GW.T, hb, out=Gbh)
+        return lin.solve(Gbb,Gbh)
+
+    def cone(self):
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.work
+        n = self.n
+        np.dot(Gb[:n].T, Gb[:n], out=Gbb)
+        np.dot(Gb[:n].T, hb[:n], out=Gbh)
+        return lin.solve(Gbb,Gbh)
+
+    def jump2D(self, b0, bs, bi, sigma, theta):
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.work
+        n = self.n
+        bs0 = bs - b0
+        ds0 = math.sqrt(dot(bs0,bs0))
+        Gb[n,0:2] = bs0
+        Gb[n,2] = -ds0
+        Gb[n+1,0] = bs[1]
+        Gb[n+1,1] = -bs[0]
+        hb[n] = dot(bs0,b0)
+        Cv = ds0*theta
+        Cc = ds0*theta*theta/2
+        self.weights(bi, bs, sigma)
+        Ws[n] = 1/(Cc*Cc)
+        Ws[n+1] = 1/(Cv*Cv)
+        X = self.solve()
+        return X[0:2]
+
+    def jump3D(self, b0, bs, bi, sigma, theta):
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.work
+        n = self.n
+        bs0 = bs - b0
+        ds0 = math.sqrt(dot(bs0,bs0))
+        Gb[n,0:3] = bs0
+        Gb[n,3] = -ds0
+        Gb[n+1,0] = bs[1]
+        Gb[n+1,1] = -bs[0]
+        Gb[n+2,0] = bs[2]
+        Gb[n+2,2] = -bs[0]
+        hb[n] = dot(bs0,b0)
+        Cv = ds0*theta
+        Cc = ds0*theta*theta/2
+        self.weights(bi, bs, sigma)
+        Ws[n] = 1/(Cc*Cc)
+        Ws[n+1] = 1/(Cv*Cv)
+        Ws[n+2] = 1/(Cv*Cv)
+        X = self.solve()
+        return X[0:3]
+
+    def jump3Dp(self, b0, bs, bi, sigma, theta):
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.work
+        n = self.n
+        bs0 = bs - b0
+        ds0 = math.sqrt(dot(bs0,bs0))
+        Gb[n,0:2] = bs0[0:2]
+        Gb[n,2] = -ds0
+        Gb[n+1,0] = bs[1]
+        Gb[n+1,1] = -bs[0]
+        hb[n] = dot(bs0[0:2],b0[0:2])
+        Cv = ds0*theta
+        Cc = ds0*theta*theta/2
+        self.weights(bi, bs, sigma)
+        Ws[n] = 1/(Cc*Cc)
+        Ws[n+1] = 1/(Cv*Cv)
+        X = self.solve()
+        return np.array((X[0],X[1],bs[2]))
+
+    def start(self, B0, B, R, x_init, r_max):
+        ## Warm start from x_init when its residual is within r_max, else None
+        self.warm = False
+        if x_init is not None:
+            X = np.array(x_init, dtype=float)
+            if hyperresidual(B0,X,B,R) <= r_max:
+                self.warm = True
+                return X
+        return None
+
+    def iterate(self, jump, B0, X, B, S, delta, theta, maxiter, cond):
+        Y = jump(B0,X,B,S,theta)
+        if delta is None:
+            delta = np.amin(S) / 2
+        N = 1
+        while N < maxiter and dist(X,Y) > delta:
+            X = Y
+            N = N + 1
+            Y = jump(B0,X,B,S,theta)
+        self.iters = N
+        if cond:
+            return Y,lin.cond(self.work[4])
+        return Y,None
+
+    def hyperlater2D(self,ref_coord,coords,ranges,sigmas,delta=None,theta=0.045,maxiter=8,cond=False,x_init=None,r_max=0.1):
+        if len(ref_coord) != 2:
+            raise ValueError('hyperlater2D only accepts 2D coordinsates')
+        if len(coords) < 3:
+            raise np.linalg.LinAlgError('Not enough inputs: {}'.format(len(coords)))
+        B0 = np.asarray(ref_coord, dtype=float)
+        B = np.asarray(coords, dtype=float)
+        R = np.asarray(ranges, dtype=float)
+        S = np.asarray(sigmas, dtype=float)
+        n = len(B)
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.setup(n,3)
+        np.subtract(B, B0, out=Gb[:n,0:2])
+        Gb[:n,2] = R
+        hb[:n] = (dsq(B) - dot(B0,B0) - R*R) / 2
+        X = self.start(B0,B,R,None if x_init is None else x_init[0:2],r_max)
+        if X is None:
+            X = self.cone()[0:2]
+        Y,C = self.iterate(self.jump2D,B0,X,B,S,delta,theta,maxiter,cond)
+        X = np.array((Y[0],Y[1],0))
+        return X,C
+
+    def hyperlater3D(self,ref_coord,coords,ranges,sigmas,delta=None,theta=0.045,maxiter=8,cond=False,x_init=None,r_max=0.1):
+        if len(ref_coord) != 3:
+            raise ValueError('hyperlater3D only accepts 3D coordinsates')
+        if len(coords) < 4:
+            raise np.linalg.LinAlgError('Not enough inputs: {}'.format(len(coords)))
+        B0 = np.asarray(ref_coord, dtype=float)
+        B = np.asarray(coords, dtype=float)
+        R = np.asarray(ranges, dtype=float)
+        S = np.asarray(sigmas, dtype=float)
+        n = len(B)
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.setup(n,4)
+        np.subtract(B, B0, out=Gb[:n,0:3])
+        Gb[:n,3] = R
+        hb[:n] = (dsq(B) - dot(B0,B0) - R*R) / 2
+        X = self.start(B0,B,R,x_init,r_max)
+        if X is None:
+            X = self.cone()[0:3]
+        return self.iterate(self.jump3D,B0,X,B,S,delta,theta,maxiter,cond)
+
+    def hyperlater3Dp(self,ref_coord,coords,ranges,sigmas,delta=None,theta=0.045,maxiter=8,z_est=0.0,cond=False,x_init=None,r_max=0.1):
+        if len(ref_coord) != 3:
+            raise ValueError('hyperlater_pseudo3D only accepts 3D coordinsates')
+        if len(coords) < 4:
+            raise np.linalg.LinAlgError('Not enough inputs: {}'.format(len(coords)))
+        B0 = np.asarray(ref_coord, dtype=float)
+        B = np.asarray(coords, dtype=float)
+        R = np.asarray(ranges, dtype=float)
+        S = np.asarray(sigmas, dtype=float)
+        n = len(B)
+        (Gb,GW,hb,Ws,Gbb,Gbh) = self.setup(n,3)
+        np.subtract(B[:,0:2], B0[0:2], out=Gb[:n,0:2])
+        Gb[:n,2] = R
+        hb[:n] = (dsq(B[:,0:2]) - dot(B0[0:2],B0[0:2]) - R*R) / 2
+        X = self.start(B0,B,R,None if x_init is None else (x_init[0],x_init[1],z_est),r_max)
+        if X is None:
+            X = self.cone()
+            X = np.array((X[0],X[1],z_est))
+        ## The z term is constant: bs_z stays at z_est throughout
+        bi0_z = B[:,2] - B0[2]
+        hb[:n] += bi0_z * ((B[:,2] - z_est) + (B0[2] - z_est)) / 2
+        return self.iterate(self.jump3Dp,B0,X,B,S,delta,theta,maxiter,cond)
+
+
+## Batch solvers
+##
+## K problems are packed into padded arrays: reference coords (K,D),
+## anchor coords (K,N,D), ranges and sigmas (K,N), and a (K,N) mask of
+## valid entries. Padded entries carry no weight in the solution.
+
+def hyperpack(coords,ranges,sigmas,dim=3):
+    K = len(coords)
+    N = max([ len(c) for c in coords ] + [0])
+    B = np.zeros((K,N,dim))
+    R = np.zeros((K,N))
+    S = np.ones((K,N))
+    M = np.zeros((K,N), dtype=bool)
+    for k in range(K):
+        n = len(coords[k])
+        if n > 0:
+            B[k,:n] = coords[k]
+            R[k,:n] = ranges[k]
+            S[k,:n] = sigmas[k]
+            M[k,:n] = True
+    return B,R,S,M
+
+def solve_batch(A,b):
+    try:
+        X = lin.solve(A,b[...,np.newaxis])[...,0]
+        OK = np.ones(len(A), dtype=bool)
+    except lin.LinAlgError:
+        X = np.zeros(b.shape)
+        OK = np.zeros(len(A), dtype=bool)
+        for k in range(len(A)):
+            try:
+                X[k] = lin.solve(A[k],b[k])
+                OK[k] = True
+            except lin.LinAlgError:
+                pass
+    return X,OK
+
+def hypercone_batch(b0,bi,di,mask):
+    dim = b0.shape[-1]
+    W = mask[:,:,np.newaxis]
+    bi0 = bi - b0[:,np.newaxis,:]
+    Gb = np.concatenate((bi0,di[:,:,np.newaxis]),2) * W
+    hb = (dsq(bi) - dsq(b0)[:,np.newaxis] - di*di) / 2 * mask
+    GbT = Gb.transpose(0,2,1)
+    Gbb = np.matmul(GbT,Gb)
+    Gbh = np.matmul(GbT,hb[:,:,np.newaxis])[:,:,0]
+    X,OK = solve_batch(Gbb,Gbh)
+    return X[:,0:dim],OK
+
+def hyperjump2D_batch(b0,bs,bi,di,sigma,mask,theta,cond=False):
+    (K,N,_) = bi.shape
+    bi0 = bi - b0[:,np.newaxis,:]
+    bs0 = bs - b0
+    ds0 = norm(bs0)
+    dis = norm(bi - bs[:,np.newaxis,:])
+    Gb = np.zeros((K,N+2,3))
+    Gb[:,:N,0:2] = bi0
+    Gb[:,:N,2] = di
+    Gb[:,N,0:2] = bs0
+    Gb[:,N,2] = -ds0
+    Gb[:,N+1,0] = bs[:,1]
+    Gb[:,N+1,1] = -bs[:,0]
+    hb = np.zeros((K,N+2))
+    hb[:,:N] = (dsq(bi) - dsq(b0)[:,np.newaxis] - di*di) / 2
+    hb[:,N] = np.sum(bs0*b0,-1)
+    Cv = ds0*theta
+    Cc = ds0*theta*theta/2
+    Pm = dis*sigma
+    Ws = np.zeros((K,N+2))
+    np.divide(1, Pm*Pm, out=Ws[:,:N], where=mask)
+    Ws[:,N] = 1/(Cc*Cc)
+    Ws[:,N+1] = 1/(Cv*Cv)
+    GbT = (Gb * Ws[:,:,np.newaxis]).transpose(0,2,1)
+    Gbb = np.matmul(GbT,Gb)
+    Gbh = np.matmul(GbT,hb[:,:,np.newaxis])[:,:,0]
+    X,OK = solve_batch(Gbb,Gbh)
+    C = np.full(K, np.nan)
+    if cond:
+        C[~OK] = np.inf
+        if OK.any():
+            C[OK] = lin.cond(Gbb[OK])
+    return X[:,0:2],C,OK
+
+def hyperjump3D_batch(b0,bs,bi,di,sigma,mask,theta,cond=False):
+    (K,N,_) = bi.shape
+    bi0 = bi - b0[:,np.newaxis,:]
+    bs0 = bs - b0
+    ds0 = norm(bs0)
+    dis = norm(bi - bs[:,np.newaxis,:])
+    Gb = np.zeros((K,N+3,4))
+    Gb[:,:N,0:3] = bi0
+    Gb[:,:N,3] = di
+    Gb[:,N,0:3] = bs0
+    Gb[:,N,3] = -ds0
+    Gb[:,N+1,0] = bs[:,1]
+    Gb[:,N+1,1] = -bs[:,0]
+    Gb[:,N+2,0] = bs[:,2]
+    Gb[:,N+2,2] = -bs[:,0]
+    hb = np.zeros((K,N+3))
+    hb[:,:N] = (dsq(bi) - dsq(b0)[:,np.newaxis] - di*di) / 2
+    hb[:,N] = np.sum(bs0*b0,-1)
+    Cv = ds0*theta
+    Cc = ds0*theta*theta/2
+    Pm = dis*sigma
+    Ws = np.zeros((K,N+3))
+    np.divide(1, Pm*Pm, out=Ws[:,:N], where=mask)
+    Ws[:,N] = 1/(Cc*Cc)
+    Ws[:,N+1] = 1/(Cv*Cv)
+    Ws[:,N+2] = 1/(Cv*Cv)
+    GbT = (Gb * Ws[:,:,np.newaxis]).transpose(0,2,1)
+    Gbb = np.matmul(GbT,Gb)
+    Gbh = np.matmul(GbT,hb[:,:,np.newaxis])[:,:,0]
+    X,OK = solve_batch(Gbb,Gbh)
+    C = np.full(K, np.nan)
+    if cond:
+        C[~OK] = np.inf
+        if OK.any():
+            C[OK] = lin.cond(Gbb[OK])
+    return X[:,0:3],C,OK
+
+def hyperwarm_batch(B0,B,R,M,x_init,r_max):
+    ## Problems whose x_init row is finite and fits within r_max RMS residual
+    Z = np.asarray(x_init, dtype=float)
+    W = np.isfinite(Z).all(1)
+    if W.any():
+        Z = np.where(W[:,np.newaxis], Z, 0)
+        E = (dist(B, Z[:,np.newaxis,:]) - dist(B0, Z)[:,np.newaxis] - R) * M
+        rms = np.sqrt(np.sum(E*E,1) / np.maximum(np.sum(M,1),1))
+        W &= (rms <= r_max)
+    return W
+
+def hyperinfo_batch(info,W,I):
+    if info is not None:
+        info['warm'] = W
+        info['iters'] = I
+
+def hyperiter_batch(jump,B0,X,B,R,S,M,OK,delta,theta,maxiter,cond,iters=None):
+    ## The condition numbers cost an SVD per problem per step; NaN unless cond
+    Y = X.copy()
+    C = np.full(len(B0), np.inf if cond else np.nan)
+    act = np.flatnonzero(OK)
+    N = 0
+    while N < maxiter and act.size:
+        if N > 0:
+            act = act[dist(X[act],Y[act]) > delta[act]]
+            X[act] = Y[act]
+        if act.size:
+            N = N + 1
+            Y[act],C[act],ok = jump(B0[act],X[act],B[act],R[act],S[act],M[act],theta,cond)
+            if iters is not None:
+                iters[act] += 1
+            OK[act[~ok]] = False
+            act = act[ok]
+    return Y,C,OK
+
+def hyperlater2D_batch(ref_coords,coords,ranges,sigmas,mask,delta=None,theta=0.045,maxiter=8,cond=False,x_init=None,r_max=0.1,info=None):
+    B0 = np.asarray(ref_coords, dtype=float)
+    B = np.asarray(coords, dtype=float)
+    R = np.asarray(ranges, dtype=float)
+    S = np.asarray(sigmas, dtype=float)
+    M = np.asarray(mask, dtype=bool)
+    K = len(B0)
+    if B0.shape[-1] != 2:
+        raise ValueError('hyperlater2D_batch only accepts 2D coordinsates')
+    if delta is None:
+        delta = np.amin(np.where(M,S,np.inf),1,initial=np.inf) / 2
+    delta = np.broadcast_to(delta,(K,))
+    X = np.zeros((K,2))
+    OK = (np.sum(M,1) >= 3)
+    W = np.zeros(K, dtype=bool)
+    if x_init is not None:
+        Z = np.asarray(x_init, dtype=float)[:,0:2]
+        W = OK & hyperwarm_batch(B0,B,R,M,Z,r_max)
+        X[W] = Z[W]
+    cold = OK & ~W
+    if cold.any():
+        X[cold],ok = hypercone_batch(B0[cold],B[cold],R[cold],M[cold])
+        OK[np.flatnonzero(cold)[~ok]] = False
+    I = np.zeros(K, dtype=int)
+    Y,C,OK = hyperiter_batch(hyperjump2D_batch,B0,X,B,R,S,M,OK,delta,theta,maxiter,cond,I)
+    hyperinfo_batch(info,W,I)
+    X = np.zeros((K,3))
+    X[:,0:2] = Y
+    return X,C,OK
+
+def hyperlater3D_batch(ref_coords,coords,ranges,sigmas,mask,delta=None,theta=0.045,maxiter=8,cond=False,x_init=None,r_max=0.1,info=None):
+    B0 = np.asarray(ref_coords, dtype=float)
+    B = np.asarray(coords, dtype=float)
+    R = np.asarray(ranges, dtype=float)
+    S = np.asarray(sigmas, dtype=float)
+    M = np.asarray(mask, dtype=bool)
+    K = len(B0)
+    if B0.shape[-1] != 3:
+        raise ValueError('hyperlater3D_batch only accepts 3D coordinsates')
+    if delta is None:
+        delta = np.amin(np.where(M,S,np.inf),1,initial=np.inf) / 2
+    delta = np.broadcast_to(delta,(K,))
+    X = np.zeros((K,3))
+    OK = (np.sum(M,1) >= 4)
+    W = np.zeros(K, dtype=bool)
+    if x_init is not None:
+        Z = np.asarray(x_init, dtype=float)
+        W = OK & hyperwarm_batch(B0,B,R,M,Z,r_max)
+        X[W] = Z[W]
+    cold = OK & ~W
+    if cold.any():
+        X[cold],ok = hypercone_batch(B0[cold],B[cold],R[cold],M[cold])
+        OK[np.flatnonzero(cold)[~ok]] = False
+    I = np.zeros(K, dtype=int)
+    Y,C,OK = hyperiter_batch(hyperjump3D_batch,B0,X,B,R,S,M,OK,delta,theta,maxiter,cond,I)
+    hyperinfo_batch(info,W,I)
+    return Y,C,OK
+
+
+def hyperjump3Dp_batch(b0,bs,bi,di,sigma,mask,theta,cond=False):
+    (K,N,_) = bi.shape
+    bi_xy = bi[:,:,0:2]
+    bi_z = bi[:,:,2]
+    b0_xy = b0[:,0:2]
+    b0_z = b0[:,2]
+    bs_xy = bs[:,0:2]
+    bs_z = bs[:,2]
+    bi0_xy = bi_xy - b0_xy[:,np.newaxis,:]
+    bi0_z = bi_z - b0_z[:,np.newaxis]
+    bs0 = bs - b0
+    bs0_xy = bs_xy - b0_xy
+    ci0_z = bi0_z * ((bi_z - bs_z[:,np.newaxis]) + (b0_z - bs_z)[:,np.newaxis])
+    ds0 = norm(bs0)
+    dis = norm(bi - bs[:,np.newaxis,:])
+    Gb = np.zeros((K,N+2,3))
+    Gb[:,:N,0:2] = bi0_xy
+    Gb[:,:N,2] = di
+    Gb[:,N,0:2] = bs0_xy
+    Gb[:,N,2] = -ds0
+    Gb[:,N+1,0] = bs[:,1]
+    Gb[:,N+1,1] = -bs[:,0]
+    hb = np.zeros((K,N+2))
+    hb[:,:N] = (dsq(bi_xy) - dsq(b0_xy)[:,np.newaxis] - di*di + ci0_z) / 2
+    hb[:,N] = np.sum(bs0_xy*b0_xy,-1)
+    Cv = ds0*theta
+    Cc = ds0*theta*theta/2
+    Pm = dis*sigma
+    Ws = np.zeros((K,N+2))
+    np.divide(1, Pm*Pm, out=Ws[:,:N], where=mask)
+    Ws[:,N] = 1/(Cc*Cc)
+    Ws[:,N+1] = 1/(Cv*Cv)
+    GbT = (Gb * Ws[:,:,np.newaxis]).transpose(0,2,1)
+    Gbb = np.matmul(GbT,Gb)
+    Gbh = np.matmul(GbT,hb[:,:,np.newaxis])[:,:,0]
+    X,OK = solve_batch(Gbb,Gbh)
+    C = np.full(K, np.nan)
+    if cond:
+        C[~OK] = np.inf
+        if OK.any():
+            C[OK] = lin.cond(Gbb[OK])
+    R = np.zeros((K,3))
+    R[:,0:2] = X[:,0:2]
+    R[:,2] = bs[:,2]
+    return R,C,OK
+
+def hyperlater3Dp_batch(ref_coords,coords,ranges,sigmas,mask,delta=None,theta=0.045,maxiter=8,z_est=0.0,cond=False,x_init=None,r_max=0.1,info=None):
+    B0 = np.asarray(ref_coords, dtype=float)
+    B = np.asarray(coords, dtype=float)
+    R = np.asarray(ranges, dtype=float)
+    S = np.asarray(sigmas, dtype=float)
+    M = np.asarray(mask, dtype=bool)
+    K = len(B0)
+    if B0.shape[-1] != 3:
+        raise ValueError('hyperlater3Dp_batch only accepts 3D coordinsates')
+    if delta is None:
+        delta = np.amin(np.where(M,S,np.inf),1,initial=np.inf) / 2
+    delta = np.broadcast_to(delta,(K,))
+    X = np.zeros((K,3))
+    X[:,2] = z_est
+    OK = (np.sum(M,1) >= 4)
+    W = np.zeros(K, dtype=bool)
+    if x_init is not None:
+        Z = np.array(x_init, dtype=float)
+        Z[:,2] = z_est
+        W = OK & hyperwarm_batch(B0,B,R,M,Z,r_max)
+        X[W] = Z[W]
+    cold = OK & ~W
+    if cold.any():
+        X[cold,0:2],ok = hypercone_batch(B0[cold,0:2],B[cold,:,0:2],R[cold],M[cold])
+        OK[np.flatnonzero(cold)[~ok]] = False
+    I = np.zeros(K, dtype=int)
+    Y,C,OK = hyperiter_batch(hyperjump3Dp_batch,B0,X,B,R,S,M,OK,delta,theta,maxiter,cond,I)
+    hyperinfo_batch(info,W,I)
+    return Y,C,OK
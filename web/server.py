@@ -64,17 +64,22 @@ async def notifier(app):
                 raw = await reader.readuntil(RS)
                 data = json.loads(raw.rstrip(RS))
                 logger.debug("Received: %s", data)
-                if data['Type'] != 'TAG':
+                if data['Type'] == 'TAG':
+                    tags = [data]
+                elif data['Type'] == 'TAGS':
+                    tags = data['Tags']
+                else:
                     continue
                 notice = {
-                    data['Tag']: {
-                        'name': data['Name'],
-                        'color': data['Colour'],
-                        'x': data['Coord'][0],
-                        'y': data['Coord'][1],
-                        'z': data['Coord'][2],
+                    tag['Tag']: {
+                        'name': tag['Name'],
+                        'color': tag['Colour'],
+                        'x': tag['Coord'][0],
+                        'y': tag['Coord'][1],
+                        'z': tag['Coord'][2],
                         'r': RADIUS,
-                    },
+                    }
+                    for tag in tags
                 }
                 logger.debug("Notifying %d clients: %s",
                              len(app['clients']), notice)